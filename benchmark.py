@@ -0,0 +1,157 @@
+"""
+This code benchmarks the preprocessing and analysis stages on synthetic recordings (see synthetic.py).
+Every stage is timed over a number of repeats and then run once more under tracemalloc for its peak memory,
+for each recording length. The results are written to a json file with the versions of the packages and the
+git commit, so the results of two versions can be compared with --compare.
+
+python benchmark.py --durations 600 3600 10800 --repeats 3 --output benchmark_results.json
+python benchmark.py --compare old_results.json new_results.json
+"""
+import numpy as np
+import pandas as pd
+import scipy
+import argparse
+import datetime
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+import time
+import json
+import os
+import preprocessing_v2
+import peri_event
+import data_store
+import synthetic
+
+#Recording lengths (seconds) benchmarked by default, 10 minutes to 3 hours.
+DURATIONS = [600, 3600, 10800]
+
+## This function records the package versions, machine and git commit the benchmark ran with
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count()
+    }
+
+
+## This function times a call over repeats and measures its peak memory in one more call under tracemalloc
+def measure(function, repeats):
+    #Returns the result of the last call, the times in seconds and the peak memory in bytes allocated during the call.
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+        del result
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, times, peak
+
+
+## This function lists the benchmarked stages of one recording as (name, function) pairs
+def stages(duration, work_path, factor = 10, pre = 20, post = 60):
+    #Every stage reads the output of the stage before it, which is computed once up front, so the stages can be
+    #timed separately. The stages are never run in place so their inputs stay the same between repeats.
+    INFO, OUTPUTS, TIMESTAMPS, SAMPLING_RATE = synthetic.synthetic_open_tank('benchmark', 0, {'A': 'benchmark'}, 'none', 'none', duration = duration)['A']
+    filtered_data = preprocessing_v2.zero_phase_filter(OUTPUTS, SAMPLING_RATE)
+    detrended_data, exponential_fit = preprocessing_v2.photo_bleach_correction(filtered_data, fit_rate = 10)
+    motion_corrected_data, motion_fit = preprocessing_v2.motion_correction(detrended_data)
+    normalised_data = preprocessing_v2.normalisation(motion_corrected_data, exponential_fit)
+    shortened_data, factor = peri_event.downsample(normalised_data, SAMPLING_RATE, factor = factor)
+    event_index = peri_event.align_events(shortened_data['time'], TIMESTAMPS.ts)
+
+    csv_path = os.path.join(work_path, 'normalised_data.csv')
+    store_path = os.path.join(work_path, 'store')
+    csv_data = {column: np.asarray(values) for column, values in normalised_data.items()}
+    pd.DataFrame(csv_data).to_csv(csv_path)
+    data_store.write_store(store_path, {'normalised_data': normalised_data}, INFO, TIMESTAMPS)
+
+    return len(OUTPUTS['signal']), [
+        ('zero_phase_filter', lambda: preprocessing_v2.zero_phase_filter(OUTPUTS, SAMPLING_RATE)),
+        ('photo_bleach_correction', lambda: preprocessing_v2.photo_bleach_correction(filtered_data, fit_rate = 10)),
+        ('motion_correction', lambda: preprocessing_v2.motion_correction(detrended_data)),
+        ('normalisation', lambda: preprocessing_v2.normalisation(motion_corrected_data, exponential_fit)),
+        ('downsample', lambda: peri_event.downsample(normalised_data, SAMPLING_RATE, factor = factor)),
+        ('align_events', lambda: peri_event.align_events(shortened_data['time'], TIMESTAMPS.ts)),
+        ('peri_event_windows', lambda: peri_event.peri_event_windows(shortened_data, event_index, TIMESTAMPS.notes,
+                                                                     SAMPLING_RATE/factor, pre = pre, post = post)),
+        ('csv_write', lambda: pd.DataFrame(csv_data).to_csv(csv_path)),
+        ('csv_read', lambda: pd.read_csv(csv_path, index_col = 0)),
+        ('store_write', lambda: data_store.write_store(store_path, {'normalised_data': normalised_data}, INFO, TIMESTAMPS)),
+        ('store_read', lambda: {column: np.array(values) for column, values in data_store.read_stage(store_path, 'normalised_data').items()})
+    ]
+
+
+## This function runs every stage for every recording length and returns one result per stage and length
+def run_benchmarks(durations = DURATIONS, repeats = 3, names = None):
+    results = []
+    for duration in durations:
+        with tempfile.TemporaryDirectory() as work_path:
+            samples, benchmarks = stages(duration, work_path)
+            for name, function in benchmarks:
+                if names is not None and name not in names:
+                    continue
+                _, times, peak = measure(function, repeats)
+                result = {
+                    'stage': name,
+                    'duration': duration,
+                    'samples': samples,
+                    'repeats': repeats,
+                    'best_time': min(times),
+                    'median_time': float(np.median(times)),
+                    'peak_memory_mb': peak/2**20
+                }
+                print(f"{name:>24} {duration:>6} s: {result['best_time']:8.3f} s, {result['peak_memory_mb']:8.1f} MB")
+                results.append(result)
+    return results
+
+
+## This function compares two result files, stage by stage, as the ratio of the new to the old time and memory
+def compare(old_path, new_path):
+    frames = []
+    for path in (old_path, new_path):
+        with open(path) as f:
+            frames.append(pd.DataFrame(json.load(f)['results']).set_index(['stage', 'duration']))
+    old, new = frames
+    comparison = old[['best_time', 'peak_memory_mb']].join(new[['best_time', 'peak_memory_mb']], lsuffix = '_old', rsuffix = '_new', how = 'inner')
+    comparison['time_ratio'] = comparison['best_time_new']/comparison['best_time_old']
+    comparison['memory_ratio'] = comparison['peak_memory_mb_new']/comparison['peak_memory_mb_old']
+    print(comparison.to_string(float_format = lambda x: f'{x:.3f}'))
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the preprocessing and analysis stages on synthetic recordings.')
+    parser.add_argument('--durations', type = float, nargs = '+', default = DURATIONS, help = 'recording lengths in seconds')
+    parser.add_argument('--repeats', type = int, default = 3, help = 'timed repeats of every stage')
+    parser.add_argument('--stages', nargs = '+', default = None, help = 'only run these stages')
+    parser.add_argument('--output', default = 'benchmark_results.json', help = 'json file the results are written to')
+    parser.add_argument('--compare', nargs = 2, metavar = ('OLD', 'NEW'), help = 'compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        results = run_benchmarks(args.durations, args.repeats, args.stages)
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent = 1)
+        print(f'Results written to {args.output}')
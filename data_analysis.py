@@ -5,109 +5,194 @@ import pandas as pd
 import os 
 import numpy as np
 import warnings
+import options as run_options
+import peri_event
+import data_store
+import instrument
+import import_tank_v2
+import event_cube
+import transients
+import work_queue
+import sys
+import traceback
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
-print('Please input path to settings file: ')
-output_file_path = input()
-settings_path = os.path.join(output_file_path,'settings.xlsx')
-settings = pd.read_excel(settings_path)
-
-#loop through settings file to extract directories for treatment and subjects.
-treatments = list(set(settings['treatment_name']))
-setup_A = list(set(settings['setup_a']))
-setup_B = list(set(settings['setup_b']))
-setup_A.extend(setup_B)
-subjects = [x for x in setup_A if x == x]
-subjects = [str(i) for i in subjects]
-
-
-print(f"Exporting timestamps \nSubjects: {subjects} \nTreatments: {treatments}")
-
-for treatment in treatments:
-    treatment_path = os.path.join(output_file_path, treatment)
-    for subject in subjects:
-        #setting paths to timestamps and normalised data
-        subject_path = os.path.join(treatment_path, subject)
-        data_path = os.path.join(subject_path,'data/normalised_data.csv')
-        ts_path = os.path.join(subject_path, 'timestamps.csv')
-
-        if os.path.exists(subject_path) == False:
-            continue
-        else:
-
-            #open timestamps.csv and normalised data
-            timestamps = pd.read_csv(ts_path, index_col = 0)
-            data = pd.read_csv(data_path, index_col = 0)
+## This function exports the peri-event windows, event metrics and event cube entry of one subject of one treatment
+def analyse_subject(output_file_path, options, treatment, subject):
+    #Returns the names of the event types, None when the subject has no folder in this treatment.
+    #setting paths to timestamps and normalised data
+    subject_path = os.path.join(output_file_path, treatment, subject)
+    data_dir = os.path.join(subject_path, 'data')
+    data_path = os.path.join(data_dir, 'normalised_data.csv')
+    ts_path = os.path.join(subject_path, 'timestamps.csv')
+    info_path = os.path.join(subject_path, 'info.csv')
+
+    if os.path.exists(subject_path) == False:
+        return None
+    else:
+        #every step of this subject is recorded with its treatment and ID when instrument is set
+        with instrument.context(treatment = treatment, id = subject):
+            #open the timestamps and normalised data, memory-mapped from the binary store or from the csv files of older exports
+            with instrument.stage('read_data'):
+                if data_store.has_store(data_dir):
+                    timestamps = data_store.read_timestamps(data_dir)
+                    data = data_store.read_stage(data_dir, 'normalised_data')
+                    info = pd.DataFrame(data_store.read_info(data_dir), index = [0])
+                else:
+                    timestamps = pd.read_csv(ts_path, index_col = 0)
+                    data = pd.read_csv(data_path, index_col = 0)
+                    info = pd.read_csv(info_path, index_col = 0)
 
             #create new directory called timestamped data
             ts_dir = os.path.join(subject_path, 'timestamped_data')
-            if os.path.exists(ts_dir) == False:
-                os.mkdir(ts_dir)
+            os.makedirs(ts_dir, exist_ok = True)
 
             #down sample the normalised data for ease of import into GraphPad.
-            shortened_data = pd.DataFrame(columns = ['time', 'dF_F', 'zscore'])
-
-            for i in range(0, len(data), 10):
-                lst = data[:][i:i+9]
-                lst = pd.DataFrame(lst.mean())
-                lst = lst.transpose()
-                shortened_data = pd.concat([shortened_data, lst], ignore_index = True)
-
-            #add timestamps to the shortened data
-            length = len(shortened_data['time'])
-            events = np.zeros(shape = ((length),2))
-            events = pd.DataFrame(events, columns = ['event_name', 'event_index'])
-
-            for x in range(0,len(timestamps['ts'])):
-                for y in range (0, len(shortened_data['time'])):
-                    if (round(timestamps['ts'][x],2) == round(shortened_data['time'][y],2)):
-                        events.loc[y, 'event_name'] = timestamps.loc[x,'notes']
-                        events.loc[y, 'event_index'] = timestamps.loc[x,'index']
-                        break
-
-            timestamped_data = pd.concat([shortened_data, events], axis = 1)
-
-            #create a dictionary of indices in the shortened data for each event type.
-            lookup = set()
-            names = [x for x in timestamps.notes if x not in lookup and lookup.add(x) is None]
-
-            timestamp_index = {
-                names[0]:timestamped_data.loc[timestamped_data['event_index'] == 1].index.tolist(),
-                names[1]:timestamped_data.loc[timestamped_data['event_index'] == 2].index.tolist(),
-                names[2]:timestamped_data.loc[timestamped_data['event_index'] == 3].index.tolist()
-            }
-
-            for name in names:
-                output_path = os.path.join(ts_dir, f'{name}.csv')
-                #creating data frame
-                zero_time = timestamped_data.loc[(timestamp_index[name][0]), 'time']
-                timestamp_window_init = timestamped_data.loc[(timestamped_data['time'] > zero_time - 20)]
-                timestamp_window_init = timestamp_window_init.loc[(timestamp_window_init['time'] < zero_time + 60)]
-                timestamp_window_init.loc[:,'time'] = timestamp_window_init.loc[:,'time'] - zero_time
-                timestamp_window_init.reset_index(inplace = True)
-                timestamp_window_init = timestamp_window_init.drop(columns = ['event_name','event_index','index'])
-                timestamp_window_init.columns = pd.MultiIndex.from_tuples([
-                    ('time', 'time'),
-                    (f'{name}_0', 'dF_F'),
-                    (f'{name}_0', 'zscore')
-                ])
-
-                for x in range(1,len(timestamp_index[name])):
-                    zero_time = timestamped_data.loc[(timestamp_index[name][x]), 'time']
-                    timestamp_window = timestamped_data.loc[(timestamped_data['time'] > zero_time - 20)]
-                    timestamp_window = timestamp_window.loc[(timestamp_window['time'] < zero_time + 60)]
-                    timestamp_window.loc[:,'time'] = timestamp_window.loc[:,'time'] - zero_time
-                    timestamp_window.reset_index(inplace = True)
-                    timestamp_window = timestamp_window.drop(columns = ['event_name','event_index', 'time','index'])
-                    timestamp_window.columns = pd.MultiIndex.from_tuples([
-                        (f'{name}_{x}','dF_F'),
-                        (f'{name}_{x}','zscore')
-                    ])
-                    timestamp_window_init = pd.concat([timestamp_window_init, timestamp_window], axis = 1)
-
-                timestamp_window_init.to_csv(output_path)
-
-        print(f"ID: {subject} from treatment: {treatment} exported")
-print(f"Timestamps {names} exported as csv files")
-
+            #each row is the mean of a block of consecutive samples, see peri_event.block_mean for the binning rule.
+            shortened_data, factor = peri_event.downsample(
+                data,
+                sampling_rate = info['Sampling Rate'][0],
+                factor = options['downsample_factor'],
+                target_rate = options['downsample_rate']
+                )
+
+            #align every timestamp to a sample of the shortened data, this index is reused for every event window.
+            event_index = peri_event.align_events(
+                shortened_data['time'],
+                timestamps['ts'],
+                mode = options['event_alignment'],
+                tolerance = options['event_tolerance']
+                )
+            aligned = event_index['aligned']
+            if not aligned.all():
+                unaligned_events = timestamps.loc[~aligned].copy()
+                unaligned_events['distance'] = event_index['distance'][~aligned]
+                with data_store.temporary_file(os.path.join(ts_dir, 'unaligned_events.csv')) as temporary:
+                    unaligned_events.to_csv(temporary)
+                print(f"ID: {subject} from treatment: {treatment}, {(~aligned).sum()} of {len(aligned)} events could not be aligned (see unaligned_events.csv)")
+
+            #gather the window around every aligned event into one events x samples x metrics array per event type.
+            windows = peri_event.peri_event_windows(
+                shortened_data,
+                event_index,
+                timestamps['notes'],
+                sampling_rate = info['Sampling Rate'][0]/factor,
+                pre = float(options['window_pre']),
+                post = float(options['window_post'])
+                )
+            names = list(windows)
+            peri_event.save_windows(windows, ts_dir, csv = bool(options['export_wide_csv']))
+
+            #detect the transients of the whole session and measure every trial of every event type, one row per trial and metric.
+            if options['event_metrics']:
+                found = {
+                    metric: transients.detect_transients(
+                        shortened_data[metric],
+                        shortened_data['time'],
+                        sampling_rate = info['Sampling Rate'][0]/factor,
+                        prominence = float(options['transient_prominence']),
+                        width = float(options['transient_width'])
+                        )
+                    for metric in ['dF_F', 'zscore']
+                }
+                response = None if options['response_window'] is None else float(options['response_window'])
+                for table, file_name in [(transients.event_metrics(windows, found, response), 'event_metrics.csv'),
+                                         (transients.transient_table(found), 'transients.csv')]:
+                    table.insert(0, 'subject', subject)
+                    table.insert(0, 'treatment', treatment)
+                    with data_store.temporary_file(os.path.join(ts_dir, file_name)) as temporary:
+                        table.to_csv(temporary, index = False)
+
+            #add the windows to the cross-subject event cube of the output directory, replacing any earlier run of this subject.
+            if options['event_cube']:
+                with instrument.stage('event_cube'):
+                    #other workers of a queue run may be adding their subjects at the same time
+                    try:
+                        with work_queue.exclusive(event_cube.cube_path(output_file_path)):
+                            event_cube.add_windows(event_cube.cube_path(output_file_path), treatment, subject, windows)
+                    except ValueError as error:
+                        print(f"ID: {subject} from treatment: {treatment} was not added to the event cube: {error}")
+
+        #the time, memory and samples of each step are saved next to info.csv when instrument is set in the options
+        if instrument.ENABLED:
+            instrument.write_manifest(os.path.join(subject_path, 'analysis_manifest'), instrument.select(treatment = treatment, id = subject))
+            instrument.release(treatment = treatment, id = subject)
+
+    print(f"ID: {subject} from treatment: {treatment} exported")
+    return names
+
+
+## This function lists the subjects of the settings file, the settings column of each setup comes from the channel map
+def settings_subjects(settings, channel_map):
+    subjects = []
+    for channels in channel_map.values():
+        if channels['column'] in settings.columns:
+            subjects.extend(x for x in set(settings[channels['column']]) if x == x)
+    return list(dict.fromkeys(str(i) for i in subjects))
+
+
+## This function returns what the exported data of a subject was computed from, so a queue job runs again after it is exported again
+def subject_key(subject_path):
+    #the key of the data store, or the modification time of the csv export of older runs
+    data_dir = os.path.join(subject_path, 'data')
+    if data_store.has_store(data_dir):
+        return data_store.read_header(data_dir).get('key')
+    data_path = os.path.join(data_dir, 'normalised_data.csv')
+    return os.path.getmtime(data_path) if os.path.exists(data_path) else None
+
+
+## This function runs the analysis as a work queue in the output directory, one job per treatment and subject
+def queue_analysis(output_file_path, options, settings_path, treatments, subjects):
+    #Every process running it takes jobs until every job is done, see work_queue.py. Returns the event type names.
+    jobs = {f'{treatment}_{subject}': (treatment, subject) for treatment in treatments for subject in subjects}
+    keys = {name: work_queue.value_key([subject_key(os.path.join(output_file_path, treatment, subject)), options])
+            for name, (treatment, subject) in jobs.items()}
+    def run(name):
+        try:
+            return {'names': analyse_subject(output_file_path, options, *jobs[name]), 'error': ''}
+        except Exception:
+            print(traceback.format_exc())
+            return {'names': None, 'error': traceback.format_exc()}
+    results = work_queue.drain(work_queue.queue_path(output_file_path, 'analysis', settings_path), list(jobs), run,
+                               lease_timeout = float(options['lease_timeout']), heartbeat_interval = float(options['heartbeat_interval']),
+                               keys = keys)
+    for name, result in results.items():
+        if result['error']:
+            print(f"{name} failed:\n{result['error']}")
+    return next((result['names'] for result in results.values() if result['names']), [])
+
+
+if __name__ == '__main__':
+    #The output directory holding the settings file is passed as python data_analysis.py <output directory>, or pasted
+    #in when asked. python data_analysis.py --queue shares the subjects with every other process running it with
+    #--queue on the same output directory (see work_queue.py).
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    if arguments:
+        output_file_path = arguments[0]
+    else:
+        print('Please input path to settings file: ')
+        output_file_path = input()
+    settings_path = os.path.join(output_file_path,'settings.xlsx')
+    settings = pd.read_excel(settings_path)
+    options = run_options.read_options(settings_path)
+    if options['instrument']:
+        instrument.enable()
+
+    channel_map = import_tank_v2.read_channel_map(settings_path)
+
+    #loop through settings file to extract directories for treatment and subjects
+    treatments = list(set(settings['treatment_name']))
+    subjects = settings_subjects(settings, channel_map)
+
+    print(f"Exporting timestamps \nSubjects: {subjects} \nTreatments: {treatments}")
+
+    if '--queue' in sys.argv[1:]:
+        names = queue_analysis(output_file_path, options, settings_path, treatments, subjects)
+    else:
+        names = []
+        for treatment in treatments:
+            for subject in subjects:
+                exported = analyse_subject(output_file_path, options, treatment, subject)
+                names = names if exported is None else exported
+    print(f"Timestamps {names} exported")
@@ -1,180 +1,869 @@
 import import_tank_v2
 import preprocessing_v2
+import data_store
+import stage_cache
+import work_queue
+import pyramid
+import instrument
+import options as run_options
 import pandas as pd
 import os
 import csv
-import matplotlib.pyplot as plt
-import matplotlib.figure as fig
+import figures
+import matplotlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import threading
+import queue
+import traceback
+import json
+import glob
+import sys
 from tqdm import tqdm
 import numpy as np
 
-#Change this path to the folder you want the outputs to be saved and put the settings excel file into this folder.
-print("Please paste in the path to the output directory")
-output_file_path = input()
-settings_path = (f'{output_file_path}/settings.xlsx')
-settings = pd.read_excel(settings_path)
-
-for i in range(0,len(settings)):
-    treatment = str(settings['treatment_name'][i])
-
-    #creating treatment directory in output directory
+#Figure rendering pool of this process, see figure_pool.
+FIGURE_POOL = None
+
+## This function finds the exponential fit parameters of the latest other session of the same mouse in the output directory
+def previous_fit_params(setup_path):
+    #Sessions of a mouse live in <output>/<treatment>/<mouse ID>, so the other sessions are the same ID under the other treatments.
+    setup_path = os.path.abspath(setup_path)
+    mouse_id = os.path.basename(setup_path)
+    output_path = os.path.dirname(os.path.dirname(setup_path))
+    reports = [path for path in glob.glob(os.path.join(output_path, '*', mouse_id, 'exp_fit.json'))
+               if os.path.dirname(os.path.abspath(path)) != setup_path]
+    if len(reports) == 0:
+        return None
+    with open(max(reports, key = os.path.getmtime)) as f:
+        report = json.load(f)
+    return {'signal': report['signal']['params'], 'ISOS': report['ISOS']['params']}
+
+
+## This function returns the mouse ID of a setup in a settings row, 'nan' when the setup is not in use
+def setup_id(row, setup, channel_map):
+    #the settings column of each setup comes from the channel map, see import_tank_v2.read_channel_map
+    column = channel_map[setup]['column']
+    return str(row[column]) if column in row else 'nan'
+
+
+## This function returns the thread pool that renders figures in the background, created on first use in each process
+def figure_pool(options):
+    #figure_workers = 0 renders the figures before moving on to the next stage of the batch
+    global FIGURE_POOL
+    if int(options['figure_workers']) <= 0:
+        return None
+    if FIGURE_POOL is None:
+        FIGURE_POOL = ThreadPoolExecutor(max_workers = int(options['figure_workers']))
+    return FIGURE_POOL
+
+
+#Preprocessing stages in the order they are computed, each one is computed from the stage before it.
+PIPELINE = ['raw_data', 'filtered_data', 'detrended_data', 'motion_corrected_data', 'normalised_data']
+
+## This function lists the stages that are exported or drawn in a requested figure, these are never overwritten in place
+def kept_stages(options):
+    #the normalised data is always exported as data_analysis.py reads it
+    figure_names = run_options.option_list(options['figures'])
+    export_stages = set(run_options.option_list(options['export_stages'])) | {'normalised_data'}
+    return export_stages.union(*[figures.FIGURE_STAGES[name] for name in figure_names if name in figures.FIGURE_STAGES])
+
+
+## This function returns the stage cache directory, or None when the cache is turned off (cache_size = 0)
+def session_cache(output_file_path, options):
+    if options['cache_size'] is None or float(options['cache_size']) <= 0:
+        return None
+    return stage_cache.cache_path(output_file_path)
+
+
+## This function collects the parameters every preprocessing stage of one setup is computed with
+def stage_params(row, setup, setup_path, options, channel_map):
+    params = {
+        'raw_data': {
+            'tank': stage_cache.tank_fingerprint(row['path']),
+            'offset': int(row['offset']),
+            'end': session_end(row),
+            'setup': setup,
+            'channels': channel_map[setup],
+            'sample_accurate_time': bool(options['sample_accurate_time']),
+            'id': setup_id(row, setup, channel_map),
+            'region': str(row['region']),
+            'sensor': str(row['sensor'])
+        }
+    }
+    params.update(preprocessing_params(options, previous_fit_params(setup_path) if options['reuse_fit_params'] else None))
+    return params
+
+
+## This function collects the parameters of the stages after raw_data from the options, initial_params warm-starts the fits
+def preprocessing_params(options, initial_params = None):
+    return {
+        'filtered_data': {
+            'dtype': np.dtype(options['dtype']).name,
+            'decimate_rate': None if options['decimate_rate'] is None else float(options['decimate_rate'])
+        },
+        'detrended_data': {
+            'fit_rate': None if options['fit_rate'] is None else float(options['fit_rate']),
+            'reuse_fit_params': bool(options['reuse_fit_params']),
+            'initial_params': initial_params,
+            'baseline': str(options['baseline']),
+            'baseline_window': float(options['baseline_window']),
+            'baseline_percentile': float(options['baseline_percentile'])
+        },
+        'motion_corrected_data': {
+            'window': None if options['motion_window'] is None else float(options['motion_window'])
+        },
+        'normalised_data': {
+            'window': None if options['zscore_window'] is None else float(options['zscore_window'])
+        }
+    }
+
+
+#Stage parameters that only steer the computation towards the same result, left out of the cache keys.
+#The warm start of the fits comes from whichever other session of the mouse was written last, so keying on it
+#would change the keys on every run and with the order the sessions finish in.
+HINT_PARAMS = {'initial_params'}
+
+## This function returns the cache key of every stage, each key also covers the parameters of the stages before it
+def stage_keys(params):
+    keys = {}
+    parent = None
+    for stage in PIPELINE:
+        keyed = {name: value for name, value in params[stage].items() if name not in HINT_PARAMS}
+        parent = keys[stage] = stage_cache.stage_key(parent, stage, keyed)
+    return keys
+
+
+## This function plans which stages of a setup are loaded from the cache and which are computed
+def cache_plan(keys, options, cache, touch = False):
+    #Returns the position in PIPELINE of the last stage taken from the cache (-1 reads the tank and computes every stage)
+    #and the stages whose data has to be loaded. Only the exported stages, the stages drawn in figures and the input
+    #of the first computed stage are loaded, the rest of the cached stages are skipped over.
+    if cache is None:
+        return -1, set()
+    figure_names = run_options.option_list(options['figures'])
+    last = len(PIPELINE) - 1
+
+    def loads(start):
+        needed = {PIPELINE[start]} if start < last else set()
+        needed |= {stage for stage in kept_stages(options) if PIPELINE.index(stage) <= start}
+        #the exponential fit is saved with the detrended data, normalisation and the exp_fit figure draw on it
+        if PIPELINE.index('detrended_data') <= start and (start < last or 'exp_fit' in figure_names):
+            needed.add('detrended_data')
+        return needed
+
+    cached = [i for i, stage in enumerate(PIPELINE) if stage_cache.has_entry(cache, keys[stage], touch = touch)]
+    start = max(cached, default = -1)
+    while start >= 0:
+        missing = [PIPELINE.index(stage) for stage in loads(start) if PIPELINE.index(stage) not in cached]
+        if len(missing) == 0:
+            return start, loads(start)
+        #an evicted stage is needed, so the computation starts again from a cached stage before it
+        start = max([i for i in cached if i < min(missing)], default = -1)
+    return -1, set()
+
+
+## This function checks whether a setup has already been exported from the same stages with the current options
+def setup_complete(setup_path, key, options):
+    data_path = os.path.join(setup_path, 'data')
+    if not data_store.has_store(data_path) or data_store.read_header(data_path).get('key') != key:
+        return False
+    header = data_store.read_header(data_path)
+    export_stages = set(run_options.option_list(options['export_stages'])) | {'normalised_data'}
+    outputs = [os.path.join(setup_path, 'info.csv'), os.path.join(setup_path, 'exp_fit.json')]
+    outputs.extend(os.path.join(setup_path, 'figures', figures.FIGURE_FILES[name])
+                   for name in run_options.option_list(options['figures']) if name in figures.FIGURE_FILES)
+    if options['pyramid']:
+        outputs.append(os.path.join(data_path, pyramid.PYRAMID_DIR, pyramid.PYRAMID_HEADER))
+    if options['export_csv']:
+        outputs.append(os.path.join(setup_path, 'timestamps.csv'))
+        outputs.extend(os.path.join(data_path, f'{stage}.csv') for stage in export_stages)
+    return export_stages.issubset(header['stages']) and all(os.path.exists(path) for path in outputs)
+
+
+## This function computes one preprocessing stage from the stages before it and returns the sampling rate of the stage
+def compute_stage(stage, stages, sampling_rate, params, keep_stages):
+    #The stages hold one setup or several setups stacked along the first axis (see import_tank_v2.stack_outputs).
+    #Stages that are not kept are overwritten in place by the stage after them.
+    if stage == 'filtered_data':
+        stages['filtered_data'] = preprocessing_v2.zero_phase_filter(stages['raw_data'], sampling_rate, dtype = np.dtype(params['dtype']))
+        if params['decimate_rate'] is not None:
+            #every stage after the filter runs at the decimated rate, which is the rate recorded in info.csv
+            stages['filtered_data'], sampling_rate = preprocessing_v2.decimate(stages['filtered_data'], sampling_rate, params['decimate_rate'])
+    elif stage == 'detrended_data':
+        stages['detrended_data'], stages['exponential_fit'] = preprocessing_v2.photo_bleach_correction(stages['filtered_data'],
+                                                                                                       fit_rate = params['fit_rate'],
+                                                                                                       initial_params = params['initial_params'],
+                                                                                                       baseline = params['baseline'],
+                                                                                                       baseline_window = params['baseline_window'],
+                                                                                                       baseline_percentile = params['baseline_percentile'],
+                                                                                                       inplace = 'filtered_data' not in keep_stages)
+    elif stage == 'motion_corrected_data':
+        stages['motion_corrected_data'], stages['motion_fit'] = preprocessing_v2.motion_correction(stages['detrended_data'],
+                                                                                                   window = params['window'],
+                                                                                                   inplace = 'detrended_data' not in keep_stages)
+    elif stage == 'normalised_data':
+        stages['normalised_data'] = preprocessing_v2.normalisation(stages['motion_corrected_data'], stages['exponential_fit'],
+                                                                   window = params['window'],
+                                                                   inplace = 'motion_corrected_data' not in keep_stages)
+    return sampling_rate
+
+
+## This function records the sampling rate of a stage in the info of a setup, keeping the tank rate as 'Raw Sampling Rate'
+def stage_info(INFO, sampling_rate):
+    if sampling_rate == INFO['Sampling Rate']:
+        return INFO
+    return dict(INFO, **{'Sampling Rate': sampling_rate, 'Raw Sampling Rate': INFO['Sampling Rate']})
+
+
+## This function returns the data of one setup from stages computed on stacked setups
+def select_channel(value, channel):
+    #2-D arrays and lists (fit reports, motion fits) hold one entry per setup, the 1-D time bases are shared by every setup
+    if isinstance(value, dict):
+        return {key: select_channel(item, channel) for key, item in value.items()}
+    if isinstance(value, list):
+        return value[channel]
+    if isinstance(value, np.ndarray) and value.ndim == 2:
+        return value[channel]
+    return value
+
+
+## This function saves one stage of a setup to the cache, with the fits computed alongside it
+def cache_stage(cache, key, stage, stages, INFO, TIMESTAMPS):
+    arrays = {stage: stages[stage]}
+    metadata = {'info': INFO}
+    if stage == 'detrended_data':
+        arrays['exponential_fit'] = {column: stages['exponential_fit'][column] for column in ('signal_expfit', 'ISOS_expfit', 'signal_baseline')
+                                     if column in stages['exponential_fit']}
+        metadata['fit_report'] = stages['exponential_fit']['fit_report']
+    if stage == 'motion_corrected_data':
+        metadata['motion_fit'] = stages['motion_fit']
+    stage_cache.save_entry(cache, key, arrays, metadata, TIMESTAMPS)
+
+
+## This function loads one stage of a setup from the cache into stages and returns the info and timestamps saved with it
+def load_stage(cache, key, stages):
+    arrays, metadata, TIMESTAMPS = stage_cache.load_entry(cache, key)
+    stages.update(arrays)
+    if 'fit_report' in metadata:
+        stages['exponential_fit']['fit_report'] = metadata['fit_report']
+    if 'motion_fit' in metadata:
+        stages['motion_fit'] = metadata['motion_fit']
+    return metadata['info'], TIMESTAMPS
+
+
+## This function runs the preprocessing for one setup and saves its info and data to setup_path
+def export_setup(setup_path, params, keys, options, cache = None, raw = None, writer = None):
+    #Stages found in the cache are loaded instead of computed, raw is (INFO, OUTPUTS, TIMESTAMPS, SAMPLING_RATE) read from
+    #the tank and is only needed when the raw data is not in the cache. Every computed stage is saved to the cache.
+    #Returns the future of the writes, see write_setup.
+    keep_stages = kept_stages(options)
+
+    start, loads = cache_plan(keys, options, cache, touch = True)
+    stages = {}
+    if start < 0:
+        if raw is None:
+            raise ValueError(f'The raw data of {setup_path} is neither read from the tank nor in the cache')
+        INFO, stages['raw_data'], TIMESTAMPS, _ = raw
+
+    #Runs the preprocessing functions from the last cached stage on
+    for position, stage in enumerate(PIPELINE):
+        if position <= start:
+            if stage in loads:
+                with instrument.stage(f'load_{stage}'):
+                    INFO, TIMESTAMPS = load_stage(cache, keys[stage], stages)
+            continue
+        if stage != 'raw_data':
+            with instrument.stage(stage, samples = instrument.count_samples(stages[PIPELINE[position - 1]])):
+                sampling_rate = compute_stage(stage, stages, INFO['Sampling Rate'], params[stage], keep_stages)
+            INFO = stage_info(INFO, sampling_rate)
+        if cache is not None:
+            with instrument.stage(f'cache_{stage}'):
+                cache_stage(cache, keys[stage], stage, stages, INFO, TIMESTAMPS)
+
+    if 'exponential_fit' in stages:
+        fit_report = stages['exponential_fit']['fit_report']
+    else:
+        fit_report = stage_cache.load_metadata(cache, keys['detrended_data'])['fit_report']
+    return write_setup(writer, setup_path, stages, INFO, TIMESTAMPS, fit_report, keys, options)
+
+
+## This function runs the preprocessing for several setups of one tank at once and saves each one to its setup_path
+def export_channels(plans, sessions, options, cache = None, writer = None):
+    #plans is a list of (setup, setup_path, params, keys) of setups read from the tank at the same sampling rate, and
+    #sessions holds what open_tank returned for them. Their streams are stacked into (setups x samples) arrays so each
+    #stage runs once for all of them, then each setup's part of every stage is cached and exported as in export_setup.
+    #Returns a dictionary of setup -> future of its writes, see write_setup.
+    keep_stages = kept_stages(options)
+    INFOS = [sessions[setup][0] for setup, _, _, _ in plans]
+    TIMESTAMPS = [sessions[setup][2] for setup, _, _, _ in plans]
+    sampling_rate = sessions[plans[0][0]][3]
+    stages = {'raw_data': import_tank_v2.stack_outputs([sessions[setup][1] for setup, _, _, _ in plans])}
+
+    #the stage parameters are the same for every setup apart from the warm start of the fits of each mouse
+    params = dict(plans[0][2])
+    params['detrended_data'] = dict(params['detrended_data'], initial_params = [plan[2]['detrended_data']['initial_params'] for plan in plans])
+
+    for position, stage in enumerate(PIPELINE):
+        if stage != 'raw_data':
+            with instrument.stage(stage, samples = instrument.count_samples(stages[PIPELINE[position - 1]]), setups = len(plans)):
+                sampling_rate = compute_stage(stage, stages, sampling_rate, params[stage], keep_stages)
+            INFOS = [stage_info(INFO, sampling_rate) for INFO in INFOS]
+        if cache is not None:
+            for channel, (setup, _, _, keys) in enumerate(plans):
+                with instrument.context(setup = setup, id = INFOS[channel]['Mouse ID']), instrument.stage(f'cache_{stage}'):
+                    cache_stage(cache, keys[stage], stage, select_channel(stages, channel), INFOS[channel], TIMESTAMPS[channel])
+
+    futures = {}
+    for channel, (setup, setup_path, _, keys) in enumerate(plans):
+        channel_stages = select_channel(stages, channel)
+        with instrument.context(setup = setup, id = INFOS[channel]['Mouse ID']):
+            futures[setup] = write_setup(writer, setup_path, channel_stages, INFOS[channel], TIMESTAMPS[channel],
+                                         channel_stages['exponential_fit']['fit_report'], keys, options)
+    return futures
+
+
+#Errors the data of one setup can raise in the stacked preprocessing (e.g. a fit that does not converge), after which
+#the setups of the group are run one at a time so the error is recorded against its own setup.
+STACKED_ERRORS = (ValueError, RuntimeError, FloatingPointError)
+
+## This function checks that the streams of the setups of a tank can be stacked, and returns why not otherwise
+def stack_mismatch(outputs):
+    #only streams of the same length are stacked (see import_tank_v2.stack_outputs), compute_session groups them by length
+    for stream in ('signal', 'ISOS'):
+        lengths = [len(output[stream]) for output in outputs]
+        if max(lengths) != min(lengths):
+            return f'their {stream} streams have {min(lengths)} to {max(lengths)} samples'
+        starts = [float(np.asarray(output[f'{stream}_ts'][:1])[0]) for output in outputs if len(output[f'{stream}_ts'])]
+        if starts and max(starts) - min(starts) > 1e-9:
+            return f'their {stream} streams start at different times'
+    return None
+
+
+## This function writes the outputs of a setup in the writer pool, or here when there is no pool
+def write_setup(writer, *args):
+    #args are passed to write_outputs. Returns a future of the futures of the figures being rendered, errors in the
+    #pool are raised by its result, and errors here are raised straight away.
+    if writer is not None:
+        return writer.submit(instrument.bind(write_outputs), *args)
+    future = Future()
+    future.set_result(write_outputs(*args))
+    return future
+
+
+## This function saves the info, fit report, exported stages and figures of one setup to setup_path
+def write_outputs(setup_path, stages, INFO, TIMESTAMPS, fit_report, keys, options):
+    #Returns the futures of the figures being rendered in the figure pool (empty when they were rendered here).
+    os.makedirs(setup_path, exist_ok = True)
+    figure_names = run_options.option_list(options['figures'])
+    export_stages = set(run_options.option_list(options['export_stages'])) | {'normalised_data'}
+
+    #every file is written to a temporary name and renamed into place, as a reclaimed queue job may write it twice at once
+    with data_store.temporary_file(os.path.join(setup_path, 'info.csv')) as temporary:
+        pd.DataFrame(INFO, index = [0]).to_csv(temporary)
+    with data_store.temporary_file(os.path.join(setup_path, 'exp_fit.json')) as temporary, open(temporary, 'w') as f:
+        json.dump(fit_report, f, indent = 1)
+
+    #saves the exported stages to the binary store, csv files are only written when export_csv is set in the options.
+    #The store records the key of its last stage, so a re-run with the same tank and options skips this setup.
+    data_path = os.path.join(setup_path, 'data')
+    with instrument.stage('write_store'):
+        data_store.write_store(data_path,
+                               stages = {stage: stages[stage] for stage in PIPELINE if stage in export_stages},
+                               info = INFO,
+                               timestamps = TIMESTAMPS,
+                               key = keys['normalised_data'])
+    #the min/max/mean pyramid of every saved trace, for browsing the session at any zoom (see pyramid.py)
+    if options['pyramid']:
+        pyramid.build_pyramid(data_path)
+    if options['export_csv']:
+        with instrument.stage('export_csv'):
+            data_store.export_csv(data_path, timestamps_path = os.path.join(setup_path, 'timestamps.csv'))
+
+    #makes a directory for the figures and renders the requested ones
+    figure_path = os.path.join(setup_path, 'figures')
+    os.makedirs(figure_path, exist_ok = True)
+    return figures.render_figures(figure_path, figure_names, stages, TIMESTAMPS, executor = figure_pool(options))
+
+
+## This function waits for the figures of a setup and records a failure in its result
+def wait_for_figures(result, futures):
+    for future in futures:
+        try:
+            future.result()
+        except Exception:
+            result['status'] = 'failed'
+            result['error'] += ''.join(traceback.format_exception(future.exception()))
+    return result
+
+
+## This function reads the optional end time (seconds) of a settings row, 0 reads to the end of the recording
+def session_end(row):
+    if 'end' not in row or pd.isna(row['end']):
+        return 0
+    return float(row['end'])
+
+
+## This function writes the instrumentation records of one setup to manifest.json and manifest.csv next to its info.csv
+def write_setup_manifest(output_file_path, result):
+    #The records of the tank read are shared by both setups of the tank, so they are in both manifests.
+    setup_path = os.path.join(output_file_path, result['treatment'], result['id'])
+    if not instrument.ENABLED or result['status'] == 'skipped' or not os.path.isdir(setup_path):
+        return
+    records = instrument.select(row = result['row'], treatment = result['treatment'], setup = result['setup'])
+    instrument.write_manifest(os.path.join(setup_path, 'manifest'), records)
+
+
+## This function writes the manifest of every setup of a session, then drops the session's records from memory
+def write_session_manifests(output_file_path, row_number, row, results):
+    for result in results:
+        write_setup_manifest(output_file_path, result)
+    instrument.release(row = row_number, treatment = str(row['treatment_name']))
+
+
+## This function opens the tank of one settings row and exports the requested setups (e.g. 'A' and/or 'B')
+def extract_session(row_number, row, setups, output_file_path, options, wait = True, channel_map = None):
+    #Runs run_session with the instrumentation asked for in the options: with instrument set every stage is recorded
+    #to the manifest of its setup, and the session holding the profile_session setup ('<treatment>/<mouse ID>')
+    #is run under cProfile, with the profile saved to profile.prof in that setup's directory.
+    #The manifests are written here when wait is True, and by the caller once the writes and figures are done otherwise.
+    if options['instrument']:
+        instrument.enable()
+    channel_map = import_tank_v2.CHANNEL_MAP if channel_map is None else channel_map
+    profile_path = session_profile(row, setups, output_file_path, options, channel_map)
+
+    with instrument.profile(profile_path, enabled = profile_path is not None), \
+            instrument.context(row = row_number, treatment = str(row['treatment_name'])):
+        results = run_session(row_number, row, setups, output_file_path, options, wait = wait, channel_map = channel_map)
+    if wait:
+        write_session_manifests(output_file_path, row_number, row, results)
+    return results
+
+
+## This function returns where the profile of a session is saved, None when the session is not profiled
+def session_profile(row, setups, output_file_path, options, channel_map):
+    #The session holding the profile_session setup ('<treatment>/<mouse ID>') is profiled, into profile.prof in that
+    #setup's directory.
+    treatment = str(row['treatment_name'])
+    profiled = [setup_id(row, setup, channel_map) for setup in setups
+                if f'{treatment}/{setup_id(row, setup, channel_map)}' == str(options['profile_session'])]
+    return os.path.join(output_file_path, treatment, profiled[0], 'profile.prof') if profiled else None
+
+
+## This function opens the tank of one settings row and exports the requested setups, see extract_session
+def run_session(row_number, row, setups, output_file_path, options, wait = True, channel_map = None, writer = None):
+    #Returns one result per setup, a failing setup does not stop the other setups of the same tank.
+    #With a writer pool the outputs are written there, and with wait = False the writes and figures may still be
+    #running, wait_for_outputs then finishes the result of each setup.
+    channel_map = import_tank_v2.CHANNEL_MAP if channel_map is None else channel_map
+    session = plan_session(row_number, row, setups, output_file_path, options, channel_map)
+    load_session(session, options, channel_map)
+    compute_session(session, options, writer = writer)
+    if wait:
+        for result in session['results']:
+            wait_for_outputs(result)
+    return session['results']
+
+
+## This function plans the export of the requested setups of one settings row
+def plan_session(row_number, row, setups, output_file_path, options, channel_map):
+    #Setups already exported with the same keys are skipped, and the tank is only read for the setups
+    #whose raw data is needed and not in the stage cache.
+    #Returns the session: one result per setup, the plan (setup_path, params, keys) of every setup to export and the
+    #setups to read from the tank.
+    treatment = str(row['treatment_name'])
+    IDS = {setup: setup_id(row, setup, channel_map) for setup in setups}
+    cache = session_cache(output_file_path, options)
+
+    #creating treatment directory in output directory, other workers may be creating it at the same time
     treatment_path = os.path.join(output_file_path, treatment)
-    if os.path.exists(treatment_path) == False:
-        os.mkdir(treatment_path)
-
-    (ID_A, ID_B, INFO_A, INFO_B,
-    OUTPUTS_A, OUTPUTS_B,
-    TIMESTAMPS_A, TIMESTAMPS_B,
-    SAMPLING_RATE_A, SAMPLING_RATE_B, RAW_FIGURE_A, RAW_FIGURE_B) = import_tank_v2.open_tank(
-        PATH = settings['path'][i], 
-        OFFSET = int(settings['offset'][i]),
-        ID_A = str(settings['setup_a'][i]),
-        ID_B = str(settings['setup_b'][i]),
-        REGION = str(settings['region'][i]),
-        SENSOR = str(settings['sensor'][i])
-        )
-    
-    #creating output for setup A.
-    if ID_A != 'nan':
-        setup_A_path = os.path.join(treatment_path, ID_A)
-        if os.path.exists(setup_A_path) == False:
-            os.mkdir(setup_A_path)
-        INFO_A = pd.DataFrame(INFO_A, index = [0])
-        path = os.path.join(setup_A_path, 'info.csv')
-        INFO_A.to_csv(path)
+    os.makedirs(treatment_path, exist_ok = True)
+
+    results = []
+    plans = {}
+    for setup in setups:
+        result = {'row': row_number, 'treatment': treatment, 'setup': setup, 'id': IDS[setup], 'status': 'success', 'error': ''}
+        results.append(result)
+        try:
+            setup_path = os.path.join(treatment_path, IDS[setup])
+            params = stage_params(row, setup, setup_path, options, channel_map)
+            keys = stage_keys(params)
+            if setup_complete(setup_path, keys['normalised_data'], options):
+                result['status'] = 'skipped'
+            else:
+                plans[setup] = (setup_path, params, keys)
+        except Exception:
+            result['status'] = 'failed'
+            result['error'] = traceback.format_exc()
+
+    tank_setups = [setup for setup, (_, _, keys) in plans.items() if cache_plan(keys, options, cache)[0] < 0]
+    return {'row': row, 'IDS': IDS, 'cache': cache, 'results': results, 'plans': plans, 'tank_setups': tank_setups, 'sessions': {}}
+
+
+## This function reads the tank of a planned session, a failed read is recorded against the setups that needed it
+def load_session(session, options, channel_map):
+    row, tank_setups = session['row'], session['tank_setups']
+    if len(tank_setups) == 0:
+        return session
+    try:
+        session['sessions'] = import_tank_v2.open_tank(
+            PATH = row['path'],
+            OFFSET = int(row['offset']),
+            IDS = {setup: session['IDS'][setup] for setup in tank_setups},
+            REGION = str(row['region']),
+            SENSOR = str(row['sensor']),
+            END = session_end(row),
+            channel_map = channel_map,
+            sample_accurate = bool(options['sample_accurate_time']),
+            reader = str(options['tank_reader'])
+            )
+    except Exception:
+        for result in session['results']:
+            if result['setup'] in tank_setups:
+                result['status'] = 'failed'
+                result['error'] = traceback.format_exc()
+                session['plans'].pop(result['setup'])
+    return session
+
+
+## This function preprocesses the setups of a loaded session and starts writing their outputs
+def compute_session(session, options, writer = None):
+    #The setups read from the tank are preprocessed together as stacked arrays, if that fails they are run one at a time
+    #so the failure is recorded against its own setup. The 'outputs' entry of each exported result is a future of its
+    #writes (see write_setup), and the tank data is released from the session once every setup is computed.
+    plans, sessions, cache = session['plans'], session['sessions'], session['cache']
+
+    #setups read from the tank at the same sampling rate and with streams of the same length are stacked and
+    #preprocessed together. Streams are never cut to stack them, so a setup gives the same stages and the same cache
+    #entries whether it is preprocessed stacked or on its own (workers > 1, or after a stacked failure).
+    groups = {}
+    for setup in session['tank_setups']:
+        if setup in plans:
+            OUTPUTS = sessions[setup][1]
+            groups.setdefault((sessions[setup][3], len(OUTPUTS['signal']), len(OUTPUTS['ISOS'])), []).append(setup)
+    outputs = {}
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        mismatch = stack_mismatch([sessions[setup][1] for setup in group])
+        if mismatch is not None:
+            print(f"Row {session['results'][0]['row']}: setups {group} are preprocessed one at a time, {mismatch}")
+            continue
+        try:
+            outputs.update(export_channels([(setup,) + plans[setup] for setup in group], sessions, options, cache = cache, writer = writer))
+        except STACKED_ERRORS:
+            #the failing setup is found by running them one at a time, any other error is a bug and fails the session
+            print(f"Row {session['results'][0]['row']}: the stacked preprocessing of setups {group} failed, running them one at a time:\n{traceback.format_exc()}")
+
+    for result in session['results']:
+        if result['setup'] not in plans:
+            continue
+        setup_path, params, keys = plans[result['setup']]
+        try:
+            if result['setup'] in outputs:
+                result['outputs'] = outputs[result['setup']]
+            else:
+                with instrument.context(setup = result['setup'], id = result['id']):
+                    result['outputs'] = export_setup(setup_path, params, keys, options, cache = cache,
+                                                     raw = sessions.get(result['setup']), writer = writer)
+        except Exception:
+            result['status'] = 'failed'
+            result['error'] = traceback.format_exc()
+    session['sessions'] = {}
+    return session
+
+
+## This function waits for the writes and figures of a setup and records a failure in its result
+def wait_for_outputs(result):
+    outputs = result.pop('outputs', None)
+    if outputs is None:
+        return result
+    try:
+        figure_futures = outputs.result()
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] += ''.join(traceback.format_exception(error))
+        return result
+    return wait_for_figures(result, figure_futures)
+
+
+## This function runs the sessions of the batch one after another, overlapping the reads, preprocessing and writes of different sessions
+def pipeline_batch(jobs, rows, output_file_path, options, channel_map, evict = None):
+    #A prefetch thread plans the next sessions and reads their tanks while this thread preprocesses the current one,
+    #and the outputs are saved by a pool of writer_workers threads while the following session is computed.
+    #At most sessions_in_flight sessions are held at once, from the start of their read to the end of their writes,
+    #so memory stays bounded however far the reads run ahead. A session that fails at any step is recorded against its
+    #own setups and the batch carries on. evict is called after every session is computed.
+    #Returns one result per setup, in the order of the jobs.
+    in_flight = max(1, int(options['sessions_in_flight']))
+    slots = threading.Semaphore(in_flight)
+    loaded = queue.Queue(maxsize = in_flight)
+    stop = threading.Event()
+
+    def prefetch():
+        for i, setups in jobs:
+            slots.acquire()
+            if stop.is_set():
+                break
+            with instrument.context(row = i, treatment = str(rows[i]['treatment_name'])):
+                try:
+                    with instrument.stage('load_session'):
+                        session = plan_session(i, rows[i], setups, output_file_path, options, channel_map)
+                        load_session(session, options, channel_map)
+                except Exception:
+                    session = {'results': failed_results(i, rows[i], setups, channel_map)}
+            loaded.put((i, setups, session))
+        loaded.put(None)
+
+    def release(session):
+        #the slot of a session is freed once every one of its writes is done
+        futures = [result['outputs'] for result in session['results'] if 'outputs' in result]
+        remaining = [len(futures)]
+        lock = threading.Lock()
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    slots.release()
+        if not futures:
+            slots.release()
+        for future in futures:
+            future.add_done_callback(done)
+
+    def finish(i, session_results):
+        #waits for the figures of a session and writes its manifests
+        for result in session_results:
+            wait_for_outputs(result)
+        write_session_manifests(output_file_path, i, rows[i], session_results)
+
+    finishing = []
+    reader = threading.Thread(target = prefetch, name = 'prefetch', daemon = True)
+    writer = ThreadPoolExecutor(max_workers = max(1, int(options['writer_workers'])), thread_name_prefix = 'writer')
+    results = []
+    reader.start()
+    try:
+        with tqdm(total = len(jobs)) as progress:
+            for i, setups, session in iter(loaded.get, None):
+                if 'plans' in session:
+                    profile_path = session_profile(rows[i], setups, output_file_path, options, channel_map)
+                    with instrument.profile(profile_path, enabled = profile_path is not None), \
+                            instrument.context(row = i, treatment = str(rows[i]['treatment_name'])):
+                        try:
+                            compute_session(session, options, writer = writer)
+                        except Exception:
+                            session['results'] = failed_results(i, rows[i], setups, channel_map)
+                release(session)
+                results.extend(session['results'])
+                finishing.append((i, session['results']))
+                #sessions whose writes are done are finished here, so their records are not held to the end of the batch
+                while finishing and all(result['outputs'].done() for result in finishing[0][1] if 'outputs' in result):
+                    finish(*finishing.pop(0))
+                if evict is not None:
+                    evict()
+                progress.update(1)
+    finally:
+        #let a prefetch thread waiting for a slot finish, and wait for the writes that are still running
+        stop.set()
+        slots.release()
+        writer.shutdown(wait = True)
+
+    for i, session_results in finishing:
+        finish(i, session_results)
+    return results
+
+
+## This function returns a failed result for every setup of a job, with the error being handled
+def failed_results(row_number, row, setups, channel_map):
+    return [{'row': row_number, 'treatment': str(row['treatment_name']), 'setup': setup, 'id': setup_id(row, setup, channel_map),
+             'status': 'failed', 'error': traceback.format_exc()} for setup in setups]
+
+
+## This function is run once in every worker process before it takes any sessions
+def init_worker():
+    #workers never show figures, so they use the non-interactive backend
+    matplotlib.use('Agg')
+    global FIGURE_POOL
+    FIGURE_POOL = None
+
+
+## This function lists the jobs of the batch, one per settings row or one per setup when the setups are fanned out
+def batch_jobs(settings, fan_out, channel_map = None):
+    #setups whose column is not in the settings file are left out
+    channel_map = import_tank_v2.CHANNEL_MAP if channel_map is None else channel_map
+    jobs = []
+    for i in range(0, len(settings)):
+        row = settings.iloc[i]
+        setups = [setup for setup in channel_map if setup_id(row, setup, channel_map) != 'nan']
+        for setup in channel_map:
+            if setup not in setups and channel_map[setup]['column'] in settings.columns:
+                print(f'Row {i}: Setup {setup} is empty.')
+        if fan_out:
+            jobs.extend((i, [setup]) for setup in setups)
+        elif setups:
+            jobs.append((i, setups))
+    return jobs
+
+
+## This function runs every row of the settings file and returns a summary of the successes and failures
+def run_batch(settings, output_file_path, options, channel_map = None):
+    #With more than one worker the setups of each tank are processed in separate worker processes,
+    #workers = 0 uses every core. With one worker the setups of a tank are preprocessed together as stacked arrays.
+    #A failing session is recorded in the summary and the batch carries on.
+    channel_map = import_tank_v2.CHANNEL_MAP if channel_map is None else channel_map
+    workers = int(options['workers'])
+    if workers <= 0:
+        workers = os.cpu_count()
+    jobs = batch_jobs(settings, fan_out = workers > 1, channel_map = channel_map)
+    rows = [settings.iloc[i].to_dict() for i in range(0, len(settings))]
+
+    #the stage cache is trimmed to its size limit after every job
+    cache = session_cache(output_file_path, options)
+    def evict():
+        if cache is not None:
+            stage_cache.evict(cache, float(options['cache_size'])*1e9)
+
+    results = []
+    if workers == 1:
+        #the next tank is read and the outputs of the last session are written while a session is computed
+        if options['instrument']:
+            instrument.enable()
+        results = pipeline_batch(jobs, rows, output_file_path, options, channel_map, evict = evict)
     else:
-        print('Setup A is empty.')
-
-    if ID_B != 'nan':
-        #creating output for setup B
-        setup_B_path = os.path.join(treatment_path, ID_B)
-        if os.path.exists(setup_B_path) == False:
-            os.mkdir(setup_B_path)
-
-        INFO_B = pd.DataFrame(INFO_B, index = [0])
-        path = os.path.join(setup_B_path, 'info.csv')
-        INFO_B.to_csv(path)
+        with ProcessPoolExecutor(max_workers = workers, initializer = init_worker) as executor:
+            futures = {executor.submit(extract_session, i, rows[i], setups, output_file_path, options, channel_map = channel_map): (i, setups)
+                       for i, setups in jobs}
+            for future in tqdm(as_completed(futures), total = len(futures)):
+                i, setups = futures[future]
+                try:
+                    results.extend(future.result())
+                except Exception:
+                    results.extend(failed_results(i, rows[i], setups, channel_map))
+                evict()
+
+    return batch_summary(results, output_file_path)
+
+
+## This function saves the results of every setup to batch_summary.csv and prints the failures
+def batch_summary(results, output_file_path):
+    summary = pd.DataFrame(results, columns = ['row', 'treatment', 'setup', 'id', 'status', 'error'])
+    summary = summary.sort_values(['row', 'setup']).reset_index(drop = True)
+    #several queue workers may finish the batch at the same time, each one writes the same summary
+    summary_path = os.path.join(output_file_path, 'batch_summary.csv')
+    with data_store.temporary_file(summary_path) as temporary:
+        summary.to_csv(temporary)
+
+    failures = summary.loc[summary['status'] == 'failed']
+    skipped = summary.loc[summary['status'] == 'skipped']
+    print(f'{len(summary) - len(failures)} of {len(summary)} setups exported successfully ({len(skipped)} were already up to date)')
+    for _, failure in failures.iterrows():
+        print(f"Row {failure['row']} setup {failure['setup']} (ID: {failure['id']}, treatment: {failure['treatment']}) failed:\n{failure['error']}")
+    return summary
+
+
+## This function returns the name of the queue job of a setup of a settings row
+def queue_job(row_number, row, setup, channel_map):
+    return f"row{row_number}_{row['treatment_name']}_{setup_id(row, setup, channel_map)}_{setup}"
+
+
+## This function returns the key of the inputs of the queue job of a setup, the key of its last stage and the options
+def queue_key(row, setup, output_file_path, options, channel_map):
+    #The stage key changes with the tank files, so a job is run again after the tank changes or an option is changed.
+    setup_path = os.path.join(output_file_path, str(row['treatment_name']), setup_id(row, setup, channel_map))
+    try:
+        stage_key = stage_keys(stage_params(row, setup, setup_path, options, channel_map))['normalised_data']
+    except Exception:
+        #the job records why the setup cannot be planned
+        stage_key = None
+    return work_queue.value_key([stage_key, options])
+
+
+## This function runs the queue jobs of the batch in this process until every job has a result, see work_queue.drain
+def drain_queue(path, jobs, keys, rows, output_file_path, options, channel_map):
+    #jobs maps every queue job to its settings row and setup, and keys to the key of its inputs (see queue_key).
+    #A job returns the results of its setup, a job that fails outside of run_session is recorded as failed rather
+    #than stopping the worker.
+    cache = session_cache(output_file_path, options)
+    def run(name):
+        i, setups = jobs[name]
+        try:
+            results = extract_session(i, rows[i], setups, output_file_path, options, channel_map = channel_map)
+        except Exception:
+            results = failed_results(i, rows[i], setups, channel_map)
+        if cache is not None:
+            stage_cache.evict(cache, float(options['cache_size'])*1e9)
+        return results
+    return work_queue.drain(path, list(jobs), run, lease_timeout = float(options['lease_timeout']),
+                            heartbeat_interval = float(options['heartbeat_interval']), keys = keys)
+
+
+## This function runs the batch as a work queue in the output directory, shared with the workers of other machines
+def queue_batch(settings, output_file_path, options, settings_path, channel_map = None):
+    #Every settings row and setup is one job of the queue of this settings file (see work_queue.py). This machine
+    #runs workers processes (0 = every core) that take jobs until every job is done, by whichever worker or machine,
+    #and each worker then writes the same batch summary. Setups already exported are skipped as in run_batch,
+    #so a job reclaimed from a crashed worker only recomputes what it had not written.
+    channel_map = import_tank_v2.CHANNEL_MAP if channel_map is None else channel_map
+    workers = int(options['workers'])
+    if workers <= 0:
+        workers = os.cpu_count()
+    rows = [settings.iloc[i].to_dict() for i in range(0, len(settings))]
+    jobs = {queue_job(i, rows[i], setups[0], channel_map): (i, setups) for i, setups in batch_jobs(settings, fan_out = True, channel_map = channel_map)}
+    path = work_queue.queue_path(output_file_path, 'extract', settings_path)
+    keys = {name: queue_key(rows[i], setups[0], output_file_path, options, channel_map) for name, (i, setups) in jobs.items()}
+
+    if workers == 1:
+        finished = drain_queue(path, jobs, keys, rows, output_file_path, options, channel_map)
     else:
-        print('Setup B is empty')
-    
-
-
-    if ID_A != 'nan':
-        #Runs the functions for setup A
-        filtered_data, filtered_figure = preprocessing_v2.zero_phase_filter(OUTPUTS_A, SAMPLING_RATE_A, TIMESTAMPS_A)
-        detrended_data, exponential_fit_figure, detrended_figure, exponential_fit = preprocessing_v2.photo_bleach_correction(filtered_data, TIMESTAMPS_A)
-        motion_corrected_data, motion_figure = preprocessing_v2.motion_correction(detrended_data, TIMESTAMPS_A)
-        normalised_data, dF_F_plot, zscore_plot = preprocessing_v2.normalisation(motion_corrected_data, exponential_fit, TIMESTAMPS_A)
-
-        data_path = os.path.join(setup_A_path, 'data')
-        os.mkdir(data_path)
-
-        raw_data = pd.DataFrame(OUTPUTS_A)
-        raw_data_path = os.path.join(data_path, 'raw_data.csv')
-        raw_data.to_csv(raw_data_path)
-
-        filtered_data = pd.DataFrame(filtered_data)
-        filtered_data_path = os.path.join(data_path, 'filtered_data.csv')
-        filtered_data.to_csv(filtered_data_path)
-
-        detrended_data = pd.DataFrame(detrended_data)
-        detrended_data_path = os.path.join(data_path, 'detrended_data.csv')
-        detrended_data.to_csv(detrended_data_path)
-
-        motion_corrected_data = pd.DataFrame(motion_corrected_data)
-        motion_corrected_data_path = os.path.join(data_path, 'motion_corrected_data.csv')
-        motion_corrected_data.to_csv(motion_corrected_data_path)
-
-        normalised_data = pd.DataFrame(normalised_data)
-        normalised_data_path = os.path.join(data_path, 'normalised_data.csv')
-        normalised_data.to_csv(normalised_data_path)
-
-        timestamps = pd.DataFrame(TIMESTAMPS_A)
-        timestamps_path = os.path.join(setup_A_path, 'timestamps.csv')
-        timestamps.to_csv(timestamps_path)
-
-        #makes a directory for the figures
-        figure_path = os.path.join(setup_A_path, 'figures')
-        os.mkdir(figure_path)
-
-        raw_figure_path = os.path.join(figure_path, 'raw_figure.png')
-        RAW_FIGURE_A.savefig(raw_figure_path, dpi = 300)
-
-        filtered_figure_path = os.path.join(figure_path, 'filtered_figure.png')
-        filtered_figure.savefig(filtered_figure_path, dpi = 300)
-
-        expfit_figure_path = os.path.join(figure_path, 'exp_fit_figure.png')
-        exponential_fit_figure.savefig(expfit_figure_path, dpi = 300)
-
-        detrended_figure_path = os.path.join(figure_path, 'detrended_figure.png')
-        detrended_figure.savefig(detrended_figure_path, dpi = 300)
-
-        motion_figure_path = os.path.join(figure_path, 'motion_figure.png')
-        motion_figure.savefig(motion_figure_path, dpi = 300)
-
-        dF_F_path = os.path.join(figure_path, 'dF_F.png')
-        dF_F_plot.savefig(dF_F_path, dpi = 300)
-
-        zscore_path = os.path.join(figure_path, 'zscore.png')
-        zscore_plot.savefig(zscore_path, dpi = 300)
-
-    #Runs the functions for setup B
-    if ID_B != 'nan':
-        filtered_data, filtered_figure = preprocessing_v2.zero_phase_filter(OUTPUTS_B, SAMPLING_RATE_B, TIMESTAMPS_B)
-        detrended_data, exponential_fit_figure, detrended_figure, exponential_fit = preprocessing_v2.photo_bleach_correction(filtered_data, TIMESTAMPS_B)
-        motion_corrected_data, motion_figure = preprocessing_v2.motion_correction(detrended_data, TIMESTAMPS_B)
-        normalised_data, dF_F_plot, zscore_plot = preprocessing_v2.normalisation(motion_corrected_data, exponential_fit, TIMESTAMPS_B)
-
-        data_path = os.path.join(setup_B_path, 'data')
-        os.mkdir(data_path)
-
-        raw_data = pd.DataFrame(OUTPUTS_B)
-        raw_data_path = os.path.join(data_path, 'raw_data.csv')
-        raw_data.to_csv(raw_data_path)
-
-        filtered_data = pd.DataFrame(filtered_data)
-        filtered_data_path = os.path.join(data_path, 'filtered_data.csv')
-        filtered_data.to_csv(filtered_data_path)
-
-        detrended_data = pd.DataFrame(detrended_data)
-        detrended_data_path = os.path.join(data_path, 'detrended_data.csv')
-        detrended_data.to_csv(detrended_data_path)
-
-        motion_corrected_data = pd.DataFrame(motion_corrected_data)
-        motion_corrected_data_path = os.path.join(data_path, 'motion_corrected_data.csv')
-        motion_corrected_data.to_csv(motion_corrected_data_path)
-
-        normalised_data = pd.DataFrame(normalised_data)
-        normalised_data_path = os.path.join(data_path, 'normalised_data.csv')
-        normalised_data.to_csv(normalised_data_path)
-
-        timestamps = pd.DataFrame(TIMESTAMPS_B)
-        timestamps_path = os.path.join(setup_B_path, 'timestamps.csv')
-        timestamps.to_csv(timestamps_path)
-
-        #makes a directory for the figures
-        figure_path = os.path.join(setup_B_path, 'figures')
-        os.mkdir(figure_path)
-
-        raw_figure_path = os.path.join(figure_path, 'raw_figure.png')
-        RAW_FIGURE_B.savefig(raw_figure_path, dpi = 300)
-
-        filtered_figure_path = os.path.join(figure_path, 'filtered_figure.png')
-        filtered_figure.savefig(filtered_figure_path, dpi = 300)
-
-        expfit_figure_path = os.path.join(figure_path, 'exp_fit_figure.png')
-        exponential_fit_figure.savefig(expfit_figure_path, dpi = 300)
-
-        detrended_figure_path = os.path.join(figure_path, 'detrended_figure.png')
-        detrended_figure.savefig(detrended_figure_path, dpi = 300)
-
-        motion_figure_path = os.path.join(figure_path, 'motion_figure.png')
-        motion_figure.savefig(motion_figure_path, dpi = 300)
-
-        dF_F_path = os.path.join(figure_path, 'dF_F.png')
-        dF_F_plot.savefig(dF_F_path, dpi = 300)
-
-        zscore_path = os.path.join(figure_path, 'zscore.png')
-        zscore_plot.savefig(zscore_path, dpi = 300)
-
-print('Export Complete')
+        with ProcessPoolExecutor(max_workers = workers, initializer = init_worker) as executor:
+            futures = [executor.submit(drain_queue, path, jobs, keys, rows, output_file_path, options, channel_map) for _ in range(workers)]
+            finished = [future.result() for future in futures][0]
+    return batch_summary([result for name in jobs for result in finished[name]], output_file_path)
+
+
+## This function lists the stages a run of the batch would recompute for every setup, without computing anything
+def plan_batch(settings, output_file_path, options, channel_map = None):
+    #'raw_data' in the list means the tank would be read again.
+    channel_map = import_tank_v2.CHANNEL_MAP if channel_map is None else channel_map
+    cache = session_cache(output_file_path, options)
+    plan = []
+    for i, setups in batch_jobs(settings, fan_out = True, channel_map = channel_map):
+        row = settings.iloc[i].to_dict()
+        for setup in setups:
+            setup_path = os.path.join(output_file_path, str(row['treatment_name']), setup_id(row, setup, channel_map))
+            keys = stage_keys(stage_params(row, setup, setup_path, options, channel_map))
+            if setup_complete(setup_path, keys['normalised_data'], options):
+                recompute = 'up to date'
+            else:
+                start, _ = cache_plan(keys, options, cache)
+                recompute = ', '.join(PIPELINE[start + 1:]) if start < len(PIPELINE) - 1 else 'outputs only'
+            plan.append({'row': i, 'treatment': str(row['treatment_name']), 'setup': setup,
+                         'id': setup_id(row, setup, channel_map), 'recompute': recompute})
+
+    plan = pd.DataFrame(plan, columns = ['row', 'treatment', 'setup', 'id', 'recompute'])
+    print(plan.to_string(index = False))
+    return plan
+
+
+if __name__ == '__main__':
+    #Put the settings excel file into the folder you want the outputs to be saved, and pass the path to this folder
+    #(python data_extract.py <output directory>) or paste it in when asked.
+    #python data_extract.py --dry-run only lists what would be recomputed, and python data_extract.py --queue shares the
+    #batch with every other machine running it with --queue on the same output directory (see work_queue.py).
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    if arguments:
+        output_file_path = arguments[0]
+    else:
+        print("Please paste in the path to the output directory")
+        output_file_path = input()
+    settings_path = (f'{output_file_path}/settings.xlsx')
+    settings = pd.read_excel(settings_path)
+    options = run_options.read_options(settings_path)
+    channel_map = import_tank_v2.read_channel_map(settings_path)
+
+    if '--dry-run' in sys.argv[1:]:
+        plan_batch(settings, output_file_path, options, channel_map)
+    elif '--queue' in sys.argv[1:]:
+        queue_batch(settings, output_file_path, options, settings_path, channel_map)
+        print('Export Complete')
+    else:
+        run_batch(settings, output_file_path, options, channel_map)
+        print('Export Complete')
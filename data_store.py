@@ -0,0 +1,143 @@
+"""
+This code stores the preprocessed data of one setup as a directory of .npy files with a json header (store.json).
+Every stage (raw, filtered, detrended, motion corrected and normalised) keeps one .npy file per column,
+together with the info metadata and the timestamps, so data_analysis.py can memory-map only the columns it needs.
+Time bases (see time_base.py) are saved as their offset, rate, length and start in the header, not as arrays.
+Csv files are written from the store only when they are asked for.
+"""
+import numpy as np
+import pandas as pd
+import json
+import os
+import uuid
+import contextlib
+from time_base import TimeBase
+
+STORE_HEADER = 'store.json'
+#Version 2 saves TimeBase columns in the header instead of as .npy files.
+STORE_VERSION = 2
+
+## This function converts numpy scalars in the info dictionary so it can be written to json
+def _json_value(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+## This function returns a temporary name next to path that no other process writes to
+def temporary_path(path):
+    #Files are written to a temporary name and renamed into place, so two workers writing the same file (a job of a
+    #work queue reclaimed from a slow worker runs twice) never interleave, and a file is always whole or absent.
+    return f'{path}.{uuid.uuid4().hex}.tmp'
+
+
+## This context manager gives a temporary name to write the file at path to, and renames it into place when the block ends
+@contextlib.contextmanager
+def temporary_file(path):
+    temporary = temporary_path(path)
+    try:
+        yield temporary
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    os.replace(temporary, path)
+
+
+## This function saves an array to the .npy file at path through a temporary file and a rename
+def save_array(path, values):
+    with temporary_file(path) as temporary, open(temporary, 'wb') as f:
+        np.save(f, values)
+
+
+## This function writes every stage, the info and the timestamps of a setup to the store in data_path
+def write_store(data_path, stages, info, timestamps, key = None):
+    #stages is a dictionary of stage name -> dictionary of column name -> array, e.g. {'raw_data': OUTPUTS_A, ...}
+    #key is saved in the header to record what the store was computed from (see stage_cache.py).
+    #The header of an existing store is removed first and the new one is written last,
+    #so an interrupted write never leaves a store that looks complete. Every file goes through save_array.
+    os.makedirs(data_path, exist_ok = True)
+    header_path = os.path.join(data_path, STORE_HEADER)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    header = {'version': STORE_VERSION, 'key': key, 'info': dict(info), 'stages': {}, 'timestamps': {}}
+
+    for stage, columns in stages.items():
+        header['stages'][stage] = {}
+        for column, values in columns.items():
+            if isinstance(values, TimeBase):
+                header['stages'][stage][column] = {'time_base': values.to_dict(), 'length': len(values)}
+                continue
+            values = np.asarray(values)
+            file_name = f'{stage}.{column}.npy'
+            save_array(os.path.join(data_path, file_name), values)
+            header['stages'][stage][column] = {'file': file_name, 'dtype': str(values.dtype), 'length': len(values)}
+
+    timestamps = pd.DataFrame(timestamps)
+    for column in timestamps.columns:
+        values = timestamps[column].to_numpy()
+        if values.dtype.kind in 'biuf':
+            file_name = f'timestamps.{column}.npy'
+            save_array(os.path.join(data_path, file_name), values)
+            header['timestamps'][column] = {'file': file_name}
+        else:
+            header['timestamps'][column] = {'values': [str(value) for value in values]}
+
+    with temporary_file(header_path) as temporary, open(temporary, 'w') as f:
+        json.dump(header, f, indent = 1, default = _json_value)
+
+
+## This function checks whether data_path holds a complete store
+def has_store(data_path):
+    return os.path.exists(os.path.join(data_path, STORE_HEADER))
+
+
+## This function reads the json header of a store
+def read_header(data_path):
+    with open(os.path.join(data_path, STORE_HEADER)) as f:
+        return json.load(f)
+
+
+## This function returns the info metadata saved with the store
+def read_info(data_path):
+    return read_header(data_path)['info']
+
+
+## This function returns the columns of one stage, memory-mapped unless mmap is False
+def read_stage(data_path, stage, columns = None, mmap = True):
+    #Time base columns are returned as TimeBase objects, np.asarray turns them into arrays.
+    header = read_header(data_path)
+    if stage not in header['stages']:
+        raise KeyError(f"Stage '{stage}' is not in the store at {data_path}")
+
+    stage_columns = header['stages'][stage]
+    columns = list(stage_columns) if columns is None else columns
+    return {
+        column: TimeBase.from_dict(stage_columns[column]['time_base']) if 'time_base' in stage_columns[column]
+        else np.load(os.path.join(data_path, stage_columns[column]['file']), mmap_mode = 'r' if mmap else None)
+        for column in columns
+    }
+
+
+## This function returns the timestamps saved with the store as a DataFrame, the same layout as timestamps.csv
+def read_timestamps(data_path):
+    header = read_header(data_path)
+    timestamps = {}
+    for column, entry in header['timestamps'].items():
+        if 'file' in entry:
+            timestamps[column] = np.load(os.path.join(data_path, entry['file']))
+        else:
+            timestamps[column] = entry['values']
+    return pd.DataFrame(timestamps)
+
+
+## This function exports stages of the store to csv files, {stage}.csv in data_path
+def export_csv(data_path, stages = None, timestamps_path = None):
+    header = read_header(data_path)
+    stages = list(header['stages']) if stages is None else stages
+    for stage in stages:
+        with temporary_file(os.path.join(data_path, f'{stage}.csv')) as temporary:
+            pd.DataFrame({column: np.asarray(values) for column, values in read_stage(data_path, stage).items()}).to_csv(temporary)
+    if timestamps_path is not None:
+        with temporary_file(timestamps_path) as temporary:
+            read_timestamps(data_path).to_csv(temporary)
@@ -0,0 +1,241 @@
+"""
+This code collects the peri-event windows of every subject into one cube, so group traces no longer have to be
+averaged by hand from the csv files of each subject.
+The cube is a memory-mapped treatments x subjects x event types x trials x time x metrics array (cube.npy) in the
+event_cube folder of the output directory, with a json header (cube.json) holding the labels of each axis and the
+number of trials of every treatment, subject and event type. Missing trials are NaN.
+Each axis is allocated with spare room that doubles when it runs out, so adding a session writes only its own
+windows, and adding a session again replaces its windows.
+Queries select any treatments, subjects and event types and reduce everything not grouped by in one call:
+the mean, SEM, median or count of the traces, or of the mean of each trial over a time window.
+
+python event_cube.py <output directory> --metric zscore --stat mean sem --by treatment event
+"""
+import numpy as np
+import pandas as pd
+import argparse
+import warnings
+import json
+import os
+
+CUBE_DIR = 'event_cube'
+CUBE_HEADER = 'cube.json'
+
+#The cube is stored in float32 to halve its size, windows are float64 while they are computed.
+CUBE_DTYPE = np.float32
+
+#Axes of the cube that can be selected and grouped by, in order.
+AXES = ['treatment', 'subject', 'event']
+
+## This function returns the cube folder inside the output directory
+def cube_path(output_file_path):
+    return os.path.join(output_file_path, CUBE_DIR)
+
+
+## This function reads the header of the cube, or returns None when there is no cube yet
+def read_header(path):
+    header_path = os.path.join(path, CUBE_HEADER)
+    if not os.path.exists(header_path):
+        return None
+    with open(header_path) as f:
+        return json.load(f)
+
+
+## This function writes the header of the cube, replacing the old one only once the new one is complete
+def write_header(path, header):
+    header_path = os.path.join(path, CUBE_HEADER)
+    with open(header_path + '.tmp', 'w') as f:
+        json.dump(header, f, indent = 1)
+    os.replace(header_path + '.tmp', header_path)
+
+
+## This function saves the trial counts next to the cube and renames them into place
+def save_trials(path, trials):
+    with open(os.path.join(path, 'trials.npy.tmp'), 'wb') as f:
+        np.save(f, trials)
+    os.replace(os.path.join(path, 'trials.npy.tmp'), os.path.join(path, 'trials.npy'))
+
+
+## This function opens the cube array and trial counts, memory-mapped read only unless mode is 'r+'
+def open_cube(path, mode = 'r'):
+    #Returns the header, the data (treatments x subjects x events x trials x time x metrics) and the
+    #trial counts (treatments x subjects x events), both cut to the labels in use.
+    header = read_header(path)
+    if header is None:
+        raise FileNotFoundError(f'There is no event cube in {path}')
+    data = np.load(os.path.join(path, 'cube.npy'), mmap_mode = mode)
+    trials = np.load(os.path.join(path, 'trials.npy'), mmap_mode = mode)
+    used = tuple(slice(0, len(header[f'{axis}s'])) for axis in AXES)
+    return header, data[used], trials[used]
+
+
+## This function allocates the cube files with the given capacity, copying in the cube that is already there
+def allocate(path, header, capacity):
+    #capacity is (treatments, subjects, events, trials). The new files are written next to the old ones and renamed,
+    #so an interrupted resize leaves the old cube in place.
+    shape = tuple(capacity) + (len(header['time']), len(header['metrics']))
+    data = np.lib.format.open_memmap(os.path.join(path, 'cube.npy.tmp'), mode = 'w+', dtype = CUBE_DTYPE, shape = shape)
+    data[:] = np.nan
+    trials = np.zeros(tuple(capacity[:3]), dtype = np.int64)
+    if header['capacity'] is not None:
+        old_data = np.load(os.path.join(path, 'cube.npy'), mmap_mode = 'r')
+        old_trials = np.load(os.path.join(path, 'trials.npy'))
+        data[tuple(slice(0, size) for size in old_data.shape)] = old_data
+        trials[tuple(slice(0, size) for size in old_trials.shape)] = old_trials
+        del old_data
+    data.flush()
+    del data
+    os.replace(os.path.join(path, 'cube.npy.tmp'), os.path.join(path, 'cube.npy'))
+    save_trials(path, trials)
+    header['capacity'] = list(capacity)
+
+
+## This function adds (or replaces) the peri-event windows of one session of a subject to the cube in path
+def add_windows(path, treatment, subject, windows):
+    #windows is the output of peri_event.peri_event_windows. Every session must share the window time axis and metrics
+    #of the first one added, a ValueError is raised otherwise.
+    os.makedirs(path, exist_ok = True)
+    if len(windows) == 0:
+        return
+    first = next(iter(windows.values()))
+    header = read_header(path)
+    if header is None:
+        header = {'treatments': [], 'subjects': [], 'events': [], 'time': [float(x) for x in first['time']],
+                  'metrics': list(first['metrics']), 'capacity': None}
+    for name, window in windows.items():
+        if len(window['time']) != len(header['time']) or not np.allclose(window['time'], header['time']) \
+                or list(window['metrics']) != header['metrics']:
+            raise ValueError(f'The {name} windows of {treatment}/{subject} do not match the time axis and metrics of the event cube in {path}, '
+                             'use the same window_pre, window_post and downsampled rate for every session')
+
+    #add the new labels, and grow any axis that has run out of room to twice what it needs
+    for axis, labels in (('treatments', [str(treatment)]), ('subjects', [str(subject)]), ('events', [str(name) for name in windows])):
+        header[axis].extend(label for label in labels if label not in header[axis])
+    needed = [len(header['treatments']), len(header['subjects']), len(header['events']),
+              max(window['data'].shape[0] for window in windows.values())]
+    capacity = header['capacity']
+    if capacity is None or any(need > size for need, size in zip(needed, capacity)):
+        allocate(path, header, [max(need, 2*size) if need > size else size
+                                for need, size in zip(needed, capacity or [0, 0, 0, 0])])
+
+    data = np.load(os.path.join(path, 'cube.npy'), mmap_mode = 'r+')
+    trials = np.load(os.path.join(path, 'trials.npy'))
+    t, s = header['treatments'].index(str(treatment)), header['subjects'].index(str(subject))
+    #a session added again replaces every window of that subject and treatment
+    data[t, s] = np.nan
+    trials[t, s] = 0
+    for name, window in windows.items():
+        e = header['events'].index(str(name))
+        count = window['data'].shape[0]
+        data[t, s, e, :count] = window['data']
+        trials[t, s, e] = count
+    data.flush()
+    del data
+    save_trials(path, trials)
+    write_header(path, header)
+
+
+## This function returns the positions on one axis of the selected labels, every label when selected is None
+def select_labels(header, axis, selected):
+    labels = header[f'{axis}s']
+    if selected is None:
+        return list(range(len(labels)))
+    selected = [selected] if isinstance(selected, str) else selected
+    missing = [label for label in selected if str(label) not in labels]
+    if missing:
+        raise KeyError(f'The event cube has no {axis} {missing}')
+    return [labels.index(str(label)) for label in selected]
+
+
+## This function reduces the values over the leading axes with one statistic, ignoring NaN
+def reduce(values, stat, axes):
+    #stat is 'mean', 'sem' (standard error of the mean), 'median' or 'count' (number of values that are not NaN).
+    count = np.sum(~np.isnan(values), axis = axes)
+    if stat == 'count':
+        return count
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        if stat == 'mean':
+            return np.nanmean(values, axis = axes)
+        if stat == 'median':
+            return np.nanmedian(values, axis = axes)
+        if stat == 'sem':
+            return np.nanstd(values, axis = axes, ddof = 1)/np.sqrt(count)
+    raise ValueError(f"Unknown statistic '{stat}', use 'mean', 'sem', 'median' or 'count'")
+
+
+## This function computes a statistic of the traces (or window means) grouped by any of treatment, subject and event
+def query(path, stat = 'mean', metric = 'zscore', by = ('treatment', 'event'), treatments = None, subjects = None, events = None,
+          level = 'subject', window = None):
+    #The selected part of the cube is read in one slice and reduced over every axis not in `by`.
+    #level = 'subject' first averages the trials of each subject, so every subject counts once (SEM across subjects),
+    #level = 'trial' pools every trial. With a window (start, stop) in seconds each trial is first reduced to its mean
+    #over that part of the window, for per-window summaries.
+    #Returns the labels of each grouped axis and an array of (grouped axes) x time, without the time axis for a window.
+    header, data, _ = open_cube(path)
+    by = [by] if isinstance(by, str) else list(by)
+    unknown = [axis for axis in by if axis not in AXES]
+    if unknown:
+        raise ValueError(f'Cannot group by {unknown}, use any of {AXES}')
+    if level not in ('subject', 'trial'):
+        raise ValueError(f"Unknown level '{level}', use 'subject' or 'trial'")
+    positions = [select_labels(header, axis, selected) for axis, selected in zip(AXES, (treatments, subjects, events))]
+
+    values = data[..., header['metrics'].index(metric)][np.ix_(*positions)].astype(np.float64)
+    time = np.asarray(header['time'])
+    #empty trials and groups are NaN, numpy warns about every all-NaN slice
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if window is not None:
+            in_window = (time >= window[0]) & (time <= window[1])
+            values = np.nanmean(values[..., in_window], axis = -1, keepdims = True)
+        if level == 'subject':
+            values = np.nanmean(values, axis = 3)
+        else:
+            values = np.moveaxis(values, 3, 0)
+
+        #the grouped axes go last (before time), everything else is reduced
+        offset = values.ndim - 4
+        grouped = [offset + AXES.index(axis) for axis in by]
+        reduced = [axis for axis in range(values.ndim - 1) if axis not in grouped]
+        values = np.moveaxis(values, reduced + grouped, list(range(len(reduced) + len(grouped))))
+        result = reduce(values, stat, tuple(range(len(reduced))))
+    if window is not None:
+        result = result[..., 0]
+    labels = {axis: [header[f'{axis}s'][position] for position in positions[AXES.index(axis)]] for axis in by}
+    return labels, result
+
+
+## This function returns query results as a tidy table, one row per group (and time point for traces)
+def query_frame(path, stats = ('mean', 'sem'), **kwargs):
+    #kwargs are passed to query, every statistic becomes a column.
+    header = read_header(path)
+    frame = None
+    for stat in stats:
+        labels, result = query(path, stat = stat, **kwargs)
+        names = list(labels)
+        index_labels = [labels[name] for name in names]
+        if kwargs.get('window') is None:
+            names.append('time')
+            index_labels.append(header['time'])
+        index = pd.MultiIndex.from_product(index_labels, names = names) if names else None
+        column = pd.Series(np.ravel(result), index = index, name = stat)
+        frame = column.to_frame() if frame is None else frame.join(column)
+    return frame.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Write group traces or window summaries from the event cube of an output directory.')
+    parser.add_argument('output_file_path', help = 'output directory holding the event_cube folder')
+    parser.add_argument('--metric', default = 'zscore', help = 'dF_F or zscore')
+    parser.add_argument('--stat', nargs = '+', default = ['mean', 'sem'], help = 'mean, sem, median and/or count')
+    parser.add_argument('--by', nargs = '*', default = ['treatment', 'event'], help = 'axes kept apart: treatment, subject, event')
+    parser.add_argument('--level', default = 'subject', help = "'subject' averages each subject's trials first, 'trial' pools every trial")
+    parser.add_argument('--window', nargs = 2, type = float, metavar = ('START', 'STOP'), help = 'summarise each trial over this part of the window (seconds)')
+    parser.add_argument('--output', help = 'csv file the table is written to')
+    args = parser.parse_args()
+
+    table = query_frame(cube_path(args.output_file_path), stats = args.stat, metric = args.metric, by = args.by, level = args.level,
+                        window = args.window)
+    output = args.output or os.path.join(args.output_file_path, f"group_{'_'.join(args.stat)}_{args.metric}.csv")
+    table.to_csv(output, index = False)
+    print(f'{len(table)} rows written to {output}')
@@ -0,0 +1,316 @@
+"""
+This code renders the figures of the preprocessing stages, separately from the computation in import_tank_v2 and preprocessing_v2.
+Only the figures that are asked for are rendered. Every trace is reduced to a min/max envelope of about two points
+per pixel column before plotting, which looks the same at 300 dpi as plotting every sample, and the figures can be
+rendered in a pool while the next session is computed.
+"""
+import numpy as np
+import os
+import instrument
+import data_store
+from matplotlib.figure import Figure
+
+#Figure names and the file each one is saved as.
+FIGURE_FILES = {
+    'raw': 'raw_figure.png',
+    'filtered': 'filtered_figure.png',
+    'exp_fit': 'exp_fit_figure.png',
+    'detrended': 'detrended_figure.png',
+    'motion': 'motion_figure.png',
+    'dF_F': 'dF_F.png',
+    'zscore': 'zscore.png'
+}
+
+#Stage data each figure is drawn from, these stages must not be overwritten in place before the figure is prepared.
+FIGURE_STAGES = {
+    'raw': ['raw_data'],
+    'filtered': ['raw_data', 'filtered_data'],
+    'exp_fit': ['filtered_data'],
+    'detrended': ['detrended_data'],
+    'motion': ['detrended_data', 'motion_corrected_data'],
+    'dF_F': ['normalised_data'],
+    'zscore': ['normalised_data']
+}
+
+#Number of envelope bins per trace, about the pixel width of a default figure at 300 dpi.
+ENVELOPE_WIDTH = 2000
+
+## This function reduces a trace to the minimum and maximum of each of `width` bins, keeping every extreme
+def envelope(x, y, width = ENVELOPE_WIDTH):
+    #x is an array of times or a TimeBase, which only gives the times of the bins.
+    y = np.asarray(y)
+    if len(y) <= 2*width:
+        return np.asarray(x), y
+    starts = np.linspace(0, len(y), width, endpoint = False).astype(np.int64)
+    low = np.minimum.reduceat(y, starts)
+    high = np.maximum.reduceat(y, starts)
+    return np.repeat(np.asarray(x[starts]), 2), np.column_stack([low, high]).ravel()
+
+
+## This function collects the enveloped traces and values one figure needs from the stage data
+def figure_inputs(name, stages, timestamps, width = ENVELOPE_WIDTH):
+    #stages holds 'raw_data', 'filtered_data', 'exponential_fit', 'detrended_data', 'motion_fit',
+    #'motion_corrected_data' and 'normalised_data' as returned by the preprocessing functions.
+    #The result only holds small arrays, so it can be sent to another process for rendering.
+    inputs = {'timestamps': np.asarray(timestamps.ts, dtype = np.float64)}
+
+    if name in ('raw', 'filtered'):
+        raw = stages['raw_data']
+        inputs['signal_raw'] = envelope(raw['signal_ts'], raw['signal'], width)
+        inputs['ISOS_raw'] = envelope(raw['ISOS_ts'], raw['ISOS'], width)
+    if name in ('filtered', 'exp_fit'):
+        filtered = stages['filtered_data']
+        inputs['signal_filtered'] = envelope(filtered['signal_ts'], filtered['filtered_signal'], width)
+        inputs['ISOS_filtered'] = envelope(filtered['ISOS_ts'], filtered['filtered_ISOS'], width)
+    if name == 'exp_fit':
+        filtered = stages['filtered_data']
+        inputs['signal_expfit'] = envelope(filtered['signal_ts'], stages['exponential_fit']['signal_expfit'], width)
+        inputs['ISOS_expfit'] = envelope(filtered['ISOS_ts'], stages['exponential_fit']['ISOS_expfit'], width)
+    if name in ('detrended', 'motion'):
+        detrended = stages['detrended_data']
+        inputs['signal_detrended'] = envelope(detrended['signal_ts'], detrended['detrended_signal'], width)
+        inputs['ISOS_detrended'] = envelope(detrended['ISOS_ts'], detrended['detrended_ISOS'], width)
+    if name == 'motion':
+        detrended = stages['detrended_data']
+        motion_fit = stages['motion_fit']
+        #every 5th point as before, thinned further so the scatter has at most 50000 points
+        step = max(5, len(detrended['detrended_ISOS'])//50000)
+        inputs['scatter'] = (np.asarray(detrended['detrended_ISOS'][::step]), np.asarray(detrended['detrended_signal'][::step]))
+        inputs['motion_fit'] = dict(motion_fit)
+        corrected = stages['motion_corrected_data']
+        #the estimated motion is what the correction removed, which also holds for a sliding window regression
+        est_motion = np.subtract(detrended['detrended_signal'], corrected['signal_corrected'], dtype = np.float64)
+        inputs['signal_est_motion'] = envelope(detrended['signal_ts'], est_motion, width)
+        inputs['signal_corrected'] = envelope(corrected['signal_ts'], corrected['signal_corrected'], width)
+    if name in ('dF_F', 'zscore'):
+        normalised = stages['normalised_data']
+        inputs['dF_F'] = envelope(normalised['time'], normalised['dF_F'], width)
+        if name == 'zscore':
+            inputs['zscore'] = envelope(normalised['time'], normalised['zscore'], width)
+
+    return inputs
+
+
+## This function adds the timestamps as tick marks at height y
+def plot_timestamps(ax, timestamps, y):
+    return ax.plot(timestamps, np.full(np.size(timestamps), y), label='Timestamps', color='w', marker="|", mec = "k")
+
+
+## This function draws the raw signals and time stamps
+def raw_figure(inputs):
+    signal_ts, signal = inputs['signal_raw']
+    ISOS_ts, ISOS = inputs['ISOS_raw']
+
+    figure = Figure()
+    ax1 = figure.subplots()
+    plot1=ax1.plot(signal_ts, signal, 'g', label='Signal')
+    ax2=ax1.twinx()
+    plot2=ax2.plot(ISOS_ts, ISOS, 'y', label='Isosbestic')
+
+    timestamp_ticks = plot_timestamps(ax1, inputs['timestamps'], np.max(signal))
+
+    ax1.set_ylim(np.min(signal) - 20, np.max(signal)+ 10)
+    ax2.set_ylim(np.min(ISOS)-10 , np.max(signal)-20)
+    ax1.set_xlabel('Time (milliseconds)')
+    ax1.set_ylabel('Signal (mV)', color='g')
+    ax2.set_ylabel('Isosbestic (mV)', color='y')
+    ax1.set_title('Raw signals')
+
+    lines = plot1 + plot2 + timestamp_ticks #line handle for legend
+    labels = [l.get_label() for l in lines]  #get legend labels
+    ax1.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.98, 0.50)) #add legend
+    return figure
+
+
+## This function draws the filtered signals over the raw signals
+def filtered_figure(inputs):
+    signal_ts, filtered_signal = inputs['signal_filtered']
+    ISOS_ts, filtered_ISOS = inputs['ISOS_filtered']
+
+    figure = Figure()
+    ax1 = figure.subplots()
+    plot1=ax1.plot(signal_ts, filtered_signal, 'g', label='Signal')
+    ax2=ax1.twinx()
+    plot2=ax2.plot(ISOS_ts, filtered_ISOS, 'y', label='ISOS')
+    plot3= ax1.plot(*inputs['signal_raw'], 'g', alpha = 0.3, label = 'Signal Raw' )
+    plot4= ax2.plot(*inputs['ISOS_raw'], 'y', alpha = 0.3, label = 'ISOS Raw' )
+
+    timestamp_ticks = plot_timestamps(ax1, inputs['timestamps'], np.max(filtered_signal))
+
+    ax1.set_ylim(np.min(filtered_signal) - 20, np.max(filtered_signal)+ 10)
+    ax2.set_ylim(np.min(filtered_ISOS)-10 , np.max(filtered_signal)-20)
+    ax1.set_xlabel('Time (seconds)')
+    ax1.set_ylabel('Filtered Signal (mV)', color='g')
+    ax2.set_ylabel('Filtered ISOS (mV)', color='y')
+    ax1.set_title('Zero Phase Filtered signals')
+
+    lines = plot1 + plot2 + plot3 + plot4 + timestamp_ticks
+    labels = [l.get_label() for l in lines]
+    ax1.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.98, 0.50))
+    #ax1.set_xlim(1000, 1010) #Optional setting of a smaller window for the plot
+    return figure
+
+
+## This function draws the double exponential fits over the filtered signals
+def exp_fit_figure(inputs):
+    signal_ts, filtered_signal = inputs['signal_filtered']
+    ISOS_ts, filtered_ISOS = inputs['ISOS_filtered']
+
+    figure = Figure()
+    ax1 = figure.subplots()
+    plot1=ax1.plot(signal_ts, filtered_signal, color = 'g', label='Signal')
+    plot3=ax1.plot(*inputs['signal_expfit'], color='k', linewidth=1.5, label='Exponential fit')
+    ax2=ax1.twinx()
+    plot2=ax2.plot(ISOS_ts, filtered_ISOS, color='y', label='ISOS')
+    plot4=ax2.plot(*inputs['ISOS_expfit'], color='k', linewidth=1.5)
+
+    ax1.set_xlabel('Time (seconds)')
+    ax1.set_ylabel('Signal (mV)', color='g')
+    ax2.set_ylabel('ISOS (mV)', color='y')
+    ax1.set_title('Filtered signals with double exponential fits')
+
+    lines = plot1 + plot2 + plot3 + plot4
+    labels = [l.get_label() for l in lines]
+    ax1.legend(lines, labels, loc='upper right')
+
+    ax1.set_ylim(np.min(filtered_signal) - 20, np.max(filtered_signal)+ 10)
+    ax2.set_ylim(np.min(filtered_ISOS)-10 , np.max(filtered_signal)-20)
+    return figure
+
+
+## This function draws the detrended signals
+def detrended_figure(inputs):
+    signal_ts, detrended_signal = inputs['signal_detrended']
+    ISOS_ts, detrended_ISOS = inputs['ISOS_detrended']
+
+    figure = Figure()
+    ax1 = figure.subplots()
+    plot1=ax1.plot(signal_ts, detrended_signal, 'g', label='Signal')
+    ax2=ax1.twinx()
+    plot2=ax2.plot(ISOS_ts, detrended_ISOS, 'y', label='ISOS')
+
+    timestamp_ticks = plot_timestamps(ax1, inputs['timestamps'], np.max(detrended_signal))
+
+    ax1.set_ylim(np.min(detrended_signal) - 20, np.max(detrended_signal)+ 10)
+    ax2.set_ylim(np.min(detrended_ISOS)-10 , np.max(detrended_ISOS)+20)
+    ax1.set_xlabel('Time (seconds)')
+    ax1.set_ylabel('Filtered Signal (mV)', color='g')
+    ax2.set_ylabel('Filtered ISOS (mV)', color='y')
+    ax1.set_title('Detrended signals')
+
+    lines = plot1 + plot2 + timestamp_ticks
+    labels = [l.get_label() for l in lines]
+    ax2.legend(lines, labels, loc='lower right', bbox_to_anchor=(0.98, 0.50))
+    return figure
+
+
+## This function draws the ISOS - signal regression and the motion corrected signal
+def motion_figure(inputs):
+    motion_fit = inputs['motion_fit']
+    slope, intercept = motion_fit['slope'], motion_fit['intercept']
+
+    figure = Figure()
+    correlation_plot, motion_plot = figure.subplots(nrows = 2)
+
+    correlation_plot.scatter(*inputs['scatter'], alpha=0.1, marker='.')
+    x = np.array(correlation_plot.get_xlim())
+    correlation_plot.plot(x, intercept+slope*x)
+    correlation_plot.set_xlabel('ISOS')
+    correlation_plot.set_ylabel('Signal')
+    correlation_plot.set_title('ISOS - Signal correlation.')
+
+    correlation_plot.annotate('Slope    : {:.3f}'.format(slope), (-7.5,25))
+    correlation_plot.annotate('R-squared: {:.3f}'.format(motion_fit['r_value']**2), (-7.5,23))
+
+    signal_ts, detrended_signal = inputs['signal_detrended']
+    est_ts, signal_est_motion = inputs['signal_est_motion']
+    plot1= motion_plot.plot(signal_ts, detrended_signal, 'b' , label='Signal - pre motion correction', alpha=0.3)
+    plot3= motion_plot.plot(*inputs['signal_corrected'], 'g', label='Signal - motion corrected')
+    plot4= motion_plot.plot(est_ts, signal_est_motion - 0.05, 'y', label='estimated motion')
+    timestamp_ticks = plot_timestamps(motion_plot, inputs['timestamps'], np.max(detrended_signal))
+
+    motion_plot.set_xlabel('Time (seconds)')
+    motion_plot.set_ylabel('Signal (mV)', color='g')
+    motion_plot.set_title('Motion Correction')
+
+    lines = plot1+plot3+plot4+ timestamp_ticks
+    labels = [l.get_label() for l in lines]
+    motion_plot.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.95, 0.7))
+    return figure
+
+
+## This function draws dF/F
+def dF_F_figure(inputs):
+    time, dF_F = inputs['dF_F']
+
+    figure = Figure()
+    ax1 = figure.subplots()
+    plot1=ax1.plot(time, dF_F, 'g', label='dF/F')
+    timestamp_ticks = plot_timestamps(ax1, inputs['timestamps'], np.max(dF_F))
+    ax1.set_xlabel('Time (seconds)')
+    ax1.set_ylabel('dF/F (%)')
+    ax1.set_title('dF/F')
+
+    lines = plot1+ timestamp_ticks
+    labels = [l.get_label() for l in lines]
+    ax1.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.95, 0.98))
+    return figure
+
+
+## This function draws the z-score
+def zscore_figure(inputs):
+    time, zscore = inputs['zscore']
+
+    figure = Figure()
+    ax1 = figure.subplots()
+    plot1=ax1.plot(time, zscore, 'g', label='z-score')
+    timestamp_ticks = plot_timestamps(ax1, inputs['timestamps'], np.max(inputs['dF_F'][1]))
+
+    ax1.set_xlabel('Time (seconds)')
+    ax1.set_ylabel('z-score')
+    ax1.set_title('z-scored')
+
+    lines = plot1+ timestamp_ticks
+    labels = [l.get_label() for l in lines]
+    ax1.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.95, 0.98))
+    return figure
+
+
+FIGURE_FUNCTIONS = {
+    'raw': raw_figure,
+    'filtered': filtered_figure,
+    'exp_fit': exp_fit_figure,
+    'detrended': detrended_figure,
+    'motion': motion_figure,
+    'dF_F': dF_F_figure,
+    'zscore': zscore_figure
+}
+
+## This function draws one figure from its inputs and saves it
+def save_figure(path, name, inputs, dpi = 300):
+    #saved under a temporary name first, so an interrupted batch never leaves a figure that looks complete
+    with instrument.stage('render_figure', figure = name), data_store.temporary_file(path) as temporary:
+        figure = FIGURE_FUNCTIONS[name](inputs)
+        figure.savefig(temporary, dpi = dpi, format = os.path.splitext(path)[1][1:])
+    return path
+
+
+## This function renders the named figures of one setup into figure_path
+def render_figures(figure_path, names, stages, timestamps, executor = None, dpi = 300):
+    #The enveloped inputs of every figure are prepared straight away, so the stage data can be overwritten or freed
+    #once this returns. With an executor (thread or process pool) the drawing and saving run in the pool and the
+    #futures are returned, otherwise the figures are saved before returning.
+    unknown = [name for name in names if name not in FIGURE_FILES]
+    if unknown:
+        raise ValueError(f'Unknown figures {unknown}, choose from {list(FIGURE_FILES)}')
+
+    futures = []
+    for name in names:
+        with instrument.stage('figure_inputs', figure = name):
+            inputs = figure_inputs(name, stages, timestamps)
+        path = os.path.join(figure_path, FIGURE_FILES[name])
+        if executor is None:
+            save_figure(path, name, inputs, dpi)
+        else:
+            futures.append(executor.submit(instrument.bind(save_figure), path, name, inputs, dpi))
+    return futures
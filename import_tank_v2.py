@@ -1,148 +1,141 @@
 """
 This code functions to open the tank data and export it to a readable format for preprocessing and finally analysis
+The setups recorded in a tank are described by a channel map: the isosbestic stream, signal stream and camera epoc
+of each setup, and the settings column that holds its mouse ID. The map defaults to the two setups of CHANNEL_MAP
+and can be changed with a 'channels' sheet in the settings file.
+The raw figure is drawn from the outputs by figures.py.
 """
 import tdt
 import numpy as np
 import os
-import matplotlib.pyplot as plt
 import sys
 import pandas as pd
+import instrument
+import tank_reader
+from time_base import TimeBase
+
+#Default channel map: the isosbestic stream, signal stream and camera epoc of each setup,
+#and the column of the settings file with its mouse ID.
+CHANNEL_MAP = {
+    'A': {'isos': '405A', 'signal': '465A', 'camera': 'Cam2', 'column': 'setup_a'},
+    'B': {'isos': '415A', 'signal': '475A', 'camera': 'Cam1', 'column': 'setup_b'}
+}
+
+## This function reads the optional 'channels' sheet of the settings file, one row per setup
+def read_channel_map(settings_path):
+    #The sheet has the columns setup, isos, signal, camera and column, e.g. a row C, 405C, 465C, Cam3, setup_c.
+    try:
+        sheet = pd.read_excel(settings_path, sheet_name = 'channels')
+    except ValueError:
+        #the settings file has no channels sheet so the default setups are used
+        return dict(CHANNEL_MAP)
+
+    missing = [column for column in ['setup', 'isos', 'signal', 'camera', 'column'] if column not in sheet.columns]
+    if missing:
+        raise ValueError(f'The channels sheet of {settings_path} is missing the columns {missing}')
+    return {
+        str(row['setup']).strip(): {key: str(row[key]).strip() for key in ['isos', 'signal', 'camera', 'column']}
+        for _, row in sheet.iterrows()
+    }
+
+
+## This function returns the name tdt gives a store in the block, store names starting with a digit get a leading underscore
+def store_key(store):
+    return '_' + store if store[0].isdigit() else store
+
+
+## This function lists the stores that need to be read from the tank for the setups in use
+def required_stores(IDS, channel_map = None):
+    #IDS is a dictionary of setup -> mouse ID, setups with the ID 'nan' are not in use.
+    channel_map = CHANNEL_MAP if channel_map is None else channel_map
+    stores = []
+    for setup, ID in IDS.items():
+        if ID != 'nan':
+            channels = channel_map[setup]
+            stores.extend(store for store in [channels['isos'], channels['signal'], channels['camera']] if store not in stores)
+    return stores
 
-## This function opens the tank and confirms the tank path, setup and camera
-def open_tank(PATH, OFFSET, ID_A, ID_B, REGION, SENSOR):
-
-    data = tdt.read_block(PATH, t1 = OFFSET)
-    print(f"Mouse IDs: {ID_A} = Setup A, {ID_B} = Setup B \nBrain Region: {REGION} \nSensor: {SENSOR}")
-
-
-    if ID_A != 'nan':
-        #Extracts Data for Setup A
-        ISOS_A = data.streams._405A.data
-        signal_A = data.streams._465A.data
-        #Creating a timeseries the same size as the data using the sampling rate.
-        ISOS_ts_A = OFFSET + np.linspace(1, len(ISOS_A), len(ISOS_A))/data.streams._405A.fs
-        signal_ts_A = OFFSET + np.linspace(1, len(signal_A), len(signal_A))/data.streams._465A.fs
-        #Extracting timestamps for setup A (Camera 2) if camera setup changes alter this to Cam1
-        TIMESTAMPS_A = data.epocs.Cam2.notes
-        TIMESTAMPS_A.ts = TIMESTAMPS_A.ts + OFFSET
-        SAMPLING_RATE_A = data.streams._465A.fs
-
-    else:
-        ISOS_A = 0
-        TIMESTAMPS_A = 0
-        SAMPLING_RATE_A = 0
-
-    if ID_B != 'nan':
-        #Extracts data for Setup B
-        ISOS_B = data.streams._415A.data
-        signal_B = data.streams._475A.data
-
-        #Creating a timeseries the same size as the data using the sampling rate.
-        ISOS_ts_B = OFFSET + np.linspace(1, len(ISOS_B), len(ISOS_B))/data.streams._415A.fs
-        signal_ts_B = OFFSET + np.linspace(1, len(signal_B), len(signal_B))/data.streams._475A.fs
-
-        #Extracting timestamps for setup B (Camera 1) if camera setup changes alter this to Cam2
-        TIMESTAMPS_B = data.epocs.Cam1.notes
-        TIMESTAMPS_B.ts = TIMESTAMPS_B.ts + OFFSET
-        SAMPLING_RATE_B = data.streams._475A.fs
-
-    else:
-        ISOS_B = 0
-        TIMESTAMPS_B = 0
-        SAMPLING_RATE_B = 0
-
-    if ID_A != 'nan':
-        INFO_A = {
-            'Mouse ID' : ID_A,
-            'Brain Region' : REGION,
-            'Sensor': SENSOR,
-            'Setup' : 'Setup A',
-            'Camera' : '2',
-            'Sampling Rate': SAMPLING_RATE_A
-        }
-    else:
-        INFO_A = 0
 
-    if ID_B != 'nan':
-        INFO_B = {
-            'Mouse ID' : ID_B,
+## This function opens the tank and confirms the tank path, setup and camera
+def open_tank(PATH, OFFSET, IDS, REGION, SENSOR, END = 0, channel_map = None, sample_accurate = False, reader = 'tdt'):
+    #Only the streams and epocs of the setups in use are read, from OFFSET to END seconds (END = 0 reads to the end of the recording).
+    #Returns a dictionary of setup -> (INFO, OUTPUTS, TIMESTAMPS, SAMPLING_RATE) for every setup with a mouse ID.
+    #sample_accurate is passed to split_block. reader = 'memmap' reads the tank with tank_reader, so the streams in
+    #OUTPUTS are tank_reader.Stream views of the tank files that are read as the stages go through them.
+    channel_map = CHANNEL_MAP if channel_map is None else channel_map
+    stores = required_stores(IDS, channel_map)
+    if len(stores) == 0:
+        raise ValueError(f'Every setup is empty for tank {PATH}')
+    with instrument.stage('read_block'):
+        if reader == 'memmap':
+            data = tank_reader.read_block(PATH, t1 = OFFSET, t2 = END, store = stores)
+        elif reader == 'tdt':
+            data = tdt.read_block(PATH, t1 = OFFSET, t2 = END, store = stores, evtype = ['epocs', 'streams'])
+        else:
+            raise ValueError(f"Unknown tank reader '{reader}', use 'tdt' or 'memmap'")
+    print(f"Mouse IDs: {', '.join(f'{ID} = Setup {setup}' for setup, ID in IDS.items())} \nBrain Region: {REGION} \nSensor: {SENSOR}")
+    return split_block(data, OFFSET, IDS, REGION, SENSOR, channel_map, sample_accurate)
+
+
+## This function splits a block read from the tank (or made by synthetic.py) into the info, outputs and timestamps of each setup
+@instrument.timed
+def split_block(data, OFFSET, IDS, REGION, SENSOR, channel_map = None, sample_accurate = False):
+    #The time bases put the first sample one interval after OFFSET as they always have, with sample_accurate they put it
+    #at the start time of the stream read from the tank (OFFSET when the block does not give one), see time_base.py.
+    channel_map = CHANNEL_MAP if channel_map is None else channel_map
+    sessions = {}
+    for setup, ID in IDS.items():
+        if ID == 'nan':
+            continue
+        channels = channel_map[setup]
+        ISOS_stream = data.streams[store_key(channels['isos'])]
+        signal_stream = data.streams[store_key(channels['signal'])]
+        ISOS = ISOS_stream.data
+        signal = signal_stream.data
+
+        #Creating a time base the same size as the data using the sampling rate.
+        ISOS_ts = TimeBase(OFFSET, ISOS_stream.fs, len(ISOS))
+        signal_ts = TimeBase(OFFSET, signal_stream.fs, len(signal))
+        if sample_accurate:
+            ISOS_ts = ISOS_ts.sample_accurate(getattr(ISOS_stream, 'start_time', None))
+            signal_ts = signal_ts.sample_accurate(getattr(signal_stream, 'start_time', None))
+
+        #Extracting the timestamps of the camera of this setup, copied as setups may share a camera
+        TIMESTAMPS = tdt.StructType({key: value for key, value in data.epocs[store_key(channels['camera'])].notes.items()})
+        TIMESTAMPS.ts = TIMESTAMPS.ts + OFFSET
+        SAMPLING_RATE = signal_stream.fs
+
+        INFO = {
+            'Mouse ID' : ID,
             'Brain Region' : REGION,
             'Sensor': SENSOR,
-            'Setup' : 'Setup B',
-            'Camera' : '1',
-            'Sampling Rate': SAMPLING_RATE_B
-        }
-    else:
-        INFO_B = 0
-    
-    if ID_A != 'nan':
-        OUTPUTS_A = { 
-            'ISOS': ISOS_A,
-            'ISOS_ts' : ISOS_ts_A,
-            'signal': signal_A,
-            'signal_ts' : signal_ts_A,
+            'Setup' : f'Setup {setup}',
+            'Camera' : channels['camera'][3:] if channels['camera'].startswith('Cam') else channels['camera'],
+            'Sampling Rate': SAMPLING_RATE
         }
-    else:
-        OUTPUTS_A = 0
-
-    if ID_B != 'nan':
-        OUTPUTS_B = { 
-            'ISOS': ISOS_B,
-            'ISOS_ts' : ISOS_ts_B,
-            'signal': signal_B,
-            'signal_ts' : signal_ts_B,
+        OUTPUTS = {
+            'ISOS': ISOS,
+            'ISOS_ts' : ISOS_ts,
+            'signal': signal,
+            'signal_ts' : signal_ts,
         }
-    else:
-        OUTPUTS_B = 0
-    
-    if ID_A != 'nan':    
-        #Graph for Setup A
-        #Creating a graph of the raw data and time stamps for reference
-        RAW_FIGURE_A, ax1=plt.subplots()
-        plot1=ax1.plot(signal_ts_A, signal_A, 'g', label='Signal')
-        ax2=plt.twinx()
-        plot2=ax2.plot(ISOS_ts_A, ISOS_A, 'y', label='Isosbestic') 
-
-        timestamp_ticks = ax1.plot(TIMESTAMPS_A.ts, np.full(np.size(TIMESTAMPS_A.ts), max(signal_A)), label='Timestamps', color='w', marker="|", mec = "k")
-
-        ax1.set_ylim(min(signal_A) - 20, max(signal_A)+ 10)
-        ax2.set_ylim(min(ISOS_A)-10 , max(signal_A)-20)
-        ax1.set_xlabel('Time (milliseconds)')
-        ax1.set_ylabel('Signal (mV)', color='g')
-        ax2.set_ylabel('Isosbestic (mV)', color='y')
-        ax1.set_title('Raw signals')
-
-        lines = plot1 + plot2 + timestamp_ticks #line handle for legend
-        labels = [l.get_label() for l in lines]  #get legend labels
-        legend = ax1.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.98, 0.50)) #add legend
-        plt.close()
-    else:
-        RAW_FIGURE_A = 0
-
-    if ID_B != 'nan':
-        #Graph for Setup B
-        #Creating a graph of the raw data and time stamps for reference
-        RAW_FIGURE_B, ax1=plt.subplots()  # create a plot to allow for dual y-axes plotting
-        plot1=ax1.plot(signal_ts_B, signal_B, 'g', label='Signal') #plot dLight on left y-axis
-        ax2=plt.twinx()# create a right y-axis, sharing x-axis on the same plot
-        plot2=ax2.plot(ISOS_ts_B, ISOS_B, 'y', label='Isosbestic') # plot TdTomato on right y-axis
-
-        # Plot epochs as lines.
-        timestamp_ticks = ax1.plot(TIMESTAMPS_B.ts, np.full(np.size(TIMESTAMPS_B.ts), max(signal_B)), label='Timestamps', color='w', marker="|", mec = "k")
-
-        ax1.set_ylim(min(signal_B) - 20, max(signal_B)+ 10)
-        ax2.set_ylim(min(ISOS_B)-10 , max(signal_B)-20)
-        ax1.set_xlabel('Time (milliseconds)')
-        ax1.set_ylabel('Signal (mV)', color='g')
-        ax2.set_ylabel('Isosbestic (mV)', color='y')
-        ax1.set_title('Raw signals')
-
-        lines = plot1 + plot2 + timestamp_ticks #line handle for legend
-        labels = [l.get_label() for l in lines]  #get legend labels
-        legend = ax1.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.98, 0.50)) #add legend
-        plt.close()
-    else:
-        RAW_FIGURE_B = 0
-
-
-    return ID_A, ID_B, INFO_A, INFO_B, OUTPUTS_A, OUTPUTS_B, TIMESTAMPS_A, TIMESTAMPS_B, SAMPLING_RATE_A, SAMPLING_RATE_B, RAW_FIGURE_A, RAW_FIGURE_B
\ No newline at end of file
+        sessions[setup] = (INFO, OUTPUTS, TIMESTAMPS, SAMPLING_RATE)
+
+    return sessions
+
+
+## This function stacks the outputs of setups recorded at the same sampling rate into (setups x samples) arrays
+def stack_outputs(outputs):
+    #The preprocessing stages then run once along the last axis for all the setups. The streams must have the same
+    #length, so a stacked setup keeps every sample as it does when it is preprocessed on its own, and the time bases
+    #are the same for every setup.
+    for stream in ('ISOS', 'signal'):
+        lengths = sorted({len(output[stream]) for output in outputs})
+        if len(lengths) > 1:
+            raise ValueError(f'Only streams of the same length can be stacked, the {stream} streams have {lengths} samples')
+    return {
+        'ISOS': np.stack([output['ISOS'] for output in outputs]),
+        'ISOS_ts': outputs[0]['ISOS_ts'],
+        'signal': np.stack([output['signal'] for output in outputs]),
+        'signal_ts': outputs[0]['signal_ts']
+    }
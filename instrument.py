@@ -0,0 +1,185 @@
+"""
+This code records the wall time, CPU time, peak memory and number of samples of every stage of a run.
+Stages are marked with the stage context manager or the timed decorator, and every record carries the labels
+(row, treatment, setup, mouse ID, ...) of the context it ran in, so the records of one setup can be written to
+its manifest (manifest.json and manifest.csv next to info.csv).
+Nothing is recorded until enable is called, a disabled stage costs one check of ENABLED.
+CPU time is the time of the thread running the stage. Peak memory is measured with tracemalloc, which traces the
+whole process and keeps a single peak. The peak is only reset when a stage opens while no other thread has a stage
+open, so a stage never loses the peak of another thread's stage. A stage that overlaps a stage of another thread
+(the prefetch thread, the writer pool or the figure pool) is recorded with shared_peak set: its peak_memory_mb also
+counts the allocations of the other threads, and can include a peak reached before it started, so it is an upper bound.
+"""
+import numpy as np
+import pandas as pd
+import contextlib
+import functools
+import threading
+import tracemalloc
+import cProfile
+import time
+import json
+import os
+
+ENABLED = False
+
+#Records of this process, the labels and open stages of each thread, and the open stages of every thread.
+RECORDS = []
+_lock = threading.Lock()
+_local = threading.local()
+_open = []
+
+## This function turns the instrumentation on in this process, tracing memory unless memory is False
+def enable(memory = True):
+    global ENABLED
+    ENABLED = True
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+## This function returns the labels of the current thread
+def labels():
+    return dict(getattr(_local, 'labels', {}))
+
+
+## This context manager adds labels to every stage recorded in the current thread until it exits
+@contextlib.contextmanager
+def context(**new_labels):
+    previous = getattr(_local, 'labels', {})
+    _local.labels = dict(previous, **new_labels)
+    try:
+        yield
+    finally:
+        _local.labels = previous
+
+
+## This function wraps function so it runs with the labels of the calling thread, for work sent to a thread pool
+def bind(function):
+    if not ENABLED:
+        return function
+    bound_labels = labels()
+
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        with context(**bound_labels):
+            return function(*args, **kwargs)
+    return run
+
+
+## This function counts the samples of a stage input, the length of the last axis of an array or of the first array in a dictionary
+def count_samples(value):
+    if isinstance(value, dict):
+        value = next((column for column in value.values() if np.ndim(column) > 0), None)
+    if value is None or np.ndim(value) == 0:
+        return None
+    return int(np.shape(value)[-1])
+
+
+## This context manager records one stage, stages opened inside it are recorded with it as their parent
+@contextlib.contextmanager
+def stage(name, samples = None, **stage_labels):
+    if not ENABLED:
+        yield
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    memory = tracemalloc.is_tracing()
+    entry = {'name': name, 'start_memory': 0, 'peak': 0, 'shared': False}
+    with _lock:
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            entry['start_memory'] = entry['peak'] = current
+            #the peak so far belongs to the stages that are already open, tracemalloc only keeps one peak
+            for other in _open:
+                other['peak'] = max(other['peak'], peak)
+            #the peak is reset only when every open stage is in this thread, the stages of other threads keep theirs
+            others = [other for other in _open if not any(other is own for own in stack)]
+            if others:
+                entry['shared'] = True
+                for other in others:
+                    other['shared'] = True
+            else:
+                tracemalloc.reset_peak()
+        _open.append(entry)
+    stack.append(entry)
+
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - start_wall, time.thread_time() - start_cpu
+        stack.pop()
+        with _lock:
+            _open[:] = [other for other in _open if other is not entry]
+            if memory:
+                entry['peak'] = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1]['peak'] = max(stack[-1]['peak'], entry['peak'])
+                    stack[-1]['shared'] = stack[-1]['shared'] or entry['shared']
+        record = dict(labels(), **stage_labels)
+        record.update({
+            'stage': name,
+            'parent': stack[-1]['name'] if stack else '',
+            'wall_time': wall,
+            'cpu_time': cpu,
+            'peak_memory_mb': (entry['peak'] - entry['start_memory'])/2**20 if memory else None,
+            'shared_peak': entry['shared'] if memory else None,
+            'samples': samples,
+            'thread': threading.current_thread().name
+        })
+        with _lock:
+            RECORDS.append(record)
+
+
+## This decorator records every call of a function as a stage named after it, counting the samples of its first argument
+def timed(function):
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        if not ENABLED:
+            return function(*args, **kwargs)
+        with stage(function.__name__, samples = count_samples(args[0]) if args else None):
+            return function(*args, **kwargs)
+    return run
+
+
+## This function returns the records whose labels match the given ones, a record without a label matches any value of it
+def select(**match):
+    with _lock:
+        return [record for record in RECORDS
+                if all(record.get(label) in (None, value) for label, value in match.items())]
+
+
+## This function removes the records whose labels all equal the given ones, once their manifests are written
+def release(**match):
+    #Long batches and queue workers release the records of each session and subject, so the records do not grow
+    #with the length of the run. Returns the number of records removed.
+    with _lock:
+        kept = [record for record in RECORDS if not all(record.get(label) == value for label, value in match.items())]
+        removed = len(RECORDS) - len(kept)
+        RECORDS[:] = kept
+    return removed
+
+
+## This function writes records to {path}.json and {path}.csv
+def write_manifest(path, records):
+    with open(path + '.json', 'w') as f:
+        json.dump(records, f, indent = 1, default = lambda value: value.item() if hasattr(value, 'item') else str(value))
+    pd.DataFrame(records).to_csv(path + '.csv')
+
+
+## This context manager runs its block under cProfile and dumps the profile to path, when enabled is True
+@contextlib.contextmanager
+def profile(path, enabled = True):
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        profiler.dump_stats(path)
@@ -0,0 +1,108 @@
+"""
+This code reads the optional 'options' sheet of the settings excel file.
+Each row of the sheet has an option name in the 'option' column and its value in the 'value' column.
+Any option that is left out (or left blank) falls back to the default below.
+"""
+import pandas as pd
+
+DEFAULT_OPTIONS = {
+    #Number of worker processes used by data_extract.py, 1 runs the batch in this process and 0 uses every core.
+    'workers': 1,
+    #With one worker: the number of sessions held at once while the next tanks are read ahead and the outputs are
+    #written, and the number of threads writing the outputs.
+    'sessions_in_flight': 2,
+    'writer_workers': 2,
+    #Queue runs (--queue, see work_queue.py): a job whose lease has not been touched for lease_timeout seconds is taken
+    #over by another worker, and running jobs touch their lease every heartbeat_interval seconds.
+    'lease_timeout': 120,
+    'heartbeat_interval': 10,
+    #Sampling rate (Hz) the filtered data is decimated to before the later preprocessing stages, blank keeps the full rate.
+    'decimate_rate': None,
+    #Rate (Hz) of the binned copy the photobleaching fits run on, blank fits every sample,
+    #and whether to warm start the fits from the latest other session of the same mouse.
+    'fit_rate': 10,
+    'reuse_fit_params': False,
+    #Write csv copies of every preprocessing stage (and timestamps.csv) next to the binary store in data_extract.py.
+    'export_csv': False,
+    #Figures rendered for each setup (comma separated) and the number of threads rendering them in the background,
+    #0 renders them before moving on.
+    'figures': 'raw, filtered, exp_fit, detrended, motion, dF_F, zscore',
+    'figure_workers': 2,
+    #Preprocessing stages saved to the store (comma separated), stages left out (and not drawn in a figure)
+    #are overwritten in place to save memory.
+    'export_stages': 'raw_data, filtered_data, detrended_data, motion_corrected_data, normalised_data',
+    #Size limit (GB) of the stage cache in the output directory, 0 (the default) turns the cache off. The cache keeps a
+    #copy of every stage of every setup, raw streams included, so it can take as much disk as the exports again.
+    'cache_size': 0,
+    #Build the min/max/mean pyramid of every saved trace next to the store, for browsing at any zoom (pyramid.py).
+    'pyramid': True,
+    #dtype of the preprocessed signals, float32 halves their memory (time bases always stay float64).
+    'dtype': 'float64',
+    #Sliding windows (seconds) for the motion correction regression and the z-score, blank uses the whole session.
+    'motion_window': None,
+    'zscore_window': None,
+    #F0 of dF/F: the photobleaching 'fit', or the 'mean' or baseline_percentile 'percentile' of the filtered signal
+    #over a sliding window of baseline_window seconds.
+    'baseline': 'fit',
+    'baseline_window': 60,
+    'baseline_percentile': 10,
+    #Put the first sample of each stream at the start of the stream instead of one sample interval after it.
+    'sample_accurate_time': False,
+    #Tank reader: 'tdt' (tdt.read_block) or 'memmap' (tank_reader.py, maps the tank files instead of copying the streams).
+    'tank_reader': 'tdt',
+    #Record the time, CPU time, peak memory and samples of every stage to a manifest next to info.csv,
+    #and run the session of one setup ('<treatment>/<mouse ID>') under cProfile.
+    'instrument': False,
+    'profile_session': None,
+    #Downsampling of the normalised data in data_analysis.py.
+    #downsample_rate (Hz) takes priority over downsample_factor (samples per block) when it is set.
+    'downsample_factor': 10,
+    'downsample_rate': None,
+    #Alignment of the event timestamps to the downsampled data, 'nearest' or 'floor',
+    #with a tolerance in seconds (blank = half a sample for 'nearest' and one sample for 'floor').
+    'event_alignment': 'nearest',
+    'event_tolerance': None,
+    #Peri-event windows in data_analysis.py, seconds before and after each event,
+    #and whether each event type is also exported as a wide csv next to its .npz file.
+    'window_pre': 20,
+    'window_post': 60,
+    'export_wide_csv': True,
+    #Collect the windows of every subject into the event cube of the output directory for group queries (event_cube.py).
+    'event_cube': True,
+    #Detect transients and measure the response to every event (transients.py): transients need a prominence of
+    #transient_prominence times the robust noise and a width of transient_width seconds, and the peak, post event
+    #area and post event transient rate are taken over the first response_window seconds (blank = window_post).
+    'event_metrics': True,
+    'transient_prominence': 3,
+    'transient_width': 0.2,
+    'response_window': None,
+}
+
+## This function reads the options sheet and fills in the defaults for anything missing
+def read_options(settings_path):
+    options = dict(DEFAULT_OPTIONS)
+
+    try:
+        sheet = pd.read_excel(settings_path, sheet_name = 'options')
+    except ValueError:
+        #the settings file has no options sheet so the defaults are used
+        return options
+
+    for option, value in zip(sheet['option'], sheet['value']):
+        option = str(option).strip()
+        if option not in DEFAULT_OPTIONS:
+            raise ValueError(f"Unknown option '{option}' in the options sheet of {settings_path}")
+        if pd.isna(value):
+            continue
+        if isinstance(value, str) and value.strip().lower() in ('true', 'false'):
+            value = value.strip().lower() == 'true'
+        options[option] = value
+
+    return options
+
+
+## This function splits a comma separated option into a list
+def option_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [item.strip() for item in str(value).split(',') if item.strip()]
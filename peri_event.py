@@ -0,0 +1,182 @@
+"""
+This code defines the array functions used by data_analysis.py to build the peri-event data.
+1. Downsampling of the normalised data into block means.
+2. Alignment of event timestamps to samples of the (downsampled) time axis.
+3. Extraction of peri-event windows into events x samples x metrics arrays, with an optional wide csv export.
+"""
+import numpy as np
+import pandas as pd
+import os
+import instrument
+import data_store
+from time_base import TimeBase
+
+## This function works out how many samples go into each downsampled block
+def downsample_factor(sampling_rate = None, factor = None, target_rate = None):
+    #A target rate takes priority over a fixed factor, the factor is rounded to the nearest whole number of samples.
+    if target_rate is not None:
+        if sampling_rate is None:
+            raise ValueError('A sampling rate is needed to downsample to a target rate')
+        factor = int(round(float(sampling_rate)/float(target_rate)))
+    if factor is None:
+        raise ValueError('Either a downsample factor or a target rate is needed')
+    return max(1, int(factor))
+
+
+## This function computes block means of an array along the first axis in a single pass
+def block_mean(values, factor):
+    #Binning rule: the samples are split into consecutive, non-overlapping blocks of `factor` samples starting at sample 0.
+    #Every sample belongs to exactly one block and each output value is the mean of its block.
+    #If the recording length is not a multiple of the factor the last block is shorter and is averaged over the samples it has.
+    values = np.asarray(values)
+    length = values.shape[0]
+    if length == 0:
+        return values.astype(np.float64)
+
+    starts = np.arange(0, length, factor)
+    sums = np.add.reduceat(values, starts, axis = 0, dtype = np.float64)
+    counts = np.diff(np.append(starts, length))
+    return sums/counts.reshape((-1,) + (1,)*(values.ndim - 1))
+
+
+## This function downsamples the time, dF_F and zscore columns of the normalised data
+@instrument.timed
+def downsample(normalised_data, sampling_rate = None, factor = None, target_rate = None, columns = ('time', 'dF_F', 'zscore')):
+    #normalised_data can be the dictionary returned by preprocessing_v2.normalisation or a DataFrame read from normalised_data.csv
+    #A TimeBase time column is downsampled to another TimeBase, see TimeBase.block_mean.
+    factor = downsample_factor(sampling_rate, factor, target_rate)
+    time_bases = {column: normalised_data[column].block_mean(factor) for column in columns if isinstance(normalised_data[column], TimeBase)}
+    array_columns = [column for column in columns if column not in time_bases]
+    stacked = np.column_stack([np.asarray(normalised_data[column], dtype = np.float64) for column in array_columns])
+    means = block_mean(stacked, factor)
+
+    shortened_data = {column: time_bases[column] if column in time_bases else means[:, array_columns.index(column)] for column in columns}
+    return shortened_data, factor
+
+
+## This function matches every event time to a sample of a monotonic time axis using a binary search
+@instrument.timed
+def align_events(time, event_times, mode = 'nearest', tolerance = None):
+    #mode 'nearest' picks the closest sample, mode 'floor' picks the last sample at or before the event.
+    #An event is aligned when it is within `tolerance` seconds of its sample, by default half a sample interval
+    #for 'nearest' and one sample interval for 'floor'. Events that cannot be aligned get a sample of -1.
+    #A TimeBase time axis converts the event times to samples directly instead of searching the time array.
+    event_times = np.asarray(event_times, dtype = np.float64)
+    length = len(time)
+
+    if mode not in ('nearest', 'floor'):
+        raise ValueError(f"Unknown event alignment mode '{mode}', use 'nearest' or 'floor'")
+    if length == 0:
+        samples = np.full(len(event_times), -1)
+        return {'sample': samples, 'aligned': np.zeros(len(event_times), dtype = bool), 'distance': np.full(len(event_times), np.nan)}
+    if isinstance(time, TimeBase):
+        interval = 1/time.fs if length > 1 else np.inf
+    else:
+        time = np.asarray(time, dtype = np.float64)
+        if np.any(np.diff(time) < 0):
+            raise ValueError('The time axis must be monotonic to align events')
+        interval = (time[-1] - time[0])/(length - 1) if length > 1 else np.inf
+
+    if tolerance is None or tolerance != tolerance:
+        tolerance = interval/2 if mode == 'nearest' else interval
+
+    if isinstance(time, TimeBase):
+        samples = time.index(event_times, mode)
+        samples = np.clip(samples, 0, length - 1) if mode == 'nearest' else np.minimum(samples, length - 1)
+    elif mode == 'nearest':
+        right = np.clip(np.searchsorted(time, event_times, side = 'left'), 0, length - 1)
+        left = np.clip(right - 1, 0, length - 1)
+        use_left = np.abs(event_times - time[left]) <= np.abs(time[right] - event_times)
+        samples = np.where(use_left, left, right)
+    else:
+        samples = np.searchsorted(time, event_times, side = 'right') - 1
+
+    distance = np.full(len(event_times), np.nan)
+    inside = samples >= 0
+    distance[inside] = event_times[inside] - time[samples[inside]]
+    aligned = inside & (np.abs(distance) <= tolerance)
+    samples = np.where(aligned, samples, -1)
+
+    return {'sample': samples, 'aligned': aligned, 'distance': distance}
+
+
+## This function gives the sample offsets of a window from `pre` seconds before to `post` seconds after an event
+def window_offsets(sampling_rate, pre, post):
+    #Both ends are rounded to the nearest sample and included, so sample 0 of the window is the event itself.
+    return np.arange(-int(round(pre*sampling_rate)), int(round(post*sampling_rate)) + 1)
+
+
+## This function gathers the window around every event sample into an events x samples x metrics array
+def extract_windows(values, samples, offsets):
+    #values is samples x metrics (or a single 1-D trace). Window samples that fall outside the recording
+    #are padded with NaN and marked False in the returned valid mask (events x samples).
+    values = np.asarray(values, dtype = np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    length = values.shape[0]
+    samples = np.asarray(samples, dtype = np.int64)
+
+    index = samples[:, None] + np.asarray(offsets)[None, :]
+    valid = (index >= 0) & (index < length)
+    windows = values[np.clip(index, 0, max(length - 1, 0))]
+    windows[~valid] = np.nan
+
+    return windows, valid
+
+
+## This function builds the peri-event windows of every event type found in the notes
+@instrument.timed
+def peri_event_windows(data, event_index, notes, sampling_rate, pre = 20, post = 60, metrics = ('dF_F', 'zscore')):
+    #event_index is the output of align_events for the same time axis as data, unaligned events are left out.
+    #Returns a dictionary with one entry per event type (in order of first appearance) holding:
+    #time (window time in seconds), data (events x samples x metrics), valid (events x samples),
+    #sample (event sample in data), event_time (time of that sample) and metrics (names of the last axis).
+    values = np.column_stack([np.asarray(data[metric], dtype = np.float64) for metric in metrics])
+    time = data['time'] if isinstance(data['time'], TimeBase) else np.asarray(data['time'], dtype = np.float64)
+    offsets = window_offsets(sampling_rate, pre, post)
+    notes = np.asarray(notes).astype(str)
+    names = list(dict.fromkeys(notes.tolist()))
+
+    windows = {}
+    for name in names:
+        samples = event_index['sample'][event_index['aligned'] & (notes == name)]
+        event_data, valid = extract_windows(values, samples, offsets)
+        windows[name] = {
+            'time': offsets/sampling_rate,
+            'data': event_data,
+            'valid': valid,
+            'sample': samples,
+            'event_time': time[samples],
+            'metrics': list(metrics)
+        }
+
+    return windows
+
+
+## This function writes the windows of one event type as a wide csv, one column pair per event
+def write_wide_csv(window, name, output_path):
+    #Column layout: ('time', 'time'), then ({name}_{event}, metric) for every event and metric.
+    n_events, n_samples, n_metrics = window['data'].shape
+    columns = [('time', 'time')] + [(f'{name}_{x}', metric) for x in range(n_events) for metric in window['metrics']]
+    values = np.column_stack([window['time'], window['data'].transpose(1, 0, 2).reshape(n_samples, n_events*n_metrics)])
+    wide_data = pd.DataFrame(values, columns = pd.MultiIndex.from_tuples(columns))
+    with data_store.temporary_file(output_path) as temporary:
+        wide_data.to_csv(temporary)
+
+
+## This function saves the windows of every event type to the timestamped data folder
+@instrument.timed
+def save_windows(windows, output_dir, csv = True):
+    #Each event type is saved as {name}.npz holding the window arrays, and as {name}.csv when csv is True.
+    for name, window in windows.items():
+        with data_store.temporary_file(os.path.join(output_dir, f'{name}.npz')) as temporary, open(temporary, 'wb') as f:
+            np.savez(f,
+                     time = window['time'],
+                     data = window['data'],
+                     valid = window['valid'],
+                     sample = window['sample'],
+                     event_time = window['event_time'],
+                     metrics = np.array(window['metrics'])
+                     )
+        if csv:
+            write_wide_csv(window, name, os.path.join(output_dir, f'{name}.csv'))
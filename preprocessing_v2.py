@@ -1,18 +1,87 @@
 """
 This code defines functions to preprocess the data.
-1. Low Pass - Zero Phase Filter to 'denoise' the signal.
+1. Low Pass - Zero Phase Filter to 'denoise' the signal, optionally followed by decimation to a lower sampling rate.
 2. Photobleaching Correction (either High Pass Filtering or Double Exponential Fitting)
 3. Motion Correction
 4. Normalisation (both dF/F or z-Score)
+Motion correction, the z-score and the dF/F baseline can also be computed over a sliding window instead of the
+whole session. The window means and (co)variances come from prefix sums, so they cost the same for any window length.
+
+The time bases are TimeBase objects (see time_base.py) or arrays of sample times.
+dtype policy: zero_phase_filter sets the dtype of the signal arrays (float64 by default, float32 halves their memory)
+and every later stage returns arrays of the same dtype as its input. Fits, regressions, means and standard deviations
+are always computed in float64. Time bases always stay float64, as float32 cannot resolve 1 kHz sample times after ~2 hours.
+With inplace=True a stage writes its output into the arrays of its input, which are then no longer valid,
+for use when the input stage is not exported.
+The signal arrays are either one recording (1-D) or several setups stacked as (setups x samples) by
+import_tank_v2.stack_outputs, every stage works along the last axis, and the time bases are always 1-D.
+For stacked data the fit reports and motion fits are lists with one entry per setup.
+The stages only return data, the figures are drawn from it by figures.py.
 """
 import numpy as np
-import matplotlib.pyplot as plt
 import scipy
-
-def zero_phase_filter(outputs, sampling_rate, timestamps):
-    b, a = scipy.signal.butter(2, 10, btype = 'low', fs = sampling_rate)
-    filtered_signal = scipy.signal.filtfilt(b, a, outputs['signal'] )
-    filtered_ISOS = scipy.signal.filtfilt(b, a, outputs['ISOS'])
+import scipy.ndimage
+import time
+import peri_event
+import instrument
+from time_base import TimeBase
+
+def filter_margin(sos, tolerance = 1e-12):
+    #Number of samples after which the impulse response of the filter has decayed below tolerance,
+    #used as the overlap between blocks in zero_phase_filter_chunks.
+    poles = scipy.signal.sos2zpk(sos)[1]
+    radius = np.max(np.abs(poles)) if len(poles) else 0
+    if radius <= 0:
+        return 1
+    return int(np.ceil(np.log(tolerance)/np.log(radius)))
+
+
+def zero_phase_filter_chunks(chunks, sos, block_size = 2**18, margin = None):
+    #Streaming version of scipy.signal.sosfiltfilt. Takes any iterable of arrays with the samples along the last axis
+    #(e.g. blocks read from the tank, or blocks of stacked setups) and yields the filtered recording in order. Each block is filtered forwards and backwards together with
+    #`margin` samples of its neighbours on both sides and only its centre is kept, so memory scales with
+    #block_size + 2*margin rather than the recording length. The start and end of the recording are padded
+    #exactly as sosfiltfilt (and filtfilt) pad them, and with the default margin the output matches
+    #the full-length filter to within 1e-9 of the signal amplitude.
+    margin = filter_margin(sos) if margin is None else margin
+    history = None
+
+    for chunk in chunks:
+        if history is None:
+            history = np.empty(np.shape(chunk)[:-1] + (0,))
+            pending = history
+        for start in range(0, np.shape(chunk)[-1], block_size):
+            pending = np.concatenate([pending, np.asarray(chunk[..., start:start + block_size], dtype = np.float64)], axis = -1)
+            if pending.shape[-1] <= block_size + margin:
+                continue
+            block = np.concatenate([history, pending], axis = -1)
+            ready = pending.shape[-1] - margin
+            filtered = scipy.signal.sosfiltfilt(sos, block, axis = -1)
+            yield filtered[..., history.shape[-1]:history.shape[-1] + ready]
+            history = block[..., :history.shape[-1] + ready][..., -margin:]
+            pending = pending[..., ready:]
+
+    if history is not None and pending.shape[-1] > 0:
+        yield scipy.signal.sosfiltfilt(sos, np.concatenate([history, pending], axis = -1), axis = -1)[..., history.shape[-1]:]
+
+
+def zero_phase_filter_array(x, sos, block_size = 2**18, out = None, dtype = np.float64):
+    #Filters a whole array along its last axis with zero_phase_filter_chunks, writing the blocks into a single output array of the given dtype.
+    out = np.empty(np.shape(x), dtype = dtype) if out is None else out
+    position = 0
+    for filtered in zero_phase_filter_chunks([x], sos, block_size = block_size):
+        out[..., position:position + filtered.shape[-1]] = filtered
+        position += filtered.shape[-1]
+    return out
+
+
+@instrument.timed
+def zero_phase_filter(outputs, sampling_rate, block_size = 2**18, dtype = np.float64):
+    #2nd order 10 Hz low-pass butterworth as second-order sections, run forwards and backwards in overlapping blocks.
+    #Each block is filtered in float64 and stored in arrays of the given dtype.
+    sos = scipy.signal.butter(2, 10, btype = 'low', fs = sampling_rate, output = 'sos')
+    filtered_signal = zero_phase_filter_array(outputs['signal'], sos, block_size = block_size, dtype = dtype)
+    filtered_ISOS = zero_phase_filter_array(outputs['ISOS'], sos, block_size = block_size, dtype = dtype)
 
     filtered_data = {
         'filtered_signal' : filtered_signal,
@@ -21,40 +90,106 @@ def zero_phase_filter(outputs, sampling_rate, timestamps):
         'ISOS_ts': outputs['ISOS_ts']
     }
 
-    #Creating a graph of the raw data and time stamps for reference
-    #Plot signals
-    filtered_figure,ax1=plt.subplots()  # create a plot to allow for dual y-axes plotting
-    plot1=ax1.plot(outputs['signal_ts'], filtered_signal, 'g', label='Signal')
-    ax2=plt.twinx()# create a right y-axis, sharing x-axis on the same plot
-    plot2=ax2.plot(outputs['ISOS_ts'], filtered_ISOS, 'y', label='ISOS')
-    plot3= ax1.plot(outputs['signal_ts'], outputs['signal'], 'g', alpha = 0.3, label = 'Signal Raw' )
-    plot4= ax2.plot(outputs['ISOS_ts'], outputs['ISOS'], 'y', alpha = 0.3, label = 'ISOS Raw' )
-
-    # Plot epochs as lines.
-    timestamp_ticks = ax1.plot(timestamps.ts, np.full(np.size(timestamps.ts), max(filtered_signal)), label='Timestamps', color='w', marker="|", mec = "k")
-
-
-    ax1.set_ylim(min(filtered_signal) - 20, max(filtered_signal)+ 10)
-    ax2.set_ylim(min(filtered_ISOS)-10 , max(filtered_signal)-20)
-    ax1.set_xlabel('Time (seconds)')
-    ax1.set_ylabel('Filtered Signal (mV)', color='g')
-    ax2.set_ylabel('Filtered ISOS (mV)', color='y')
-    ax1.set_title('Zero Phase Filtered signals')
-
-    lines = plot1 + plot2 + plot3 + plot4 + timestamp_ticks #line handle for legend
-    labels = [l.get_label() for l in lines]  #get legend labels
-    legend = ax1.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.98, 0.50)) #add legend
-    plt.close()
-
-    #ax1.set_xlim(1000, 1010) #Optional setting of a smaller window for the plot
-
-    return filtered_data, filtered_figure
-
+    return filtered_data
+
+
+@instrument.timed
+def decimate(filtered_data, sampling_rate, target_rate):
+    #Reduces the filtered data to roughly target_rate with a polyphase anti-aliasing FIR filter (zero phase, edges padded with a line fit).
+    #The decimation factor is the whole number of samples that keeps the rate at or above the target,
+    #the time base keeps every factor-th timestamp so it stays aligned with the decimated samples.
+    if target_rate < 20:
+        raise ValueError(f'A decimation rate of {target_rate} Hz would remove part of the 10 Hz low-pass band, use at least 20 Hz')
+    factor = int(sampling_rate // target_rate)
+    if factor <= 1:
+        return filtered_data, sampling_rate
+
+    dtype = filtered_data['filtered_signal'].dtype
+    decimated_data = {
+        'filtered_signal' : scipy.signal.resample_poly(filtered_data['filtered_signal'], 1, factor, axis = -1, padtype = 'line').astype(dtype, copy = False),
+        'signal_ts': filtered_data['signal_ts'][::factor],
+        'filtered_ISOS': scipy.signal.resample_poly(filtered_data['filtered_ISOS'], 1, factor, axis = -1, padtype = 'line').astype(dtype, copy = False),
+        'ISOS_ts': filtered_data['ISOS_ts'][::factor]
+    }
 
-def photo_bleach_correction(filtered_data, timestamps):
-    #Fitting a double exponential curve to the filtered data, adapted from Thomas Akam's Github
-    def double_exponential(t, const, amp_fast, amp_slow, tau_slow, tau_multiplier):
-    #Compute a double exponential function with constant offset
+    return decimated_data, sampling_rate/factor
+
+
+def time_base_rate(t):
+    #Sampling rate of a time base, from its first and last sample.
+    if isinstance(t, TimeBase):
+        return t.fs
+    return (len(t) - 1)/(t[-1] - t[0]) if len(t) > 1 else 1.0
+
+
+def window_samples(t, window):
+    #Number of samples in a window of `window` seconds on the time base t, at least one.
+    return max(int(round(window*time_base_rate(t))), 1)
+
+
+def window_sums(x, window):
+    #Sums of x over a window of `window` samples centred on every sample (along the last axis), from one prefix sum,
+    #with the windows cut short at the ends of the recording. Returns the sums and the number of samples in each window.
+    length = np.shape(x)[-1]
+    cumulative = np.zeros(np.shape(x)[:-1] + (length + 1,))
+    np.cumsum(x, axis = -1, dtype = np.float64, out = cumulative[..., 1:])
+    start = np.clip(np.arange(length) - window//2, 0, length)
+    stop = np.clip(np.arange(length) - window//2 + window, 0, length)
+    return cumulative[..., stop] - cumulative[..., start], stop - start
+
+
+def sliding_mean_std(x, window):
+    #Mean and standard deviation of x over a centred window of `window` samples at every sample, in float64.
+    #x is centred on its overall mean first so the prefix sums of squares keep their precision on long recordings.
+    mean = np.mean(x, axis = -1, dtype = np.float64, keepdims = True)
+    deviation = x - mean
+    sums, count = window_sums(deviation, window)
+    squares, _ = window_sums(deviation*deviation, window)
+    del deviation
+    sums /= count
+    squares /= count
+    squares -= sums*sums
+    np.maximum(squares, 0, out = squares)
+    return mean + sums, np.sqrt(squares)
+
+
+def sliding_regression(x, y, window):
+    #Least squares fit of y = slope*x + intercept over a centred window of `window` samples at every sample, in float64.
+    #Both signals are centred on their overall means first, as in sliding_mean_std.
+    x_mean = np.mean(x, axis = -1, dtype = np.float64, keepdims = True)
+    y_mean = np.mean(y, axis = -1, dtype = np.float64, keepdims = True)
+    x_deviation = x - x_mean
+    y_deviation = y - y_mean
+    sum_x, count = window_sums(x_deviation, window)
+    sum_y, _ = window_sums(y_deviation, window)
+    sum_xy, _ = window_sums(x_deviation*y_deviation, window)
+    sum_xx, _ = window_sums(x_deviation*x_deviation, window)
+    del x_deviation, y_deviation
+    sum_xy -= sum_x*sum_y/count
+    sum_xx -= sum_x*sum_x/count
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        slope = np.nan_to_num(sum_xy/sum_xx)
+    intercept = y_mean + sum_y/count - slope*(x_mean + sum_x/count)
+    return slope, intercept
+
+
+def sliding_percentile(t, x, window, percentile, rate = 10):
+    #Running percentile of x over a centred window of `window` seconds, at every sample of the time base t.
+    #The percentile runs on block means of x at about `rate` Hz with the sorted window rank filter of scipy.ndimage,
+    #which keeps its cost low for windows of minutes, and is interpolated back to every sample.
+    factor = max(int(time_base_rate(t)//rate), 1)
+    block_t = peri_event.block_mean(np.asarray(t, dtype = np.float64), factor)
+    size = window_samples(block_t, window)
+    baseline = np.empty(np.shape(x), dtype = np.float64)
+    for channel in np.ndindex(np.shape(x)[:-1]):
+        blocks = peri_event.block_mean(np.asarray(x[channel], dtype = np.float64), factor)
+        blocks = scipy.ndimage.percentile_filter(blocks, percentile, size = size, mode = 'nearest')
+        baseline[channel] = np.interp(t, block_t, blocks)
+    return baseline
+
+
+def double_exponential(t, const, amp_fast, amp_slow, tau_slow, tau_multiplier):
+    #Compute a double exponential function with constant offset, adapted from Thomas Akam's Github
     #Parameters:
     #t       : Time vector in seconds.
     #const   : Amplitude of the constant offset. 
@@ -62,172 +197,224 @@ def photo_bleach_correction(filtered_data, timestamps):
     #amp_slow: Amplitude of the slow component.  
     #tau_slow: Time constant of slow component in seconds.
     #tau_multiplier: Time constant of fast component relative to slow. 
-        tau_fast = tau_slow*tau_multiplier
-        return const+amp_slow*np.exp(-t/tau_slow)+amp_fast*np.exp(-t/tau_fast)
-    
-    # Fit curve to signal.
-    max_sig = np.max(filtered_data['filtered_signal'])
-    inital_params = [max_sig/2, max_sig/4, max_sig/4, 3600, 0.1]
-    bounds = ([0      , 0      , 0      , 600  , 0],
-            [max_sig, max_sig, max_sig, 36000, 1])
-    signal_parms, parm_cov = scipy.optimize.curve_fit(double_exponential,
-                                                      filtered_data['signal_ts'],
-                                                      filtered_data['filtered_signal'],
-                                                      p0=inital_params,
-                                                      bounds=bounds,
-                                                      maxfev=1000
-                                                      )
-    signal_expfit = double_exponential(filtered_data['signal_ts'], *signal_parms)
-
-    # Fit curve to ISOS signal.
-    max_sig = np.max(filtered_data['filtered_ISOS'])
-    inital_params = [max_sig/2, max_sig/4, max_sig/4, 3600, 0.1]
+    tau_fast = tau_slow*tau_multiplier
+    return const+amp_slow*np.exp(-t/tau_slow)+amp_fast*np.exp(-t/tau_fast)
+
+
+def double_exponential_jacobian(t, const, amp_fast, amp_slow, tau_slow, tau_multiplier):
+    #Analytic partial derivatives of double_exponential with respect to each parameter (one column per parameter).
+    tau_fast = tau_slow*tau_multiplier
+    slow = np.exp(-t/tau_slow)
+    fast = np.exp(-t/tau_fast)
+    with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+        d_tau_slow = amp_slow*slow*t/tau_slow**2 + amp_fast*fast*t/(tau_slow*tau_fast)
+        d_tau_multiplier = amp_fast*fast*t/(tau_fast*tau_multiplier)
+    return np.nan_to_num(np.column_stack([np.ones_like(t), fast, slow, d_tau_slow, d_tau_multiplier]))
+
+
+@instrument.timed
+def fit_double_exponential(t, y, fit_rate = None, initial_params = None):
+    #Fits double_exponential to y with the analytic jacobian and returns the parameters and a fit report.
+    #The parameters are scaled by the jacobian columns, without this the exact jacobian converges more slowly than
+    #numerical derivatives on short recordings where the time constants are poorly determined.
+    #With a fit_rate (Hz) the fit runs on block means of the data at about that rate, which is enough for
+    #bleaching time constants of minutes, and the residuals are then measured on the full time base.
+    #initial_params (e.g. a previous fit) are used as a warm start and the default guess is the fallback if that fit fails.
+    start_time = time.perf_counter()
+    dtype = np.asarray(y).dtype if np.asarray(y).dtype.kind == 'f' else np.float64
+    t = np.asarray(t, dtype = np.float64)
+    y = np.asarray(y, dtype = np.float64)
+    max_sig = np.max(y)
+    default_params = [max_sig/2, max_sig/4, max_sig/4, 3600, 0.1]
     bounds = ([0      , 0      , 0      , 600  , 0],
             [max_sig, max_sig, max_sig, 36000, 1])
-    ISOS_parms, parm_cov = scipy.optimize.curve_fit(double_exponential,
-                                      filtered_data['ISOS_ts'],
-                                      filtered_data['filtered_ISOS'],
-                                      p0=inital_params,
-                                      bounds=bounds,
-                                      maxfev=1000
-                                      )
-    ISOS_expfit = double_exponential(filtered_data['ISOS_ts'], *ISOS_parms)
-
-    #plot fits over filtered data
-    exponential_fit_figure,ax1=plt.subplots()  
-    plot1=ax1.plot(filtered_data['signal_ts'], filtered_data['filtered_signal'], color = 'g', label='Signal')
-    plot3=ax1.plot(filtered_data['signal_ts'], signal_expfit, color='k', linewidth=1.5, label='Exponential fit') 
-    ax2=plt.twinx()
-    plot2=ax2.plot(filtered_data['ISOS_ts'], filtered_data['filtered_ISOS'], color='y', label='ISOS') 
-    plot4=ax2.plot(filtered_data['ISOS_ts'], ISOS_expfit, color='k', linewidth=1.5) 
-
-
-    ax1.set_xlabel('Time (seconds)')
-    ax1.set_ylabel('Signal (mV)', color='g')
-    ax2.set_ylabel('ISOS (mV)', color='y')
-    ax1.set_title('Filtered signals with double exponential fits')
-
-    lines = plot1 + plot2 + plot3 + plot4
-    labels = [l.get_label() for l in lines]  
-    legend = ax1.legend(lines, labels, loc='upper right')
-
-    ax1.set_ylim(min(filtered_data['filtered_signal']) - 20, max(filtered_data['filtered_signal'])+ 10)
-    ax2.set_ylim(min(filtered_data['filtered_ISOS'])-10 , max(filtered_data['filtered_signal'])-20)
-    plt.close()
+
+    fit_t, fit_y = t, y
+    if fit_rate is not None and len(t) > 1:
+        factor = int((len(t) - 1)/(t[-1] - t[0])//fit_rate)
+        if factor > 1:
+            fit_t = peri_event.block_mean(t, factor)
+            fit_y = peri_event.block_mean(y, factor)
+
+    attempts = [] if initial_params is None else [('warm start', initial_params)]
+    attempts.append(('default', default_params))
+    for start, params in attempts:
+        #starting parameters must lie strictly inside the bounds
+        lower, upper = np.array(bounds[0], dtype = np.float64), np.array(bounds[1], dtype = np.float64)
+        margin = 1e-6*(upper - lower)
+        params = np.clip(np.asarray(params, dtype = np.float64), lower + margin, upper - margin)
+        try:
+            fit_params, parm_cov, infodict, message, ier = scipy.optimize.curve_fit(double_exponential,
+                                                                                    fit_t,
+                                                                                    fit_y,
+                                                                                    p0=params,
+                                                                                    bounds=bounds,
+                                                                                    jac=double_exponential_jacobian,
+                                                                                    x_scale='jac',
+                                                                                    maxfev=1000,
+                                                                                    full_output=True
+                                                                                    )
+            break
+        except RuntimeError:
+            if start == 'default':
+                raise
+
+    expfit = double_exponential(t, *fit_params)
+    residuals = y - expfit
+    expfit = expfit.astype(dtype, copy = False)
+    fit_report = {
+        'params': [float(x) for x in fit_params],
+        'start': start,
+        'fit_samples': int(len(fit_t)),
+        'iterations': int(infodict['nfev']),
+        'fit_time': time.perf_counter() - start_time,
+        'residual_rms': float(np.sqrt(np.mean(residuals**2))),
+        'r_squared': float(1 - np.sum(residuals**2)/np.sum((y - np.mean(y))**2))
+    }
+
+    return expfit, fit_report
+
+
+@instrument.timed
+def photo_bleach_correction(filtered_data, fit_rate = None, initial_params = None, baseline = 'fit', baseline_window = 60,
+                            baseline_percentile = 10, inplace = False):
+    #Fitting a double exponential curve to the filtered data.
+    #fit_rate and initial_params are passed to fit_double_exponential, initial_params is a dictionary with
+    #'signal' and 'ISOS' parameter lists (e.g. from a previous session of the same mouse), or a list of them
+    #(or None) per setup for stacked data. The fits run per setup, the detrending runs once on the whole array.
+    #baseline sets the F0 that normalisation divides by for dF/F: the signal fit ('fit'), or the 'mean' or the
+    #baseline_percentile 'percentile' of the filtered signal over a sliding window of baseline_window seconds,
+    #which is saved as 'signal_baseline' with the fit.
+    if baseline not in ('fit', 'mean', 'percentile'):
+        raise ValueError(f"Unknown dF/F baseline '{baseline}', use 'fit', 'mean' or 'percentile'")
+    signal_baseline = None
+    if baseline == 'mean':
+        signal_baseline = sliding_mean_std(filtered_data['filtered_signal'], window_samples(filtered_data['signal_ts'], baseline_window))[0]
+    elif baseline == 'percentile':
+        signal_baseline = sliding_percentile(filtered_data['signal_ts'], filtered_data['filtered_signal'], baseline_window, baseline_percentile)
+    stacked = np.ndim(filtered_data['filtered_signal']) == 2
+    signal = np.atleast_2d(filtered_data['filtered_signal'])
+    ISOS = np.atleast_2d(filtered_data['filtered_ISOS'])
+    initial_params = initial_params if stacked and initial_params is not None else [initial_params]*len(signal)
+    signal_expfit = np.empty_like(signal)
+    ISOS_expfit = np.empty_like(ISOS)
+    fit_report = []
+
+    for channel in range(len(signal)):
+        channel_params = {} if initial_params[channel] is None else initial_params[channel]
+
+        # Fit curve to signal.
+        signal_expfit[channel], signal_report = fit_double_exponential(filtered_data['signal_ts'],
+                                                                       signal[channel],
+                                                                       fit_rate = fit_rate,
+                                                                       initial_params = channel_params.get('signal')
+                                                                       )
+
+        # Fit curve to ISOS signal, warm started from the signal fit scaled to the ISOS amplitude unless parameters were given.
+        ISOS_start = channel_params.get('ISOS')
+        if ISOS_start is None:
+            scale = np.max(ISOS[channel])/np.max(signal[channel])
+            const, amp_fast, amp_slow, tau_slow, tau_multiplier = signal_report['params']
+            ISOS_start = [const*scale, amp_fast*scale, amp_slow*scale, tau_slow, tau_multiplier]
+        ISOS_expfit[channel], ISOS_report = fit_double_exponential(filtered_data['ISOS_ts'],
+                                                                   ISOS[channel],
+                                                                   fit_rate = fit_rate,
+                                                                   initial_params = ISOS_start
+                                                                   )
+        fit_report.append({'signal': signal_report, 'ISOS': ISOS_report})
+
+    if not stacked:
+        signal_expfit, ISOS_expfit, fit_report = signal_expfit[0], ISOS_expfit[0], fit_report[0]
 
     #Creacting a dictionary with the detrended data
     detrended_data = {
-        'detrended_signal': filtered_data['filtered_signal'] - signal_expfit,
+        'detrended_signal': np.subtract(filtered_data['filtered_signal'], signal_expfit, out = filtered_data['filtered_signal'] if inplace else None),
         'signal_ts': filtered_data['ISOS_ts'],
-        'detrended_ISOS': filtered_data['filtered_ISOS'] - ISOS_expfit,
+        'detrended_ISOS': np.subtract(filtered_data['filtered_ISOS'], ISOS_expfit, out = filtered_data['filtered_ISOS'] if inplace else None),
         'ISOS_ts': filtered_data['ISOS_ts']
     }
 
     #saving the exponential fit data
     exponential_fit = {
         'signal_expfit': signal_expfit,
-        'ISOS_expfit': ISOS_expfit
+        'ISOS_expfit': ISOS_expfit,
+        'fit_report': fit_report
     }
+    if signal_baseline is not None:
+        exponential_fit['signal_baseline'] = signal_baseline.astype(signal_expfit.dtype, copy = False)
 
-    #creating a plot of the detrended data
-    detrended_figure,ax1= plt.subplots()  # create a plot to allow for dual y-axes plotting
-    plot1=ax1.plot(detrended_data['signal_ts'], detrended_data['detrended_signal'], 'g', label='Signal')
-    ax2=plt.twinx()# create a right y-axis, sharing x-axis on the same plot
-    plot2=ax2.plot(detrended_data['ISOS_ts'], detrended_data['detrended_ISOS'], 'y', label='ISOS')
-
-    # Plot epochs as lines.
-    timestamp_ticks = ax1.plot(timestamps.ts, np.full(np.size(timestamps.ts), max(detrended_data['detrended_signal'])), label='Timestamps', color='w', marker="|", mec = "k")
-
-    ax1.set_ylim(min(detrended_data['detrended_signal']) - 20, max(detrended_data['detrended_signal'])+ 10)
-    ax2.set_ylim(min(detrended_data['detrended_ISOS'])-10 , max(detrended_data['detrended_ISOS'])+20)
-    ax1.set_xlabel('Time (seconds)')
-    ax1.set_ylabel('Filtered Signal (mV)', color='g')
-    ax2.set_ylabel('Filtered ISOS (mV)', color='y')
-    ax1.set_title('Detrended signals')
+    return detrended_data, exponential_fit
 
-    lines = plot1 + plot2 + timestamp_ticks #line handle for legend
-    labels = [l.get_label() for l in lines]  #get legend labels
-    legend = ax2.legend(lines, labels, loc='lower right', bbox_to_anchor=(0.98, 0.50)) #add legend
-    plt.close()
 
-    return detrended_data, exponential_fit_figure, detrended_figure, exponential_fit
-
-
-def motion_correction(detrended_data, timestamps):
+@instrument.timed
+def motion_correction(detrended_data, window = None, inplace = False):
     #using the ISOS signal to predict the motion in the signal.
-    slope, intercept, r_value, p_value, std_err = scipy.stats.linregress(x= detrended_data['detrended_signal'], y= detrended_data['detrended_ISOS'])
-
-    motion_figure, (correlation_plot, motion_plot) = plt.subplots(nrows = 2)
-    
-    correlation_plot.scatter(detrended_data['detrended_ISOS'][::5], detrended_data['detrended_signal'][::5],alpha=0.1, marker='.')
-    x = np.array(plt.xlim())
-    correlation_plot.plot(x, intercept+slope*x)
-    correlation_plot.set_xlabel('ISOS')
-    correlation_plot.set_ylabel('Signal')
-    correlation_plot.set_title('ISOS - Signal correlation.')
-
-    correlation_plot.annotate('Slope    : {:.3f}'.format(slope), (-7.5,25))
-    correlation_plot.annotate('R-squared: {:.3f}'.format(r_value**2), (-7.5,23))
+    #Returns the motion corrected data and the regression (slope, intercept, r_value) of the whole session.
+    #The least squares fit of scipy.stats.linregress(x = ISOS, y = signal), the signal predicted from the ISOS as it
+    #is applied below, is computed along the last axis in float64, so stacked setups are all regressed at once.
+    #With a window (seconds) each sample is corrected with the regression of the window centred on it instead,
+    #which follows a coupling that drifts over the session.
+    signal = detrended_data['detrended_signal']
+    ISOS = detrended_data['detrended_ISOS']
+    signal_mean = np.mean(signal, axis = -1, dtype = np.float64, keepdims = True)
+    ISOS_mean = np.mean(ISOS, axis = -1, dtype = np.float64, keepdims = True)
+    signal_deviation = signal - signal_mean
+    ISOS_deviation = ISOS - ISOS_mean
+    ss_signal = np.einsum('...i,...i->...', signal_deviation, signal_deviation)[..., None]
+    ss_cross = np.einsum('...i,...i->...', signal_deviation, ISOS_deviation)[..., None]
+    ss_ISOS = np.einsum('...i,...i->...', ISOS_deviation, ISOS_deviation)[..., None]
+    del signal_deviation, ISOS_deviation
+    slope = ss_cross/ss_ISOS
+    intercept = signal_mean - slope*ISOS_mean
+    r_value = ss_cross/np.sqrt(ss_signal*ss_ISOS)
 
     #Estimating motion from the ISOS signal and correcting the signal for this.
-    signal_est_motion = intercept + slope * detrended_data['detrended_ISOS']
-    signal_corrected = detrended_data['detrended_signal'] - signal_est_motion
-
-    plot1= motion_plot.plot(detrended_data['signal_ts'],detrended_data['detrended_signal'], 'b' , label='Signal - pre motion correction', alpha=0.3)
-    plot3= motion_plot.plot(detrended_data['signal_ts'], signal_corrected, 'g', label='Signal - motion corrected')
-    plot4= motion_plot.plot(detrended_data['signal_ts'], signal_est_motion - 0.05, 'y', label='estimated motion')
-    timestamp_ticks = motion_plot.plot(timestamps.ts, np.full(np.size(timestamps.ts), max(detrended_data['detrended_signal'])), label='Timestamps', color='w', marker="|", mec = "k")
-
-    motion_plot.set_xlabel('Time (seconds)')
-    motion_plot.set_ylabel('Signal (mV)', color='g')
-    motion_plot.set_title('Motion Correction')
-
-    lines = plot1+plot3+plot4+ timestamp_ticks
-    labels = [l.get_label() for l in lines]  
-    legend = motion_plot.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.95, 0.7))
-    plt.close()
-
+    if window is None:
+        window_slope, window_intercept = slope, intercept
+    else:
+        window_slope, window_intercept = sliding_regression(ISOS, signal, window_samples(detrended_data['ISOS_ts'], window))
+    signal_est_motion = np.multiply(ISOS, window_slope.astype(ISOS.dtype), out = ISOS if inplace else None)
+    signal_est_motion += window_intercept.astype(ISOS.dtype)
+    del window_slope, window_intercept
+    signal_corrected = np.subtract(signal, signal_est_motion, out = signal if inplace else None)
 
     #creating a dictionary with motion corrected data.
     motion_corrected_data = {
         'signal_corrected': signal_corrected,
         'signal_ts': detrended_data['signal_ts']
     }
-    return motion_corrected_data, motion_figure
+    motion_fit = [{
+        'slope': float(slope[channel, 0]),
+        'intercept': float(intercept[channel, 0]),
+        'r_value': float(r_value[channel, 0])
+    } for channel in range(slope.shape[0])] if slope.ndim == 2 else {
+        'slope': float(slope[0]),
+        'intercept': float(intercept[0]),
+        'r_value': float(r_value[0])
+    }
+    if window is not None:
+        for fit in (motion_fit if isinstance(motion_fit, list) else [motion_fit]):
+            fit['window'] = window
+    return motion_corrected_data, motion_fit
 
-def normalisation(motion_corrected_data, exponential_fit, timestamps):
+@instrument.timed
+def normalisation(motion_corrected_data, exponential_fit, window = None, inplace = False):
+    #dF/F is taken against the sliding baseline of photo_bleach_correction when there is one, and the signal fit otherwise.
+    #With a window (seconds) the z-score uses the mean and std of the window centred on each sample instead of the session.
 
     #dF/F 
-    dF_F = 100*motion_corrected_data['signal_corrected']/exponential_fit['signal_expfit']
-
-    #plot dF/F
-    dF_F_plot,ax1=plt.subplots()  
-    plot1=ax1.plot(motion_corrected_data['signal_ts'], dF_F, 'g', label='dF/F')
-    timestamp_ticks = ax1.plot(timestamps.ts, np.full(np.size(timestamps.ts), max(dF_F)), label='Timestamps', color='w', marker="|", mec = "k")
-    ax1.set_xlabel('Time (seconds)')
-    ax1.set_ylabel('dF/F (%)')
-    ax1.set_title('dF/F')
-
-    lines = plot1+ timestamp_ticks
-    labels = [l.get_label() for l in lines]  
-    legend = ax1.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.95, 0.98))
-    plt.close()
-
-    #ZScore
-    zscore = (motion_corrected_data['signal_corrected']-np.mean(motion_corrected_data['signal_corrected']))/np.std(motion_corrected_data['signal_corrected'])
-
-    zscore_plot,ax1=plt.subplots()  
-    plot1=ax1.plot(motion_corrected_data['signal_ts'], zscore, 'g', label='z-score')
-    timestamp_ticks = ax1.plot(timestamps.ts, np.full(np.size(timestamps.ts), max(dF_F)), label='Timestamps', color='w', marker="|", mec = "k")
-
-    ax1.set_xlabel('Time (seconds)')
-    ax1.set_ylabel('z-score')
-    ax1.set_title('z-scored')
-
-    lines = plot1+ timestamp_ticks
-    labels = [l.get_label() for l in lines]  
-    legend = ax1.legend(lines, labels, loc='upper right', bbox_to_anchor=(0.95, 0.98))
-    plt.close()
+    signal_corrected = motion_corrected_data['signal_corrected']
+    dF_F = np.divide(signal_corrected, exponential_fit.get('signal_baseline', exponential_fit['signal_expfit']))
+    dF_F *= 100
+
+    #ZScore of each setup
+    if window is None:
+        mean = np.mean(signal_corrected, axis = -1, dtype = np.float64, keepdims = True)
+        std = np.std(signal_corrected, axis = -1, dtype = np.float64, keepdims = True)
+    else:
+        mean, std = sliding_mean_std(signal_corrected, window_samples(motion_corrected_data['signal_ts'], window))
+    zscore = np.subtract(signal_corrected, mean.astype(signal_corrected.dtype), out = signal_corrected if inplace else None)
+    zscore /= std.astype(signal_corrected.dtype)
 
     normalised_data = {
         'time': motion_corrected_data['signal_ts'],
@@ -235,4 +422,4 @@ def normalisation(motion_corrected_data, exponential_fit, timestamps):
         'zscore': zscore
     }
 
-    return normalised_data, dF_F_plot, zscore_plot
\ No newline at end of file
+    return normalised_data
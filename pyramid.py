@@ -0,0 +1,202 @@
+"""
+This code keeps a multi-resolution copy of every trace of a setup's data store, so any part of a long session can be
+drawn at screen resolution without reading every sample.
+1. Building - each value column of each stage in the store (raw, filtered, detrended, motion corrected and normalised
+   traces) is reduced to the minimum, maximum and mean of bins of 2**FIRST_LEVEL samples, and every following level
+   halves the previous one, until a level has at most MIN_BINS bins. All levels of a column are one (bins x 3) .npy
+   file in the pyramid folder of the store, with a json header listing where each level starts. The first level is
+   read from the store in chunks, so building never holds a whole trace in memory.
+2. Querying - for a time range and a pixel width, query picks the coarsest level that still has at least one bin per
+   pixel (at most two), and reads only those bins. Ranges short enough to need finer bins than the first level
+   return the samples themselves, at most 2**FIRST_LEVEL per pixel. Either way the work depends on the width only,
+   not on the length of the session or of the range.
+Bins start at multiples of their size from the first sample, so the first and last bin of a query may reach a little
+outside the range. NaN samples are left out of the minimum and maximum.
+The header records the key of the store it was built from, and a pyramid is only used while that key matches.
+
+python pyramid.py <output directory>        builds the pyramids of every setup store that does not have a current one
+"""
+import numpy as np
+import json
+import os
+import argparse
+import data_store
+import stage_cache
+import instrument
+from time_base import TimeBase
+
+PYRAMID_DIR = 'pyramid'
+PYRAMID_HEADER = 'pyramid.json'
+#log2 of the samples per bin of the first level, and the number of bins the coarsest level stops at.
+FIRST_LEVEL = 3
+MIN_BINS = 512
+#Samples read from the store at a time while building the first level, a multiple of the first level's bins.
+CHUNK_SAMPLES = 2**22
+
+## This function returns the time column of a stage that a value column is sampled on
+def time_column(columns, column):
+    #signal columns go with signal_ts and ISOS columns with ISOS_ts, a stage with one time column uses it for all
+    times = [name for name in columns if name == 'time' or name.endswith('_ts')]
+    matches = [name for name in times if name[:-3] in column]
+    if len(matches) == 1:
+        return matches[0]
+    if len(times) == 1:
+        return times[0]
+    raise ValueError(f"Cannot tell which time column of {times} the column '{column}' is sampled on")
+
+
+## This function lists the levels of a trace of n samples as (level, first row, bins)
+def pyramid_levels(n):
+    levels = []
+    level, offset = FIRST_LEVEL, 0
+    while True:
+        bins = -(-n//2**level)
+        levels.append((level, offset, bins))
+        offset += bins
+        if bins <= MIN_BINS:
+            return levels
+        level += 1
+
+
+## This function reduces blocks of a trace to the minimum, maximum and mean of each bin of `size` samples
+def reduce_bins(values, size):
+    starts = np.arange(0, len(values), size)
+    counts = np.minimum(size, len(values) - starts)
+    return np.column_stack([np.fmin.reduceat(values, starts), np.fmax.reduceat(values, starts), np.add.reduceat(values, starts)/counts])
+
+
+## This function builds every level of one trace into the (bins x 3) .npy file at path
+def build_column(values, path):
+    n = len(values)
+    dtype = values.dtype if values.dtype.kind == 'f' else np.float64
+    levels = pyramid_levels(n)
+    #written under a temporary name and renamed into place once complete, as data_store.temporary_file does
+    temporary = data_store.temporary_path(path)
+    rows = np.lib.format.open_memmap(temporary, mode = 'w+', dtype = dtype, shape = (levels[-1][1] + levels[-1][2], 3))
+
+    #first level from the samples, one chunk at a time
+    size = 2**FIRST_LEVEL
+    for start in range(0, n, CHUNK_SAMPLES):
+        block = np.asarray(values[start:start + CHUNK_SAMPLES], dtype = np.float64)
+        first = start//size
+        rows[first:first + -(-len(block)//size)] = reduce_bins(block, size)
+
+    #each further level merges pairs of bins of the level before, the mean is weighted by the samples of each bin
+    for (level, offset, bins), (previous, previous_offset, previous_bins) in zip(levels[1:], levels):
+        merged = np.asarray(rows[previous_offset:previous_offset + previous_bins], dtype = np.float64)
+        counts = np.minimum(2**previous, n - np.arange(previous_bins)*2**previous)
+        pairs = np.arange(0, previous_bins, 2)
+        rows[offset:offset + bins] = np.column_stack([np.fmin.reduceat(merged[:, 0], pairs), np.fmax.reduceat(merged[:, 1], pairs),
+                                                      np.add.reduceat(merged[:, 2]*counts, pairs)/np.add.reduceat(counts, pairs)])
+    rows.flush()
+    del rows
+    os.replace(temporary, path)
+    return [{'level': level, 'offset': offset, 'bins': bins} for level, offset, bins in levels]
+
+
+## This function builds the pyramid of every trace of the store in data_path
+@instrument.timed
+def build_pyramid(data_path, stages = None):
+    #stages limits the pyramid to some stages of the store, by default every stage gets one.
+    #The old header is removed first and the new one written last, and every file is written to a temporary name
+    #and renamed into place, as in data_store.write_store.
+    header = data_store.read_header(data_path)
+    path = os.path.join(data_path, PYRAMID_DIR)
+    os.makedirs(path, exist_ok = True)
+    header_path = os.path.join(path, PYRAMID_HEADER)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+
+    pyramid = {'key': header.get('key'), 'first_level': FIRST_LEVEL, 'stages': {}}
+    for stage in header['stages'] if stages is None else stages:
+        columns = header['stages'][stage]
+        values = [column for column in columns if 'time_base' not in columns[column] and column != 'time' and not column.endswith('_ts')]
+        if values:
+            pyramid['stages'][stage] = {}
+        data = data_store.read_stage(data_path, stage, values)
+        for column in values:
+            file_name = f'{stage}.{column}.npy'
+            pyramid['stages'][stage][column] = {'file': file_name, 'time': time_column(columns, column), 'length': len(data[column]),
+                                                'levels': build_column(data[column], os.path.join(path, file_name))}
+
+    with data_store.temporary_file(header_path) as temporary, open(temporary, 'w') as f:
+        json.dump(pyramid, f, indent = 1)
+    return pyramid
+
+
+## This function reads the pyramid header of a store, None when there is none or it was built from an older store
+def read_pyramid(data_path):
+    try:
+        with open(os.path.join(data_path, PYRAMID_DIR, PYRAMID_HEADER)) as f:
+            pyramid = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not data_store.has_store(data_path) or pyramid['key'] != data_store.read_header(data_path).get('key'):
+        return None
+    return pyramid
+
+
+## This function returns the samples from the first at or after start up to the last at or before stop
+def sample_range(times, start, stop):
+    n = len(times)
+    if isinstance(times, TimeBase):
+        first = 0 if start is None else int(times.index(start, mode = 'floor'))
+        first += int(start is not None and 0 <= first < n and times.time(first) < start)
+        last = n if stop is None else int(times.index(stop, mode = 'floor')) + 1
+    else:
+        first = 0 if start is None else int(np.searchsorted(times, start, side = 'left'))
+        last = n if stop is None else int(np.searchsorted(times, stop, side = 'right'))
+    return min(max(first, 0), n), min(max(last, 0), n)
+
+
+## This function returns one trace between start and stop seconds at the resolution of `width` pixels
+def query(data_path, stage, column, start = None, stop = None, width = 1000, pyramid = None):
+    #Returns a dictionary of arrays with one entry per bin: time (of the first sample of the bin), min, max and
+    #mean, with the samples per bin (1 when the samples themselves are returned). There are between width and
+    #2*width bins, or fewer when the range has fewer samples. pyramid is the read_pyramid header, read here when None.
+    pyramid = read_pyramid(data_path) if pyramid is None else pyramid
+    if pyramid is None:
+        raise FileNotFoundError(f'There is no current pyramid for the store at {data_path}, build it with build_pyramid')
+    if column not in pyramid['stages'].get(stage, {}):
+        raise KeyError(f"The pyramid at {data_path} has no column '{column}' in stage '{stage}'")
+    entry = pyramid['stages'][stage][column]
+    times = data_store.read_stage(data_path, stage, [entry['time']])[entry['time']]
+    first, last = sample_range(times, start, stop)
+
+    #the coarsest level with at least `width` bins over the range
+    samples = max(last - first, 1)
+    level = int(np.floor(np.log2(samples/max(int(width), 1)))) if samples > width else 0
+    if level < pyramid['first_level']:
+        values = np.asarray(data_store.read_stage(data_path, stage, [column])[column][first:last])
+        return {'time': np.asarray(times[first:last], dtype = np.float64), 'min': values, 'max': values, 'mean': values, 'samples': 1}
+
+    levels = entry['levels']
+    found = levels[min(level - pyramid['first_level'], len(levels) - 1)]
+    size = 2**found['level']
+    bin_first, bin_last = first//size, -(-last//size)
+    rows = np.load(os.path.join(data_path, PYRAMID_DIR, entry['file']), mmap_mode = 'r')[found['offset'] + bin_first:found['offset'] + bin_last]
+    return {'time': np.asarray(times[bin_first*size:bin_last*size:size], dtype = np.float64),
+            'min': np.asarray(rows[:, 0]), 'max': np.asarray(rows[:, 1]), 'mean': np.asarray(rows[:, 2]), 'samples': size}
+
+
+## This function draws one trace between start and stop seconds on ax as its min/max band and mean
+def plot_range(ax, data_path, stage, column, start = None, stop = None, width = None, **kwargs):
+    #width defaults to the pixel width of the axes, so redrawing after a zoom reads about two bins per pixel.
+    width = int(ax.get_window_extent().width) if width is None else width
+    trace = query(data_path, stage, column, start, stop, width)
+    band = ax.fill_between(trace['time'], trace['min'], trace['max'], alpha = 0.3, linewidth = 0, **kwargs)
+    line, = ax.plot(trace['time'], trace['mean'], linewidth = 0.5, **kwargs)
+    return band, line
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Builds the trace pyramids of the setup stores in an output directory.')
+    parser.add_argument('output_file_path')
+    parser.add_argument('--force', action = 'store_true', help = 'rebuild pyramids that are already current')
+    args = parser.parse_args()
+    for root, directories, files in os.walk(args.output_file_path):
+        #the stores of the stage cache are not browsed
+        directories[:] = [directory for directory in directories if directory not in (stage_cache.CACHE_DIR, PYRAMID_DIR)]
+        if data_store.STORE_HEADER in files and (args.force or read_pyramid(root) is None):
+            build_pyramid(root)
+            print(f'Pyramid built for {root}')
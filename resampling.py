@@ -0,0 +1,291 @@
+"""
+This code computes bootstrap confidence bands of peri-event traces and cluster-based permutation tests between two
+groups of traces (e.g. two event types or two treatments), on trials x time matrices from the peri-event windows.
+Resamples are drawn in batches that are each one matrix product: a bootstrap batch weights the trials with
+multinomial counts, and a permutation batch assigns the trials to the two groups with a 0/1 membership matrix.
+The batch size is set by memory_mb, and each batch is reduced before the next one is drawn, so memory does not
+grow with the number of resamples:
+- the bootstrap means of each time point go into a histogram spanning the mean +/- 8 standard errors
+  (HISTOGRAM_BINS bins), and the band is read from the histogram,
+- a permutation only adds to the count of permutations whose largest cluster reaches each observed cluster.
+Batches run in a process pool when workers > 1. Every batch has its own seed spawned from `seed`, so the results
+depend only on the seed and not on the number of workers.
+Clusters are runs of time points where the Welch t statistic is beyond the threshold, weighed by the sum of their t
+values, and are tested against the largest cluster of every permutation (two sided).
+Samples outside the recording (NaN) are left out of every mean.
+
+python resampling.py <output directory> --metric zscore --event a --treatment T1 --bootstrap
+python resampling.py <output directory> --metric zscore --event a --compare treatment T1 T2
+"""
+import numpy as np
+import pandas as pd
+import scipy
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import event_cube
+
+#Bins of the histogram each time point's bootstrap means are collected in, over the mean +/- HISTOGRAM_RANGE standard errors.
+HISTOGRAM_BINS = 1024
+HISTOGRAM_RANGE = 8
+
+#Traces of the current process, set once in every worker so batches only send their seeds.
+_TRACES = {}
+
+## This function returns the trials x time matrix of one metric from a peri-event window file (.npz) saved by data_analysis.py
+def window_traces(path, metric = 'zscore'):
+    with np.load(path) as window:
+        metrics = list(window['metrics'])
+        return window['time'], window['data'][..., metrics.index(metric)].astype(np.float64)
+
+
+## This function returns the traces of the selected part of the event cube, one row per trial or per subject
+def cube_traces(path, metric = 'zscore', treatments = None, subjects = None, events = None, level = 'trial'):
+    #level = 'subject' averages the selected trials of each subject first, so every subject is one row.
+    header, data, trials = event_cube.open_cube(path)
+    positions = [event_cube.select_labels(header, axis, selected) for axis, selected in zip(event_cube.AXES, (treatments, subjects, events))]
+    values = data[..., header['metrics'].index(metric)][np.ix_(*positions)]
+    counts = trials[np.ix_(*positions)]
+    rows = []
+    for s in range(counts.shape[1]):
+        subject = [values[t, s, e, :counts[t, s, e]] for t in range(counts.shape[0]) for e in range(counts.shape[2])]
+        subject = np.concatenate(subject).astype(np.float64) if subject else np.empty((0, len(header['time'])))
+        if level == 'trial':
+            rows.append(subject)
+        elif level == 'subject':
+            if len(subject):
+                with np.errstate(invalid = 'ignore'):
+                    rows.append((np.nansum(subject, axis = 0)/np.sum(~np.isnan(subject), axis = 0))[None, :])
+        else:
+            raise ValueError(f"Unknown level '{level}', use 'trial' or 'subject'")
+    traces = np.concatenate(rows) if rows else np.empty((0, len(header['time'])))
+    return np.asarray(header['time']), traces
+
+
+## This function returns how many resamples go in a batch so a batch stays within memory_mb
+def batch_size(rows, samples, memory_mb = 64):
+    #a batch holds about four (batch x rows) and (batch x samples) float64 arrays
+    return max(1, int(memory_mb*2**20/(4*8*(rows + samples))))
+
+
+## This function splits the resamples into batches, each with its own seed spawned from seed
+def batches(resamples, size, seed):
+    sizes = [min(size, resamples - start) for start in range(0, resamples, size)]
+    return list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+
+
+## This function runs a batch function over every batch, in a process pool of workers when workers > 1, and sums the results
+def run_batches(function, traces, jobs, workers = 1):
+    #traces is a dictionary of the arrays the batches need, sent to each worker once.
+    if workers <= 1 or len(jobs) < 2:
+        return sum(function(traces, *job) for job in jobs)
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = (traces,)) as executor:
+        return sum(executor.map(run_worker_batch, [function]*len(jobs), jobs))
+
+
+## This function is run once in every worker process and keeps the traces the batches run on
+def init_worker(traces):
+    global _TRACES
+    _TRACES = traces
+
+
+## This function runs one batch in a worker process on the traces of init_worker
+def run_worker_batch(function, job):
+    return function(_TRACES, *job)
+
+
+## This function returns the traces with NaN set to 0 and the mask of the samples that are present
+def split_missing(traces):
+    traces = np.asarray(traces, dtype = np.float64)
+    present = ~np.isnan(traces)
+    return np.where(present, traces, 0.0), present.astype(np.float64)
+
+
+## This function returns the histogram range of the bootstrap means of every time point
+def histogram_range(values, present):
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        count = present.sum(axis = 0)
+        mean = values.sum(axis = 0)/count
+        error = np.sqrt(np.maximum((values**2).sum(axis = 0)/count - mean**2, 0)/np.maximum(count - 1, 1))
+    #a time point without spread still gets a range, so every mean falls in a bin
+    width = np.where(error > 0, HISTOGRAM_RANGE*error, np.maximum(np.abs(mean), 1)*1e-9)
+    return mean - width, mean + width
+
+
+## This function draws one batch of bootstrap means and returns their histogram counts (time x bins)
+def bootstrap_batch(traces, seed, size):
+    values, present, low, high = traces['values'], traces['present'], traces['low'], traces['high']
+    rows, samples = values.shape
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(rows, np.full(rows, 1/rows), size = size).astype(np.float64)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = (weights @ values)/(weights @ present)
+
+    #means outside the range go in the end bins, resamples without samples at a time point are left out
+    kept = ~np.isnan(means)
+    bins = np.clip(np.nan_to_num((means - low)/(high - low)*HISTOGRAM_BINS), 0, HISTOGRAM_BINS - 1).astype(np.int64)
+    cells = (np.arange(samples)[None, :]*HISTOGRAM_BINS + bins)[kept]
+    return np.bincount(cells, minlength = samples*HISTOGRAM_BINS).reshape(samples, HISTOGRAM_BINS)
+
+
+## This function reads quantiles of every time point from histogram counts, interpolating within a bin
+def histogram_quantiles(counts, low, high, quantiles):
+    cumulative = np.cumsum(counts, axis = 1)
+    total = cumulative[:, -1]
+    width = (high - low)/HISTOGRAM_BINS
+    result = []
+    for quantile in quantiles:
+        target = quantile*total
+        index = np.minimum(np.sum(cumulative < target[:, None], axis = 1), HISTOGRAM_BINS - 1)
+        before = np.where(index > 0, np.take_along_axis(cumulative, np.maximum(index - 1, 0)[:, None], axis = 1)[:, 0], 0)
+        inside = np.take_along_axis(counts, index[:, None], axis = 1)[:, 0]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            fraction = np.where(inside > 0, (target - before)/inside, 0.5)
+        result.append(np.where(total > 0, low + (index + fraction)*width, np.nan))
+    return result
+
+
+## This function computes the bootstrap confidence band of the mean trace of trials x time traces
+def bootstrap_band(traces, resamples = 10000, confidence = 0.95, seed = 0, workers = 1, memory_mb = 64):
+    #Returns a dictionary of arrays over time: mean, lower and upper (the percentile band), and the number of rows
+    #present at each time point. The band is read from histograms with a resolution of 2*HISTOGRAM_RANGE/HISTOGRAM_BINS
+    #standard errors.
+    values, present = split_missing(traces)
+    if values.shape[0] < 2:
+        raise ValueError('A bootstrap band needs at least two traces')
+    low, high = histogram_range(values, present)
+    inputs = {'values': values, 'present': present, 'low': low, 'high': high}
+    jobs = batches(int(resamples), batch_size(*values.shape, memory_mb = memory_mb), seed)
+    counts = run_batches(bootstrap_batch, inputs, jobs, workers)
+    lower, upper = histogram_quantiles(counts, low, high, [(1 - confidence)/2, (1 + confidence)/2])
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = values.sum(axis = 0)/present.sum(axis = 0)
+    return {'mean': mean, 'lower': lower, 'upper': upper, 'count': present.sum(axis = 0).astype(np.int64)}
+
+
+## This function computes the Welch t statistic between the rows in membership and the other rows, for every row of membership
+def welch_t(membership, values, present, squares, totals):
+    #membership is (permutations x rows) of 0 and 1, totals are the count, sum and sum of squares of every row together.
+    count_a, sum_a, squares_a = membership @ present, membership @ values, membership @ squares
+    count_b, sum_b, squares_b = totals[0] - count_a, totals[1] - sum_a, totals[2] - squares_a
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean_a, mean_b = sum_a/count_a, sum_b/count_b
+        variance_a = np.maximum(squares_a - sum_a*mean_a, 0)/(count_a - 1)
+        variance_b = np.maximum(squares_b - sum_b*mean_b, 0)/(count_b - 1)
+        return (mean_a - mean_b)/np.sqrt(variance_a/count_a + variance_b/count_b)
+
+
+## This function returns the mass of the largest cluster of every row of t statistics (permutations x time)
+def largest_cluster(t, threshold):
+    #The running sum of the t values above the threshold only grows, so the sum at the start of each cluster is the
+    #running maximum of the sums where the clusters break. Positive and negative clusters are measured separately.
+    largest = np.zeros(t.shape[0])
+    for signed in (t, -t):
+        above = np.nan_to_num(signed) > threshold
+        running = np.cumsum(np.where(above, signed, 0), axis = 1)
+        starts = np.maximum.accumulate(np.where(above, 0, running), axis = 1)
+        largest = np.maximum(largest, np.max(running - starts, axis = 1, initial = 0))
+    return largest
+
+
+## This function lists the clusters of a row of t statistics as (start, stop, mass) runs of time points, stop excluded
+def find_clusters(t, threshold):
+    clusters = []
+    for sign in (1, -1):
+        above = np.concatenate([[False], np.nan_to_num(sign*t) > threshold, [False]])
+        edges = np.flatnonzero(np.diff(above.astype(np.int8)))
+        clusters.extend((start, stop, float(np.sum(t[start:stop]))) for start, stop in zip(edges[::2], edges[1::2]))
+    return sorted(clusters)
+
+
+## This function counts, for every observed cluster, the permutations of one batch whose largest cluster is at least as large
+def permutation_batch(traces, seed, size):
+    values, present, squares = traces['values'], traces['present'], traces['squares']
+    rows = values.shape[0]
+    rng = np.random.default_rng(seed)
+    #the first group_size rows of a random order of the rows make up group A of each permutation
+    order = np.argsort(rng.random((size, rows)), axis = 1)
+    membership = np.zeros((size, rows))
+    np.put_along_axis(membership, order[:, :traces['group_size']], 1.0, axis = 1)
+    t = welch_t(membership, values, present, squares, traces['totals'])
+    return np.sum(largest_cluster(t, traces['threshold'])[:, None] >= traces['masses'][None, :], axis = 0)
+
+
+## This function runs a cluster-based permutation test between two groups of trials x time traces
+def cluster_test(group_a, group_b, permutations = 5000, alpha = 0.05, threshold = None, seed = 0, workers = 1, memory_mb = 64):
+    #threshold is the |t| a time point must exceed to join a cluster, by default the two sided alpha quantile of the
+    #t distribution with the degrees of freedom of a pooled t test.
+    #Returns the t statistic over time, a table of the clusters (start and stop time point, mass and p value) and
+    #the mask of the time points in a cluster with p < alpha.
+    group_a, group_b = np.asarray(group_a, dtype = np.float64), np.asarray(group_b, dtype = np.float64)
+    if len(group_a) < 2 or len(group_b) < 2:
+        raise ValueError('A cluster test needs at least two traces in each group')
+    values, present = split_missing(np.concatenate([group_a, group_b]))
+    squares = values**2
+    totals = (present.sum(axis = 0), values.sum(axis = 0), squares.sum(axis = 0))
+    if threshold is None:
+        threshold = scipy.stats.t.ppf(1 - alpha/2, len(group_a) + len(group_b) - 2)
+
+    membership = np.zeros((1, len(values)))
+    membership[0, :len(group_a)] = 1
+    t = welch_t(membership, values, present, squares, totals)[0]
+    clusters = find_clusters(t, threshold)
+    masses = np.array([abs(mass) for _, _, mass in clusters])
+
+    counts = np.zeros(len(clusters), dtype = np.int64)
+    if len(clusters):
+        inputs = {'values': values, 'present': present, 'squares': squares, 'totals': totals, 'group_size': len(group_a),
+                  'threshold': threshold, 'masses': masses}
+        jobs = batches(int(permutations), batch_size(*values.shape, memory_mb = memory_mb), seed)
+        counts = run_batches(permutation_batch, inputs, jobs, workers)
+
+    table = pd.DataFrame(clusters, columns = ['start', 'stop', 'mass'])
+    table['p'] = (counts + 1)/(int(permutations) + 1)
+    significant = np.zeros(len(t), dtype = bool)
+    for _, cluster in table.loc[table['p'] < alpha].iterrows():
+        significant[int(cluster['start']):int(cluster['stop'])] = True
+    return {'t': t, 'clusters': table, 'significant': significant, 'threshold': threshold}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Bootstrap bands and cluster permutation tests on the event cube of an output directory.')
+    parser.add_argument('output_file_path', help = 'output directory holding the event_cube folder')
+    parser.add_argument('--metric', default = 'zscore', help = 'dF_F or zscore')
+    parser.add_argument('--treatment', nargs = '*', help = 'treatments to include, all when left out')
+    parser.add_argument('--event', nargs = '*', help = 'event types to include, all when left out')
+    parser.add_argument('--level', default = 'trial', help = "'trial' uses every trial, 'subject' the mean trace of each subject")
+    parser.add_argument('--bootstrap', action = 'store_true', help = 'write the bootstrap band of the selected traces')
+    parser.add_argument('--compare', nargs = 3, metavar = ('AXIS', 'A', 'B'), help = 'cluster test between two treatments or two events')
+    parser.add_argument('--resamples', type = int, default = 10000, help = 'bootstrap resamples or permutations')
+    parser.add_argument('--confidence', type = float, default = 0.95)
+    parser.add_argument('--alpha', type = float, default = 0.05)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--workers', type = int, default = 1, help = 'worker processes, 0 uses every core')
+    args = parser.parse_args()
+
+    path = event_cube.cube_path(args.output_file_path)
+    workers = os.cpu_count() if args.workers <= 0 else args.workers
+    name = '_'.join([args.metric] + (args.treatment or []) + (args.event or []))
+    if args.bootstrap:
+        time, traces = cube_traces(path, args.metric, treatments = args.treatment, events = args.event, level = args.level)
+        band = bootstrap_band(traces, args.resamples, args.confidence, seed = args.seed, workers = workers)
+        output = os.path.join(args.output_file_path, f'bootstrap_{name}.csv')
+        pd.DataFrame(dict(time = time, **band)).to_csv(output, index = False)
+        print(f'Bootstrap band of {len(traces)} traces written to {output}')
+    if args.compare:
+        axis, a, b = args.compare
+        if axis not in ('treatment', 'event'):
+            raise ValueError(f"Cannot compare {axis}, use 'treatment' or 'event'")
+        selected = {'treatments': args.treatment, 'events': args.event}
+        groups = []
+        for label in (a, b):
+            selected[f'{axis}s'] = [label]
+            time, traces = cube_traces(path, args.metric, level = args.level, **selected)
+            groups.append(traces)
+        test = cluster_test(groups[0], groups[1], args.resamples, args.alpha, seed = args.seed, workers = workers)
+        output = os.path.join(args.output_file_path, f'clusters_{args.metric}_{a}_vs_{b}.csv')
+        clusters = test['clusters'].assign(start_time = time[test['clusters']['start'].astype(int)],
+                                           stop_time = time[test['clusters']['stop'].astype(int) - 1])
+        clusters.to_csv(output, index = False)
+        pd.DataFrame({'time': time, 't': test['t'], 'significant': test['significant']}).to_csv(output.replace('clusters_', 'cluster_t_'), index = False)
+        print(f"{int((clusters['p'] < args.alpha).sum())} of {len(clusters)} clusters with p < {args.alpha} written to {output}")
@@ -0,0 +1,140 @@
+"""
+This code keeps a cache of the preprocessing stages of every setup, so a re-run only recomputes what has changed.
+Each stage is stored under a key that hashes the key of the stage before it with the parameters of the stage,
+the first (raw data) key hashes the tank files, the offset, the end and the setup. Changing one parameter therefore
+only changes the keys of that stage and the stages after it.
+Every entry is a directory in the data_store format, written to a temporary directory and renamed when complete,
+so an interrupted batch never leaves a half written entry. The least recently used entries are removed once the
+cache grows past its size limit.
+"""
+import data_store
+import hashlib
+import shutil
+import json
+import time
+import os
+
+CACHE_DIR = 'stage_cache'
+
+#Version of each stage, bump it when the code of a stage changes so the old entries are no longer used.
+STAGE_VERSIONS = {
+    'raw_data': 1,
+    'filtered_data': 1,
+    'detrended_data': 1,
+    'motion_corrected_data': 2,
+    'normalised_data': 1
+}
+
+#Entries used within this many seconds are never evicted, so an entry a worker has just planned to read stays in place.
+EVICT_GRACE = 60
+
+## This function hashes the files of a tank by name, size and modification time, and the index (.tsq) files by content
+def tank_fingerprint(tank_path):
+    #Hashing the content of the stream files would read the whole tank on every run, any rewrite of them changes
+    #their size or modification time and the .tsq index that tdt reads them through.
+    digest = hashlib.sha256(os.path.abspath(str(tank_path)).encode())
+    if os.path.isdir(str(tank_path)):
+        paths = sorted(os.path.join(str(tank_path), name) for name in os.listdir(str(tank_path)))
+    else:
+        paths = [str(tank_path)] if os.path.isfile(str(tank_path)) else []
+
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        digest.update(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        if path.lower().endswith('.tsq'):
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+## This function returns the key of a stage from the key of the stage before it and the parameters of the stage
+def stage_key(parent_key, stage, params):
+    description = {'parent': parent_key, 'stage': stage, 'version': STAGE_VERSIONS[stage], 'params': params}
+    return hashlib.sha256(json.dumps(description, sort_keys = True, default = str).encode()).hexdigest()
+
+
+## This function returns the cache directory inside the output directory
+def cache_path(output_file_path):
+    return os.path.join(output_file_path, CACHE_DIR)
+
+
+## This function checks whether an entry is in the cache, with touch = True it also marks the entry as used
+def has_entry(cache_path, key, touch = False):
+    entry_path = os.path.join(cache_path, key)
+    if not data_store.has_store(entry_path):
+        return False
+    if touch:
+        try:
+            os.utime(entry_path)
+        except OSError:
+            return False
+    return True
+
+
+## This function saves the arrays, json metadata and timestamps of one stage under key
+def save_entry(cache_path, key, arrays, metadata, timestamps):
+    #arrays is a dictionary of name -> dictionary of column -> array, in the same layout as the stages of data_store.
+    entry_path = os.path.join(cache_path, key)
+    if has_entry(cache_path, key, touch = True):
+        return entry_path
+    tmp_path = f'{entry_path}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors = True)
+    data_store.write_store(tmp_path, stages = arrays, info = metadata, timestamps = timestamps)
+    try:
+        os.rename(tmp_path, entry_path)
+    except OSError:
+        #another worker saved the same entry first
+        shutil.rmtree(tmp_path, ignore_errors = True)
+    return entry_path
+
+
+## This function loads an entry, returning its arrays (in memory, so they can be overwritten in place), metadata and timestamps
+def load_entry(cache_path, key):
+    entry_path = os.path.join(cache_path, key)
+    header = data_store.read_header(entry_path)
+    arrays = {name: data_store.read_stage(entry_path, name, mmap = False) for name in header['stages']}
+    os.utime(entry_path)
+    return arrays, header['info'], data_store.read_timestamps(entry_path)
+
+
+## This function returns only the json metadata of an entry (e.g. the fit report), without loading its arrays
+def load_metadata(cache_path, key):
+    return data_store.read_info(os.path.join(cache_path, key))
+
+
+## This function returns the size in bytes of every entry in the cache and the time it was last used
+def cache_entries(cache_path):
+    entries = {}
+    if not os.path.isdir(cache_path):
+        return entries
+    for key in os.listdir(cache_path):
+        entry_path = os.path.join(cache_path, key)
+        if not os.path.isdir(entry_path):
+            continue
+        try:
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_path) if entry.is_file())
+            entries[key] = (size, os.stat(entry_path).st_mtime)
+        except OSError:
+            continue
+    return entries
+
+
+## This function removes the least recently used entries until the cache is at most max_bytes
+def evict(cache_path, max_bytes):
+    #Returns the removed keys. Entries used in the last EVICT_GRACE seconds are kept even when over the limit.
+    entries = cache_entries(cache_path)
+    total = sum(size for size, _ in entries.values())
+    removed = []
+    now = time.time()
+    for key, (size, used) in sorted(entries.items(), key = lambda item: item[1][1]):
+        if total <= max_bytes:
+            break
+        if now - used < EVICT_GRACE:
+            continue
+        shutil.rmtree(os.path.join(cache_path, key), ignore_errors = True)
+        total -= size
+        removed.append(key)
+    return removed
@@ -0,0 +1,262 @@
+"""
+This code preprocesses the data as a stream of chunks, for watching dF/F and z-scores during acquisition and for
+replaying finished tanks. It follows the same four steps as preprocessing_v2, each replaced by a causal version
+that only keeps a small state between chunks, so the work per chunk depends on the chunk length and not on how
+long the stream has been running:
+1. Low Pass - the same 10 Hz butterworth, run forwards only with its filter state carried between chunks.
+2. Photobleaching Correction - a running baseline, an exponential moving average with a time constant of
+   baseline_window seconds, in place of the double exponential fit of the whole session.
+3. Motion Correction - the regression of preprocessing_v2.motion_correction, from running means and co-moments of
+   every sample so far (or of the last regression_window seconds), updated at every sample.
+4. Normalisation - dF/F against the running baseline, and a z-score against the running mean and variance of the
+   corrected signal (or of the last zscore_window seconds), also updated at every sample.
+As every running statistic is updated sample by sample, the output does not depend on the chunk lengths.
+The first minute or so of a stream is a warm up, while the baseline and the running statistics settle.
+Like preprocessing_v2 the signals are one recording (1-D) or several setups stacked as (setups x samples),
+every step works along the last axis. Statistics are kept in float64 and every output is float64.
+
+python streaming.py --tank <tank path> --offset 0 --ids A=mouse1 B=mouse2 --speed 10
+python streaming.py --synthetic 600 --speed 0
+"""
+import numpy as np
+import scipy
+import argparse
+import time
+import import_tank_v2
+
+#Default time constant (seconds) of the running baseline, long against transients and short against bleaching.
+BASELINE_WINDOW = 60
+
+## This function returns the per sample weight that forgets samples older than window seconds, 1 keeps every sample
+def forgetting_factor(window, sampling_rate):
+    return 1.0 if window is None else float(np.exp(-1/(window*sampling_rate)))
+
+
+## This function returns empty running means and co-moments of two signals, one per setup
+def empty_moments(shape = ()):
+    return {key: np.zeros(shape) for key in ['weight', 'mean_x', 'mean_y', 'xx', 'xy', 'yy']}
+
+
+## This function returns the running means and co-moments of x and y at every sample of a chunk, and updates moments to its last sample
+def running_moments(moments, x, y, decay = 1.0):
+    #The statistics at each sample cover every sample up to and including it, so they do not depend on how the stream
+    #is cut into chunks. With decay < 1 each sample is weighted by decay**age, so the statistics follow the last
+    #1/(1 - decay) samples. The running sums are taken about the means at the start of the chunk (or its first sample),
+    #which keeps them accurate over long streams where sums of squares about zero would lose their precision.
+    length = np.shape(x)[-1]
+    if length == 0:
+        return moments
+    started = moments['weight'] > 0
+    centre_x = np.where(started, moments['mean_x'], x[..., 0])
+    centre_y = np.where(started, moments['mean_y'], y[..., 0])
+    deviation_x = x - centre_x[..., None]
+    deviation_y = y - centre_y[..., None]
+
+    #each running sum is s[i] = decay*s[i - 1] + v[i], started from the sums of the samples before the chunk
+    def running_sum(values, initial):
+        return scipy.signal.lfilter([1], [1, -decay], values, axis = -1, zi = (decay*initial)[..., None])[0]
+    weight = running_sum(np.ones_like(deviation_x), moments['weight'])
+    sum_x = running_sum(deviation_x, np.zeros_like(moments['weight']))
+    sum_y = running_sum(deviation_y, np.zeros_like(moments['weight']))
+    running = {
+        'weight': weight,
+        'mean_x': centre_x[..., None] + sum_x/weight,
+        'mean_y': centre_y[..., None] + sum_y/weight,
+        'xx': running_sum(deviation_x*deviation_x, moments['xx']) - sum_x*sum_x/weight,
+        'xy': running_sum(deviation_x*deviation_y, moments['xy']) - sum_x*sum_y/weight,
+        'yy': running_sum(deviation_y*deviation_y, moments['yy']) - sum_y*sum_y/weight
+    }
+    for key, values in running.items():
+        moments[key] = values[..., -1]
+    return running
+
+
+## This function sets up the state of a stream of setups recorded at sampling_rate
+def stream_state(sampling_rate, baseline_window = BASELINE_WINDOW, regression_window = None, zscore_window = None):
+    #regression_window and zscore_window (seconds) limit the running statistics to recent samples, None uses the whole stream
+    #like the offline preprocessing does. The filter and baseline states are set from the first chunk.
+    return {
+        'sampling_rate': sampling_rate,
+        'sos': scipy.signal.butter(2, 10, btype = 'low', fs = sampling_rate, output = 'sos'),
+        'filter_signal': None,
+        'filter_ISOS': None,
+        'baseline_alpha': 1 - forgetting_factor(baseline_window, sampling_rate),
+        'baseline_signal': None,
+        'baseline_ISOS': None,
+        'regression_decay': forgetting_factor(regression_window, sampling_rate),
+        'regression': None,
+        'zscore_decay': forgetting_factor(zscore_window, sampling_rate),
+        'zscore': None,
+        'samples': 0,
+        'chunks': 0,
+        'max_latency': 0.0,
+        'total_latency': 0.0
+    }
+
+
+## This function runs the causal low-pass over a chunk, carrying the filter state in state[key]
+def stream_filter(state, key, x):
+    if state[key] is None:
+        #start the filter in its steady state for the first sample, as if the stream had always been at that level
+        zi = scipy.signal.sosfilt_zi(state['sos'])
+        state[key] = zi.reshape((zi.shape[0],) + (1,)*(x.ndim - 1) + (2,))*x[..., 0][None, ..., None]
+    filtered, state[key] = scipy.signal.sosfilt(state['sos'], x, axis = -1, zi = state[key])
+    return filtered
+
+
+## This function updates the running baseline in state[key] over a chunk and returns the baseline of every sample
+def stream_baseline(state, key, x):
+    alpha = state['baseline_alpha']
+    if state[key] is None:
+        state[key] = (1 - alpha)*x[..., :1]
+    baseline, state[key] = scipy.signal.lfilter([alpha], [1, alpha - 1], x, axis = -1, zi = state[key])
+    return baseline
+
+
+## This function preprocesses one chunk of the stream and returns its normalised data
+def process_chunk(state, ISOS, signal, time_stamps):
+    #ISOS and signal are the new samples (along the last axis) and time_stamps their times.
+    #Each sample is corrected and z-scored with the statistics of the samples up to and including it, so the output
+    #is the same however the stream is cut into chunks.
+    #The time taken is added to the latency of the state ('max_latency' and 'total_latency' over 'chunks').
+    start_time = time.perf_counter()
+    ISOS = np.asarray(ISOS, dtype = np.float64)
+    signal = np.asarray(signal, dtype = np.float64)
+
+    #Low pass filter and running photobleaching baseline.
+    filtered_ISOS = stream_filter(state, 'filter_ISOS', ISOS)
+    filtered_signal = stream_filter(state, 'filter_signal', signal)
+    ISOS_baseline = stream_baseline(state, 'baseline_ISOS', filtered_ISOS)
+    signal_baseline = stream_baseline(state, 'baseline_signal', filtered_signal)
+    detrended_ISOS = filtered_ISOS - ISOS_baseline
+    detrended_signal = filtered_signal - signal_baseline
+
+    #Motion correction with the same regression as preprocessing_v2.motion_correction (x = ISOS, y = signal).
+    if state['regression'] is None:
+        state['regression'] = empty_moments(signal.shape[:-1])
+    regression = running_moments(state['regression'], detrended_ISOS, detrended_signal, state['regression_decay'])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        slope = np.nan_to_num(regression['xy']/regression['xx'])
+    intercept = regression['mean_y'] - slope*regression['mean_x']
+    signal_corrected = detrended_signal - (slope*detrended_ISOS + intercept)
+
+    #dF/F against the running baseline and the z-score against the running mean and variance.
+    if state['zscore'] is None:
+        state['zscore'] = empty_moments(signal.shape[:-1])
+    moments = running_moments(state['zscore'], signal_corrected, signal_corrected, state['zscore_decay'])
+    std = np.sqrt(np.maximum(moments['xx'], 0)/moments['weight'])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        dF_F = 100*signal_corrected/signal_baseline
+        zscore = (signal_corrected - moments['mean_x'])/std
+
+    latency = time.perf_counter() - start_time
+    state['samples'] += signal.shape[-1]
+    state['chunks'] += 1
+    state['max_latency'] = max(state['max_latency'], latency)
+    state['total_latency'] += latency
+
+    return {
+        'time': np.asarray(time_stamps, dtype = np.float64),
+        'dF_F': dF_F,
+        'zscore': zscore
+    }
+
+
+## This function returns the current motion fit of a stream, in the format of preprocessing_v2.motion_correction
+def stream_motion_fit(state):
+    regression = state['regression']
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        slope = regression['xy']/regression['xx']
+        r_value = regression['xy']/np.sqrt(regression['xx']*regression['yy'])
+    intercept = regression['mean_y'] - slope*regression['mean_x']
+    if np.ndim(slope) == 0:
+        return {'slope': float(slope), 'intercept': float(intercept), 'r_value': float(r_value)}
+    return [{'slope': float(slope[channel]), 'intercept': float(intercept[channel]), 'r_value': float(r_value[channel])}
+            for channel in range(len(slope))]
+
+
+## This function preprocesses a stream of (ISOS, signal, time_stamps) chunks, yielding the normalised data of each chunk
+def stream_preprocess(chunks, sampling_rate, max_chunk = None, **kwargs):
+    #kwargs are passed to stream_state. Chunks longer than max_chunk samples are processed in pieces of max_chunk,
+    #which bounds the latency of each piece. The state is yielded with the data so the caller can read the latency and motion fit.
+    state = stream_state(sampling_rate, **kwargs)
+    for ISOS, signal, time_stamps in chunks:
+        length = np.shape(signal)[-1]
+        step = length if max_chunk is None else max_chunk
+        for start in range(0, length, max(step, 1)):
+            yield process_chunk(state, ISOS[..., start:start + step], signal[..., start:start + step], time_stamps[start:start + step]), state
+
+
+## This function cuts the outputs of open_tank (1-D or stacked) into chunks of chunk_samples, released at speed times real time
+def replay_chunks(outputs, sampling_rate, chunk_samples, speed = 1.0):
+    #outputs can also be a list of the outputs of several setups, which are stacked one chunk at a time, so streams
+    #read with tank_reader are never read whole. speed = 0 releases the chunks as fast as they are consumed.
+    #Chunks whose release time has passed are released at once, so a consumer that falls behind catches up rather
+    #than drifting further behind.
+    #the streams of stacked setups are cut to the shortest one, which differ by a few samples within one tank
+    length = min(min(np.shape(output['signal'])[-1], np.shape(output['ISOS'])[-1])
+                 for output in (outputs if isinstance(outputs, list) else [outputs]))
+    start_time = time.perf_counter()
+    for start in range(0, length, chunk_samples):
+        if speed > 0:
+            release = start_time + start/sampling_rate/speed
+            delay = release - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        stop = min(start + chunk_samples, length)
+        if isinstance(outputs, list):
+            yield (np.stack([output['ISOS'][start:stop] for output in outputs]), np.stack([output['signal'][start:stop] for output in outputs]),
+                   outputs[0]['signal_ts'][start:stop])
+        else:
+            yield outputs['ISOS'][..., start:stop], outputs['signal'][..., start:stop], outputs['signal_ts'][start:stop]
+
+
+## This function replays a tank (or the sessions returned by a stand in for open_tank) through the streaming preprocessing
+def replay_tank(sessions, chunk_seconds = 0.1, speed = 10, **kwargs):
+    #sessions is the dictionary of setup -> (INFO, OUTPUTS, TIMESTAMPS, SAMPLING_RATE) returned by import_tank_v2.open_tank,
+    #the setups are stacked and streamed together, so they must share a sampling rate.
+    #kwargs are passed to stream_state. Yields the setups, the normalised data of each chunk and the state.
+    setups = list(sessions)
+    sampling_rates = {sessions[setup][3] for setup in setups}
+    if len(sampling_rates) != 1:
+        raise ValueError(f'The setups {setups} were recorded at different sampling rates {sorted(sampling_rates)}, replay them separately')
+    sampling_rate = sampling_rates.pop()
+    #the setups are stacked chunk by chunk, a replay only ever holds one chunk of the streams
+    outputs = [sessions[setup][1] for setup in setups]
+    chunk_samples = max(int(round(chunk_seconds*sampling_rate)), 1)
+    for normalised_chunk, state in stream_preprocess(replay_chunks(outputs, sampling_rate, chunk_samples, speed), sampling_rate, **kwargs):
+        yield setups, normalised_chunk, state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Replay a tank through the streaming preprocessing.')
+    parser.add_argument('--tank', help = 'path to the tank')
+    parser.add_argument('--offset', type = float, default = 0, help = 'seconds skipped at the start of the tank')
+    parser.add_argument('--end', type = float, default = 0, help = 'seconds at which to stop reading the tank, 0 reads to the end')
+    parser.add_argument('--ids', nargs = '+', default = ['A=A', 'B=B'], help = 'mouse ID of each setup as setup=ID')
+    parser.add_argument('--synthetic', type = float, help = 'replay a synthetic recording of this many seconds instead of a tank')
+    parser.add_argument('--speed', type = float, default = 10, help = 'replay speed relative to real time, 0 runs as fast as possible')
+    parser.add_argument('--chunk', type = float, default = 0.1, help = 'chunk length in seconds')
+    parser.add_argument('--reader', default = 'tdt', help = "'tdt' or 'memmap' (tank_reader.py, reads the tank as it is replayed)")
+    parser.add_argument('--report', type = float, default = 10, help = 'seconds of recording between progress lines')
+    args = parser.parse_args()
+
+    IDS = dict(item.split('=', 1) for item in args.ids)
+    if args.synthetic:
+        import synthetic
+        sessions = synthetic.synthetic_open_tank('replay', args.offset, IDS, 'none', 'none', END = args.end, duration = args.synthetic)
+    else:
+        sessions = import_tank_v2.open_tank(args.tank, args.offset, IDS, 'none', 'none', END = args.end, reader = args.reader)
+
+    next_report = None
+    for setups, normalised_chunk, state in replay_tank(sessions, chunk_seconds = args.chunk, speed = args.speed):
+        if len(normalised_chunk['time']) == 0:
+            continue
+        now = normalised_chunk['time'][-1]
+        next_report = now if next_report is None else next_report
+        if now >= next_report:
+            zscores = np.atleast_2d(normalised_chunk['zscore'])[:, -1]
+            print(f"{now:8.1f} s  " + '  '.join(f'{setup}: z = {z:6.2f}' for setup, z in zip(setups, zscores))
+                  + f"  latency {1000*state['total_latency']/state['chunks']:.2f} ms (max {1000*state['max_latency']:.2f} ms)")
+            next_report += args.report
+    print(f"{state['chunks']} chunks, mean latency {1000*state['total_latency']/state['chunks']:.2f} ms, max {1000*state['max_latency']:.2f} ms")
@@ -0,0 +1,90 @@
+"""
+This code makes synthetic recordings for running and benchmarking the pipeline without TDT tanks.
+synthetic_block builds a block laid out like tdt.read_block returns it, with the streams and camera epocs of
+every setup of a channel map (by default _405A/_465A/_415A/_475A and Cam1/Cam2), and synthetic_open_tank
+passes it through import_tank_v2.split_block, so it returns exactly what open_tank returns and can stand in for it.
+Each setup has a double exponential bleaching curve, shared motion artifacts in the signal and ISOS channels,
+event-locked transients in the signal and gaussian noise. Streams are float32 like the tank streams.
+"""
+import numpy as np
+import scipy.signal
+import tdt
+import import_tank_v2
+
+#Sampling rate (Hz) of the streams of the fibre photometry rig.
+SAMPLING_RATE = 1017.2526245117188
+
+#Default bleaching curve of the signal, the parameters of preprocessing_v2.double_exponential.
+#The ISOS curve is the same shape at ISOS_SCALE of the amplitude.
+BLEACH = {'const': 300.0, 'amp_fast': 20.0, 'amp_slow': 50.0, 'tau_slow': 1800.0, 'tau_multiplier': 0.05}
+ISOS_SCALE = 0.5
+
+## This function adds a copy of kernel at each of the event samples, scaled by the amplitudes
+def event_train(n, samples, amplitudes, kernel):
+    impulses = np.zeros(n)
+    np.add.at(impulses, samples, amplitudes)
+    return scipy.signal.oaconvolve(impulses, kernel)[:n]
+
+
+## This function makes the streams and event times of one setup
+def synthetic_streams(duration, sampling_rate = SAMPLING_RATE, bleach = None, motion_rate = 0.5, motion_amplitude = 20,
+                      event_rate = 2, event_names = ('a', 'b', 'c'), transient_amplitude = 5, noise = 1, seed = 0):
+    #duration in seconds, motion_rate and event_rate in events per minute.
+    #Motion artifacts are 0.5 s gaussian dips in both channels (scaled by ISOS_SCALE in the ISOS), each event is
+    #followed by a transient in the signal with a 0.2 s rise and 2 s decay.
+    #Returns the ISOS and signal streams (float32), the event times (seconds from the start) and their notes.
+    rng = np.random.default_rng(seed)
+    bleach = dict(BLEACH, **({} if bleach is None else bleach))
+    n = int(round(duration*sampling_rate))
+    t = np.arange(n)/sampling_rate
+
+    tau_fast = bleach['tau_slow']*bleach['tau_multiplier']
+    curve = bleach['const'] + bleach['amp_slow']*np.exp(-t/bleach['tau_slow']) + bleach['amp_fast']*np.exp(-t/tau_fast)
+
+    kernel_t = np.arange(int(3*sampling_rate))/sampling_rate
+    motion_kernel = -np.exp(-0.5*((kernel_t - 1.5)/0.25)**2)
+    motion_samples = rng.integers(0, n, rng.poisson(motion_rate*duration/60))
+    motion = event_train(n, motion_samples, rng.uniform(0.5, 1, len(motion_samples))*motion_amplitude, motion_kernel)
+
+    event_samples = np.sort(rng.integers(0, n, rng.poisson(event_rate*duration/60)))
+    transient_t = np.arange(int(10*sampling_rate))/sampling_rate
+    transient_kernel = (1 - np.exp(-transient_t/0.2))*np.exp(-transient_t/2)
+    transients = event_train(n, event_samples, rng.uniform(0.5, 1.5, len(event_samples))*transient_amplitude, transient_kernel)
+
+    ISOS = (curve + motion)*ISOS_SCALE + rng.normal(0, noise, n)
+    signal = curve + motion + transients + rng.normal(0, noise, n)
+    notes = rng.choice(list(event_names), len(event_samples))
+    return ISOS.astype(np.float32), signal.astype(np.float32), t[event_samples], notes
+
+
+## This function makes a block with the streams and camera epocs of every setup, laid out like tdt.read_block returns it
+def synthetic_block(duration, sampling_rate = SAMPLING_RATE, seed = 0, channel_map = None, **kwargs):
+    #kwargs are passed to synthetic_streams, each setup uses the next seed so the setups differ.
+    #Setups sharing a camera get the events of the last of them.
+    channel_map = import_tank_v2.CHANNEL_MAP if channel_map is None else channel_map
+    block = tdt.StructType(streams = tdt.StructType(), epocs = tdt.StructType())
+    for number, channels in enumerate(channel_map.values()):
+        ISOS, signal, event_times, notes = synthetic_streams(duration, sampling_rate, seed = seed + number, **kwargs)
+        camera = channels['camera']
+        block.streams[import_tank_v2.store_key(channels['isos'])] = tdt.StructType(name = channels['isos'], data = ISOS, fs = sampling_rate)
+        block.streams[import_tank_v2.store_key(channels['signal'])] = tdt.StructType(name = channels['signal'], data = signal, fs = sampling_rate)
+        block.epocs[import_tank_v2.store_key(camera)] = tdt.StructType(
+            name = camera,
+            onset = event_times,
+            offset = event_times + 1/sampling_rate,
+            data = np.arange(1, len(event_times) + 1, dtype = np.float64),
+            notes = tdt.StructType(ts = event_times.copy(), index = np.arange(1, len(event_times) + 1), notes = notes)
+            )
+    return block
+
+
+## This function returns what import_tank_v2.open_tank returns, from a synthetic block instead of a tank
+def synthetic_open_tank(PATH, OFFSET, IDS, REGION, SENSOR, END = 0, channel_map = None, sample_accurate = False, reader = 'tdt', duration = 600, **kwargs):
+    #PATH is only used to seed the block, so different rows of a settings file get different recordings.
+    #reader is ignored, the block is always made in memory.
+    #END (seconds, 0 = duration) shortens the recording like it does for a tank.
+    if END > 0:
+        duration = min(duration, END - OFFSET)
+    seed = kwargs.pop('seed', sum(str(PATH).encode()))
+    data = synthetic_block(duration, seed = seed, channel_map = channel_map, **kwargs)
+    return import_tank_v2.split_block(data, OFFSET, IDS, REGION, SENSOR, channel_map, sample_accurate)
@@ -0,0 +1,324 @@
+"""
+This code reads the streams and camera epocs of a TDT tank straight from its files, without tdt.read_block copying
+every stream into memory first.
+A block of a tank is a .tsq file of 40 byte event headers in time order and a .tev file with the data they point to.
+A stream (e.g. 465A) is stored as blocks of samples with a header each, interleaved in the .tev file with the blocks
+of the other streams, or as one .sev file per channel with the samples back to back.
+read_block maps the files with numpy.memmap and gives the data of each stream as a Stream: a view over its blocks that only
+reads the samples asked for, sliced by sample (stream[a:b]) or by time (stream.time_slice(t1, t2)). A slice inside
+one block, and any slice of a .sev stream or of a stream whose blocks are back to back, is a memmap view with no copy.
+stream.chunks() walks a stream in pieces, the low-pass of preprocessing_v2 and the replay in streaming.py read it
+that way, and np.asarray(stream) reads the whole stream into one array.
+Streams, epocs, start times and sampling rates follow tdt.read_block (times rounded to the tank clock, whole blocks
+trimmed to the requested time range). Only single channel streams in float or integer formats are read, check_block
+compares the two readers on a tank.
+
+python tank_reader.py <tank path> --stores 405A 465A 415A 475A Cam1 Cam2 --t1 0 --t2 0
+"""
+import tdt
+import numpy as np
+import argparse
+import glob
+import os
+
+#Layout of a .tsq event header. The offset field holds the position of the data in the .tev file for streams and
+#the value of the event for epocs, and the frequency field holds the note number for epocs.
+TSQ_HEADER = np.dtype([('size', '<i4'), ('type', '<i4'), ('code', '<u4'), ('channel', '<u2'), ('sort_code', '<u2'),
+                       ('timestamp', '<f8'), ('offset', '<u8'), ('format', '<i4'), ('frequency', '<f4')])
+
+#Rate (Hz) of the clock the tank time stamps are rounded to, as tdt does.
+TANK_CLOCK = 195312.5
+
+#Event types of the headers (tdt.EVTYPE_*), the start of block marker and the data formats of the streams.
+STREAM_TYPE = 0x8101
+STREAM_MASK = 0xFF0F
+ONSET_TYPES = (0x101, 0x8801)
+START_BLOCK = 1
+FORMATS = [np.float32, np.int32, np.int16, np.int8, np.float64, np.int64]
+
+## This function converts times to sample numbers at fs the way tdt does, to the nearest sample, the first one at or after ('first') or the last one before ('last')
+def tank_sample(time, fs = TANK_CLOCK, mode = 'nearest'):
+    #precision beyond 1e-9 of a sample is dropped first, so a time exactly on a sample is not moved by rounding errors
+    exact = np.round(np.asarray(time, dtype = np.float64)*fs*1e9)/1e9
+    if mode == 'nearest':
+        return np.round(exact).astype(np.int64)
+    if mode == 'first':
+        return np.ceil(exact).astype(np.int64)
+    if mode == 'last':
+        return (np.floor(exact) - (np.floor(exact) == exact)).astype(np.int64)
+    raise ValueError(f"Unknown mode '{mode}', use 'nearest', 'first' or 'last'")
+
+
+## This function rounds times to the tank clock
+def tank_time(time, fs = TANK_CLOCK):
+    return tank_sample(time, fs)/fs
+
+
+## This function returns the code of a store in the .tsq headers, its four characters read as one number
+def store_code(store):
+    return int.from_bytes(store.encode('cp437'), byteorder = 'little')
+
+
+class Stream:
+    #A stream of samples stored in blocks of block_size in source (a memmap), starting at the positions in offsets.
+    #The stream starts `first` samples into the first block and has n samples, the first one at start_time.
+    __slots__ = ('name', 'source', 'offsets', 'block_size', 'first', 'n', 'fs', 'start_time')
+
+    def __init__(self, name, source, offsets, block_size, first, n, fs, start_time):
+        self.name = name
+        self.source = source
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+        self.block_size = int(block_size)
+        self.first = int(first)
+        self.n = int(n)
+        self.fs = float(fs)
+        self.start_time = float(start_time)
+
+    def __len__(self):
+        return self.n
+
+    #array attributes, so np.ndim, np.shape and instrument.count_samples see a 1-D array without reading it
+    ndim = 1
+
+    @property
+    def shape(self):
+        return (self.n,)
+
+    @property
+    def dtype(self):
+        return self.source.dtype
+
+    def __repr__(self):
+        return f'Stream({self.name}, fs = {self.fs}, n = {self.n}, start_time = {self.start_time}, blocks = {len(self.offsets)})'
+
+    ## This function checks whether the blocks are back to back in the file, so the whole stream is one memmap view
+    @property
+    def contiguous(self):
+        return len(self.offsets) < 2 or bool(np.all(np.diff(self.offsets) == self.block_size))
+
+    ## This function returns the positions in the file of samples of the stream
+    def positions(self, index):
+        index = np.asarray(index, dtype = np.int64) + self.first
+        return self.offsets[index//self.block_size] + index % self.block_size
+
+    ## This function reads samples start to stop, a memmap view when they are back to back in the file
+    def read(self, start = 0, stop = None):
+        start, stop, _ = slice(start, stop).indices(self.n)
+        stop = max(stop, start)
+        if stop == start:
+            return self.source[:0]
+        first_block, last_block = (start + self.first)//self.block_size, (stop - 1 + self.first)//self.block_size
+        if self.contiguous or first_block == last_block:
+            position = int(self.positions(start))
+            return self.source[position:position + stop - start]
+        #gather the blocks the samples are in, one copy of only these samples
+        return self.source[self.positions(np.arange(start, stop))]
+
+    ## This function returns a sample, or the samples of a slice or of an array of indices
+    def __getitem__(self, key):
+        #x[..., a:b] is accepted as well, as the stages slice along the last axis
+        if isinstance(key, tuple):
+            key = key[1] if len(key) == 2 and key[0] is Ellipsis else key[0] if len(key) == 1 else key
+            if isinstance(key, tuple):
+                raise IndexError('A stream has one axis')
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.n)
+            if step == 1:
+                return self.read(start, stop)
+            return self.source[self.positions(np.arange(start, stop, step))]
+        index = np.asarray(key)
+        if np.any((index < -self.n) | (index >= self.n)):
+            raise IndexError(f'Index out of range for a stream of {self.n} samples')
+        return self.source[self.positions(np.where(index < 0, index + self.n, index))]
+
+    def __array__(self, dtype = None, copy = None):
+        values = np.array(self.read(0, self.n))
+        return values if dtype is None else values.astype(dtype, copy = False)
+
+    ## This function returns the samples start to stop as a stream, without reading them
+    def sub(self, start = 0, stop = None):
+        start, stop, _ = slice(start, stop).indices(self.n)
+        return Stream(self.name, self.source, self.offsets, self.block_size, self.first + start, max(stop - start, 0),
+                      self.fs, self.start_time + start/self.fs)
+
+    ## This function returns the samples from t1 up to t2 (seconds, on the time of the samples) as a stream
+    def time_slice(self, t1 = None, t2 = None):
+        #A sample at time t is kept when t1 <= t < t2, sample i being at start_time + i/fs.
+        start = 0 if t1 is None else int(np.ceil((t1 - self.start_time)*self.fs - 1e-9))
+        stop = self.n if t2 is None else int(np.ceil((t2 - self.start_time)*self.fs - 1e-9))
+        return self.sub(max(start, 0), max(stop, 0))
+
+    ## This function yields the stream in arrays of chunk_samples, views where the blocks allow it
+    def chunks(self, chunk_samples = 2**18):
+        for start in range(0, self.n, chunk_samples):
+            yield self.read(start, start + chunk_samples)
+
+
+## This function finds the .tsq, .tev and .tnt files of a block
+def block_files(path):
+    tsq = glob.glob(os.path.join(path, '*.tsq'))
+    if len(tsq) != 1:
+        raise FileNotFoundError(f'Expected one .tsq file in {path}, found {len(tsq)}')
+    base = tsq[0][:-len('.tsq')]
+    return tsq[0], base + '.tev', base + '.tnt'
+
+
+## This function maps the event headers of a block and returns them with the start time of the block
+def read_headers(path):
+    tsq, _, _ = block_files(path)
+    headers = np.memmap(tsq, dtype = TSQ_HEADER, mode = 'r')
+    if len(headers) < 2 or headers[1]['code'] != START_BLOCK:
+        raise ValueError(f'{tsq} does not start with a block start marker')
+    #the first header describes the file and the second marks the start of the block
+    return headers[1:], float(headers[1]['timestamp'])
+
+
+## This function returns the stream of a store kept in the .tev file, trimmed to t1 - t2 as tdt.read_block trims it
+def tev_stream(path, headers, block_start, store, t1 = 0, t2 = np.inf, channel = 1):
+    code = store_code(store)
+    selected = headers[(headers['code'] == code) & ((headers['type'] & STREAM_MASK) == STREAM_TYPE)]
+    channels = np.unique(selected['channel'])
+    if len(channels) > 1:
+        selected = selected[selected['channel'] == channel]
+    if len(selected) == 0:
+        raise KeyError(f'The tank {path} has no stream {store}')
+    data_format = int(selected[0]['format'])
+    if data_format >= len(FORMATS):
+        raise ValueError(f'The stream {store} is in a format tank_reader cannot read, use tdt.read_block')
+    dtype = np.dtype(FORMATS[data_format])
+    block_size = (int(selected[0]['size']) - 10)*4//dtype.itemsize
+    fs = float(np.float64(selected[0]['frequency']))
+    offsets = selected['offset'].astype(np.int64)
+    if np.any(offsets % dtype.itemsize):
+        raise ValueError(f'The blocks of {store} are not aligned to its {dtype} samples, use tdt.read_block')
+
+    #keep the blocks starting in the time range and the one before it, which holds the first samples of the range
+    ts = tank_time(selected['timestamp'] - block_start)
+    blocks = np.flatnonzero((ts >= t1) & (ts < t2))
+    if len(blocks) == 0:
+        blocks = np.flatnonzero(ts < t2)[-1:]
+    elif blocks[0] > 0:
+        blocks = np.concatenate([[blocks[0] - 1], blocks])
+    if len(blocks) == 0:
+        raise ValueError(f'The stream {store} has no samples before {t2} s')
+    blocks = np.arange(blocks[0], blocks[-1] + 1)
+
+    #then cut the samples before t1 and from t2 on
+    block_sample = tank_sample(tank_time(ts[blocks[0]], fs), fs, 'first')
+    first_sample = tank_sample(t1, fs, 'first')
+    first = max(int(first_sample) - int(block_sample), 0)
+    total = len(blocks)*block_size
+    stop = total if np.isinf(t2) else min(int(tank_sample(t2, fs, 'first')) - int(block_sample), total)
+    source = np.memmap(block_files(path)[1], dtype = dtype, mode = 'r')
+    return Stream(store, source, offsets[blocks]//dtype.itemsize, block_size, first, max(stop - first, 0), fs, first_sample/fs)
+
+
+## This function returns the stream of a store kept in a .sev file, trimmed to t1 - t2 as tdt.read_sev trims it
+def sev_stream(path, store, t1 = 0, t2 = np.inf, channel = 1):
+    files = sorted(glob.glob(os.path.join(path, f'*_{store}_[Cc]h{channel}.sev')))
+    if len(files) != 1 or glob.glob(os.path.join(path, f'*_{store}*.log')):
+        raise ValueError(f'The {store} recording is split over several .sev files or has gaps, use tdt.read_block')
+    header = np.fromfile(files[0], dtype = np.uint8, count = 40)
+    if bytes(header[8:11]) != b'SEV' or header[11] == 0:
+        raise ValueError(f'{files[0]} has no sev header, use tdt.read_block')
+    data_format, decimate = int(header[24]), int(header[25])
+    rate = int(header[26:28].view('<u2')[0])
+    dtype = np.dtype(FORMATS[data_format])
+    fs = 2.0**(rate - 12)*25e6/decimate
+
+    source = np.memmap(files[0], dtype = dtype, mode = 'r', offset = 40)
+    first = int(tank_sample(t1, fs, 'first'))
+    stop = len(source) if np.isinf(t2) else min(int(tank_sample(t2, fs, 'last')) + 1, len(source))
+    return Stream(store, source, [0], len(source), first, max(stop - first, 0), fs, first/fs)
+
+
+## This function reads the onsets, offsets, values and notes of an epoc store, the events with onsets in t1 - t2
+def read_epoc(path, headers, block_start, store, t1 = 0, t2 = np.inf):
+    #Returns the epoc as tdt.read_block does, with notes (ts, index and the note text from the .tnt file) when the
+    #events have notes, as the camera epocs do.
+    selected = headers[(headers['code'] == store_code(store)) & np.isin(headers['type'], ONSET_TYPES)]
+    if len(selected) == 0:
+        raise KeyError(f'The tank {path} has no epoc {store}')
+    onset = tank_time(selected['timestamp'] - block_start)
+    values = selected['offset'].view(np.float64)
+    offset = np.append(onset[1:], np.inf)
+    kept = (onset >= t1) & (onset < t2)
+    epoc = tdt.StructType(name = store, onset = onset[kept], offset = offset[kept], data = values[kept],
+                          type = 'onset', type_str = 'epocs')
+    if len(epoc.offset) and epoc.offset[-1] > t2:
+        epoc.offset[-1] = t2
+
+    note_numbers = selected['frequency'].view(np.uint32)
+    tnt = block_files(path)[2]
+    if np.any(note_numbers) and os.path.exists(tnt):
+        with open(tnt) as f:
+            note_text = np.array([line.rstrip('\n') for line in f][1:])
+        noted = (note_numbers != 0) & kept
+        epoc.notes = tdt.StructType(ts = onset[noted], index = note_numbers[noted], notes = note_text[note_numbers[noted] - 1])
+    return epoc
+
+
+## This function reads the stores of a block from t1 to t2 seconds (t2 = 0 reads to the end), with the streams as memmapped Stream views
+def read_block(path, t1 = 0, t2 = 0, store = None, channel = 1):
+    #store is a list of store names, only their headers are used. Returns a tdt.StructType laid out like the one from
+    #tdt.read_block (e.g. data.streams._465A with name, fs, start_time and data), with a Stream as the data of each stream.
+    t2 = np.inf if t2 is None or t2 <= 0 else t2
+    headers, block_start = read_headers(path)
+    if store is None:
+        raise ValueError('List the stores to read, tank_reader does not read every store of a tank')
+    data = tdt.StructType(streams = tdt.StructType(), epocs = tdt.StructType(), info = tdt.StructType(blockpath = path))
+    for name in [store] if isinstance(store, str) else store:
+        code = store_code(name)
+        types = headers['type'][headers['code'] == code]
+        if len(types) and np.isin(types[0], ONSET_TYPES):
+            data.epocs[tdt.fix_var_name(name)] = read_epoc(path, headers, block_start, name, t1, t2)
+        else:
+            if glob.glob(os.path.join(path, f'*_{name}_[Cc]h*.sev')):
+                stream = sev_stream(path, name, t1, t2, channel)
+            else:
+                stream = tev_stream(path, headers, block_start, name, t1, t2, channel)
+            data.streams[tdt.fix_var_name(name)] = tdt.StructType(name = name, fs = stream.fs, start_time = stream.start_time,
+                                                                  data = stream, type_str = 'streams')
+    return data
+
+
+## This function compares the stores read by read_block with tdt.read_block and returns a list of the differences
+def check_block(path, stores, t1 = 0, t2 = 0):
+    mapped = read_block(path, t1, t2, stores)
+    reference = tdt.read_block(path, t1 = t1, t2 = t2, store = list(stores), evtype = ['epocs', 'streams'])
+    differences = []
+    for key, mapped_stream in mapped.streams.items():
+        stream, expected = mapped_stream.data, reference.streams[key]
+        #tdt.read_sev ends a .sev stream read to the end with one extra zero sample, which is not counted as a difference
+        if stream.contiguous and len(stream.offsets) == 1 and len(expected.data) == len(stream) + 1 and expected.data[-1] == 0:
+            expected.data = expected.data[:-1]
+        if stream.fs != float(expected.fs) or not np.isclose(stream.start_time, expected.start_time, rtol = 0, atol = 1e-9):
+            differences.append(f'{key}: fs {stream.fs} / {expected.fs}, start time {stream.start_time} / {expected.start_time}')
+        if not np.array_equal(np.asarray(stream), np.asarray(expected.data)):
+            differences.append(f'{key}: {len(stream)} samples differ from the {len(expected.data)} samples of tdt.read_block')
+    for key, epoc in mapped.epocs.items():
+        expected = reference.epocs[key]
+        for field in ['onset', 'offset', 'data']:
+            if not np.allclose(epoc[field], expected[field], rtol = 0, atol = 1e-9):
+                differences.append(f'{key}: the {field} differ')
+        if 'notes' in expected.keys() or 'notes' in epoc.keys():
+            if 'notes' not in epoc.keys() or 'notes' not in expected.keys() \
+                    or not np.allclose(epoc.notes.ts, expected.notes.ts, rtol = 0, atol = 1e-9) \
+                    or list(epoc.notes.notes) != list(expected.notes.notes):
+                differences.append(f'{key}: the notes differ')
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Check the memmapped reader against tdt.read_block on a tank.')
+    parser.add_argument('tank', help = 'path to the tank block')
+    parser.add_argument('--stores', nargs = '+', default = ['405A', '465A', '415A', '475A', 'Cam1', 'Cam2'])
+    parser.add_argument('--t1', type = float, default = 0, help = 'seconds from the start of the block')
+    parser.add_argument('--t2', type = float, default = 0, help = 'seconds at which to stop, 0 reads to the end')
+    args = parser.parse_args()
+
+    differences = check_block(args.tank, args.stores, args.t1, args.t2)
+    for difference in differences:
+        print(difference)
+    print(f"{len(differences)} differences between tank_reader and tdt.read_block for {', '.join(args.stores)}")
+    raise SystemExit(1 if differences else 0)
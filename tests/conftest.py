@@ -0,0 +1,7 @@
+"""
+The modules of this repo are run from its root folder, so the tests import them from there.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
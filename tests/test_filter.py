@@ -0,0 +1,25 @@
+"""
+Checks the block-wise zero phase filter of preprocessing_v2.py against scipy's full-length filtfilt.
+"""
+import numpy as np
+import scipy.signal
+import pytest
+import synthetic
+import preprocessing_v2
+
+#Largest difference allowed, relative to the largest value of the full-length filter output.
+TOLERANCE = 1e-9
+
+
+@pytest.mark.parametrize('block_size', [2**12, 2**18])
+def test_zero_phase_filter_matches_filtfilt(block_size):
+    ISOS, signal, event_times, notes = synthetic.synthetic_streams(600, seed = 2)
+    time = np.arange(len(signal))/synthetic.SAMPLING_RATE
+    outputs = {'signal': signal, 'signal_ts': time, 'ISOS': ISOS, 'ISOS_ts': time}
+    filtered_data = preprocessing_v2.zero_phase_filter(outputs, synthetic.SAMPLING_RATE, block_size = block_size)
+
+    b, a = scipy.signal.butter(2, 10, btype = 'low', fs = synthetic.SAMPLING_RATE)
+    for name, raw in [('filtered_signal', signal), ('filtered_ISOS', ISOS)]:
+        expected = scipy.signal.filtfilt(b, a, raw.astype(np.float64))
+        assert filtered_data[name].shape == expected.shape
+        assert np.max(np.abs(filtered_data[name] - expected)) <= TOLERANCE*np.max(np.abs(expected))
@@ -0,0 +1,48 @@
+"""
+Checks that the float32 mode of the preprocessing (dtype option) gives the same dF/F and z-score as float64, on a
+synthetic.py session run through every preprocessing stage.
+"""
+import numpy as np
+import pytest
+import options as run_options
+import data_extract
+import synthetic
+
+#Largest difference allowed between the float32 and float64 traces, relative to the largest value of the float64 trace.
+#float32 keeps about 7 significant digits, and the fits and statistics run in float64 in both modes.
+TOLERANCE = 1e-4
+
+
+## This function runs the streams through every preprocessing stage of data_extract.py with the default options and the given dtype
+def preprocess(outputs, dtype):
+    #only the normalised data is kept, so every other stage is overwritten in place as in a default export
+    params = data_extract.preprocessing_params(dict(run_options.DEFAULT_OPTIONS, dtype = dtype))
+    stages = {'raw_data': outputs}
+    sampling_rate = synthetic.SAMPLING_RATE
+    for stage in data_extract.PIPELINE[1:]:
+        sampling_rate = data_extract.compute_stage(stage, stages, sampling_rate, params[stage], {'normalised_data'})
+    return stages['normalised_data']
+
+
+@pytest.fixture(scope = 'module')
+def session():
+    ISOS, signal, event_times, notes = synthetic.synthetic_streams(300)
+    time = np.arange(len(signal))/synthetic.SAMPLING_RATE
+    outputs = {'ISOS': ISOS, 'ISOS_ts': time, 'signal': signal, 'signal_ts': time}
+    return {dtype: preprocess(outputs, dtype) for dtype in ('float32', 'float64')}
+
+
+def test_float32_dtype(session):
+    for metric in ['dF_F', 'zscore']:
+        assert np.asarray(session['float32'][metric]).dtype == np.float32
+        assert np.asarray(session['float64'][metric]).dtype == np.float64
+
+
+@pytest.mark.parametrize('metric', ['dF_F', 'zscore'])
+def test_float32_matches_float64(session, metric):
+    single = np.asarray(session['float32'][metric], dtype = np.float64)
+    double = np.asarray(session['float64'][metric])
+    assert single.shape == double.shape
+    assert np.max(np.abs(single - double)) <= TOLERANCE*np.max(np.abs(double))
+    #the time base stays float64 in both modes
+    np.testing.assert_array_equal(session['float32']['time'], session['float64']['time'])
@@ -0,0 +1,72 @@
+"""
+Checks the vectorised peri-event code of peri_event.py against the plain loops it replaced, on a
+synthetic session.
+"""
+import numpy as np
+import pytest
+import peri_event
+
+#Largest difference allowed between the vectorised and the looped values.
+TOLERANCE = 1e-9
+SAMPLING_RATE = 1017.2526245117188
+
+
+@pytest.fixture(scope = 'module')
+def session():
+    #5 min of a slow oscillation with noise, and events of three types (including one at each end of the session,
+    #whose windows reach outside of it)
+    rng = np.random.default_rng(1)
+    time = np.arange(int(300*SAMPLING_RATE))/SAMPLING_RATE
+    dF_F = np.sin(2*np.pi*time/30) + rng.normal(0, 0.5, len(time))
+    data = {'time': time, 'dF_F': dF_F, 'zscore': (dF_F - dF_F.mean())/dF_F.std()}
+    event_times = np.concatenate([[0.01], np.sort(rng.uniform(0, 300, 20)), [time[-1] - 0.01]])
+    notes = np.concatenate([['a'], rng.choice(['a', 'b', 'c'], 20), ['b']])
+    return data, event_times, notes
+
+
+def test_block_mean_matches_loop(session):
+    data, event_times, notes = session
+    for factor in [7, 10, 1017]:
+        shortened_data, _ = peri_event.downsample(data, factor = factor)
+        for column in ['time', 'dF_F', 'zscore']:
+            looped = np.array([np.mean(data[column][i:i + factor]) for i in range(0, len(data[column]), factor)])
+            np.testing.assert_allclose(shortened_data[column], looped, rtol = 0, atol = TOLERANCE)
+
+
+@pytest.mark.parametrize('mode', ['nearest', 'floor'])
+def test_align_events_matches_loop(session, mode):
+    data, event_times, notes = session
+    time = peri_event.downsample(data, factor = 10)[0]['time']
+    event_index = peri_event.align_events(time, event_times, mode = mode)
+    interval = (time[-1] - time[0])/(len(time) - 1)
+    for x, event_time in enumerate(event_times):
+        if mode == 'nearest':
+            sample = int(np.argmin(np.abs(time - event_time)))
+            aligned = abs(event_time - time[sample]) <= interval/2
+        else:
+            before = np.flatnonzero(time <= event_time)
+            sample = int(before[-1]) if len(before) else -1
+            aligned = sample >= 0 and event_time - time[sample] <= interval
+        assert event_index['aligned'][x] == aligned
+        assert event_index['sample'][x] == (sample if aligned else -1)
+
+
+def test_peri_event_windows_match_loop(session):
+    data, event_times, notes = session
+    shortened_data, factor = peri_event.downsample(data, factor = 10)
+    sampling_rate = SAMPLING_RATE/factor
+    event_index = peri_event.align_events(shortened_data['time'], event_times)
+    windows = peri_event.peri_event_windows(shortened_data, event_index, notes, sampling_rate, pre = 20, post = 60)
+    assert list(windows) == list(dict.fromkeys(notes))
+
+    offsets = range(-int(round(20*sampling_rate)), int(round(60*sampling_rate)) + 1)
+    length = len(shortened_data['time'])
+    for name, window in windows.items():
+        samples = [sample for sample, note in zip(event_index['sample'], notes) if note == name and sample >= 0]
+        assert window['data'].shape == (len(samples), len(offsets), 2)
+        for x, sample in enumerate(samples):
+            looped = [[shortened_data[metric][sample + offset] if 0 <= sample + offset < length else np.nan for metric in ['dF_F', 'zscore']]
+                      for offset in offsets]
+            np.testing.assert_allclose(window['data'][x], looped, rtol = 0, atol = TOLERANCE)
+            np.testing.assert_array_equal(window['valid'][x], [0 <= sample + offset < length for offset in offsets])
+        np.testing.assert_allclose(window['event_time'], shortened_data['time'][samples], rtol = 0, atol = TOLERANCE)
@@ -0,0 +1,36 @@
+"""
+Checks that the streaming preprocessing of streaming.py gives the same output however the stream is cut into chunks.
+"""
+import numpy as np
+import pytest
+import synthetic
+import streaming
+
+#Largest difference allowed between two chunkings, relative to the largest value of the trace.
+TOLERANCE = 1e-9
+
+
+## This function streams a synthetic session in chunks of chunk_samples and joins the normalised data of every chunk
+def stream(outputs, chunk_samples, **kwargs):
+    chunks = streaming.replay_chunks(outputs, synthetic.SAMPLING_RATE, chunk_samples, speed = 0)
+    normalised = [chunk for chunk, state in streaming.stream_preprocess(chunks, synthetic.SAMPLING_RATE, **kwargs)]
+    return {column: np.concatenate([chunk[column] for chunk in normalised], axis = -1) for column in ['time', 'dF_F', 'zscore']}
+
+
+@pytest.fixture(scope = 'module')
+def outputs():
+    ISOS, signal, event_times, notes = synthetic.synthetic_streams(300)
+    return {'ISOS': ISOS, 'signal': signal, 'signal_ts': np.arange(len(signal))/synthetic.SAMPLING_RATE}
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'regression_window': 30, 'zscore_window': 30}])
+def test_output_does_not_depend_on_chunks(outputs, kwargs):
+    small = stream(outputs, 101, **kwargs)
+    large = stream(outputs, 5000, **kwargs)
+    split = stream(outputs, 5000, max_chunk = 333, **kwargs)
+    np.testing.assert_array_equal(small['time'], large['time'])
+    #the first samples have no variance yet, so their z-score is not defined
+    for metric in ['dF_F', 'zscore']:
+        scale = np.nanmax(np.abs(large[metric]))
+        for other in (small, split):
+            np.testing.assert_allclose(other[metric], large[metric], rtol = 0, atol = TOLERANCE*scale, equal_nan = True)
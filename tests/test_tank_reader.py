@@ -0,0 +1,84 @@
+"""
+Checks the memory-mapped reader of tank_reader.py against tdt.read_block (through check_block) on a small block
+written here: four TEV stream stores, one SEV stream store and two camera epoc stores with notes.
+"""
+import os
+import struct
+import numpy as np
+import pytest
+import tdt
+import tank_reader
+
+#Header record of a .tsq file, see tank_reader.read_headers.
+TSQ = np.dtype([('size', '<i4'), ('type', '<i4'), ('code', '<u4'), ('channel', '<u2'), ('sort_code', '<u2'),
+                ('timestamp', '<f8'), ('offset', '<u8'), ('format', '<i4'), ('frequency', '<f4')])
+STREAM_TYPE, SEV_TYPE, EPOC_TYPE = 0x8101, 0x8111, 0x101
+TEV_STORES = ['405A', '465A', '415A', '475A']
+SEV_STORE = 'Wav1'
+#The SEV header gives the rate as 2**(rate - 12)*25e6/decimate.
+SEV_RATE, SEV_DECIMATE = 0, 6
+FS = 2.0**(SEV_RATE - 12)*25e6/SEV_DECIMATE
+START = 1.7e9
+DURATION = 20
+
+
+## This function writes a block at path with the stores above, and returns the samples of every stream store
+def write_block(path, block_size = 256, seed = 0):
+    os.makedirs(path)
+    name = os.path.basename(path)
+    rng = np.random.default_rng(seed)
+    blocks = int(DURATION*FS/block_size)
+    data = {store: (rng.normal(size = blocks*block_size) + 100).astype(np.float32) for store in TEV_STORES + [SEV_STORE]}
+
+    #the first two headers and the last one mark the start and end of the block
+    headers = [(0, 0, 0, 0, 0, 0.0, 0, 0, 0.0), (10, 0, 1, 0, 0, START, 0, 0, 0.0)]
+    events = []
+    tev = bytearray()
+    for x in range(blocks):
+        time = START + x*block_size/FS
+        for store in TEV_STORES:
+            events.append((10 + block_size, STREAM_TYPE, tank_reader.store_code(store), 1, 0, time, len(tev), 0, FS))
+            tev += data[store][x*block_size:(x + 1)*block_size].tobytes()
+        events.append((10 + block_size, SEV_TYPE, tank_reader.store_code(SEV_STORE), 1, 0, time, 0, 0, FS))
+
+    #camera frames are epocs with the frame number as data and a note every 97 frames in the frequency field
+    for camera, period in [('Cam1', 1/30), ('Cam2', 1/20)]:
+        for frame, time in enumerate(np.arange(0.01, DURATION, period)):
+            note = 1 + (frame//97) % 3 if frame % 97 == 5 else 0
+            events.append((10, EPOC_TYPE, tank_reader.store_code(camera), 0, 0, START + time,
+                           np.array([frame + 1.0]).view('<u8')[0], 4, np.array([note], '<u4').view('<f4')[0]))
+    events.sort(key = lambda event: event[5])
+    headers += events + [(10, 0, 2, 0, 0, START + DURATION, 0, 0, 0.0)]
+
+    np.array(headers, dtype = TSQ).tofile(os.path.join(path, f'{name}.tsq'))
+    with open(os.path.join(path, f'{name}.tev'), 'wb') as f:
+        f.write(tev)
+    with open(os.path.join(path, f'{name}.tnt'), 'w') as f:
+        f.write('3\nleft\nright\nboth\n')
+    with open(os.path.join(path, f'{name}_{SEV_STORE}_Ch1.sev'), 'wb') as f:
+        header = bytearray(40)
+        struct.pack_into('<Q3sB4sHHHHBBH', header, 0, 40 + 4*len(data[SEV_STORE]), b'SEV', 3, SEV_STORE.encode(), 1, 1, 4, 0, 0,
+                         SEV_DECIMATE, SEV_RATE)
+        f.write(bytes(header) + data[SEV_STORE].tobytes())
+    return data
+
+
+@pytest.fixture(scope = 'module')
+def block(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('tank')/'block')
+    return path, write_block(path)
+
+
+#the block has no .tbk file of notes, which tdt.read_block warns about
+@pytest.mark.filterwarnings('ignore:Bad tbk file')
+@pytest.mark.parametrize('t1, t2', [(0, 0), (3.3, 11.7)])
+def test_check_block(block, t1, t2):
+    path, data = block
+    assert tank_reader.check_block(path, TEV_STORES + [SEV_STORE, 'Cam1', 'Cam2'], t1, t2) == []
+
+
+def test_read_block_samples(block):
+    path, data = block
+    mapped = tank_reader.read_block(path, store = TEV_STORES + [SEV_STORE])
+    for store, samples in data.items():
+        np.testing.assert_array_equal(np.asarray(mapped.streams[tdt.fix_var_name(store)].data), samples)
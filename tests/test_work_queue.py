@@ -0,0 +1,93 @@
+"""
+Checks that worker processes draining the same work_queue.py queue run every job once, that the job of a worker
+that was killed is reclaimed once its lease times out, and that a finished job whose key changed is claimed at once.
+"""
+import os
+import time
+import uuid
+import multiprocessing
+import work_queue
+
+JOBS = [f'job_{x}' for x in range(40)]
+WORKERS = 4
+
+
+## This function runs a job of the test queue, recording every run in the runs folder next to the queue
+def run_job(root, name, duration):
+    with open(os.path.join(root, 'runs', f'{name}.{os.getpid()}.{uuid.uuid4().hex}'), 'w'):
+        pass
+    time.sleep(duration)
+    return {'worker': os.getpid()}
+
+
+## This function drains the test queue in a worker process
+def worker(root, names, duration, lease_timeout, heartbeat_interval):
+    work_queue.drain(os.path.join(root, 'queue'), names, lambda name: run_job(root, name, duration),
+                     lease_timeout = lease_timeout, heartbeat_interval = heartbeat_interval, poll = 0.05)
+
+
+## This function counts the runs of every job
+def run_counts(root):
+    runs = [file.split('.')[0] for file in os.listdir(os.path.join(root, 'runs'))]
+    return {name: runs.count(name) for name in set(runs)}
+
+
+def test_workers_run_every_job_once(tmp_path):
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, 'runs'))
+    workers = [multiprocessing.Process(target = worker, args = (root, JOBS, 0.02, 60, 0.1)) for _ in range(WORKERS)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join(60)
+        assert process.exitcode == 0
+
+    path = os.path.join(root, 'queue')
+    assert run_counts(root) == {name: 1 for name in JOBS}
+    results = {name: work_queue.read_result(work_queue.job_path(path, name)) for name in JOBS}
+    assert all(result is not None for result in results.values())
+    #every result was saved by the worker that ran the job, on its only lease
+    assert all(work_queue.lease_generations(work_queue.job_path(path, name)) == [0] for name in JOBS)
+    assert set(result['worker'] for result in results.values()) <= set(process.pid for process in workers)
+
+
+def test_killed_worker_job_is_reclaimed(tmp_path):
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, 'runs'))
+    job = work_queue.job_path(os.path.join(root, 'queue'), JOBS[0])
+
+    #a worker that claims the job and hangs, killed while it holds the lease
+    stuck = multiprocessing.Process(target = worker, args = (root, JOBS[:1], 600, 1, 0.1))
+    stuck.start()
+    deadline = time.time() + 30
+    while not run_counts(root) and time.time() < deadline:
+        time.sleep(0.05)
+    stuck.kill()
+    stuck.join()
+    assert work_queue.read_result(job) is None
+
+    #the lease is not reclaimed while it is younger than the lease timeout
+    started = time.time()
+    results = work_queue.drain(os.path.join(root, 'queue'), JOBS[:1], lambda name: run_job(root, name, 0),
+                               lease_timeout = 1, heartbeat_interval = 0.1, poll = 0.05)
+    assert time.time() - started >= 0.5
+    assert work_queue.lease_generations(job) == [0, 1]
+    assert results == {JOBS[0]: {'worker': os.getpid()}}
+    assert run_counts(root) == {JOBS[0]: 2}
+
+
+def test_finished_job_with_new_key_is_claimed_at_once(tmp_path):
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, 'runs'))
+    path = os.path.join(root, 'queue')
+
+    #the lease of the finished run is younger than the lease timeout but older than its result
+    work_queue.drain(path, JOBS[:1], lambda name: run_job(root, name, 0.05), lease_timeout = 30, heartbeat_interval = 0.1,
+                     keys = {JOBS[0]: 'old'})
+    started = time.time()
+    results = work_queue.drain(path, JOBS[:1], lambda name: run_job(root, name, 0.05), lease_timeout = 30, heartbeat_interval = 0.1,
+                               poll = 0.05, keys = {JOBS[0]: 'new'})
+    assert time.time() - started < 10
+    assert work_queue.lease_generations(work_queue.job_path(path, JOBS[0])) == [0, 1]
+    assert results == {JOBS[0]: {'worker': os.getpid()}}
+    assert run_counts(root) == {JOBS[0]: 2}
@@ -0,0 +1,85 @@
+"""
+This code describes the time axis of a regularly sampled stream by its offset, sampling rate and number of samples,
+instead of an array with the time of every sample.
+Sample i is at offset + (i + start)/fs. open_tank has always put the first sample one interval after the offset
+(start = 1, from np.linspace(1, n, n)/fs), which is kept so existing results do not move; sample_accurate gives the
+time base with the first sample at the start of the stream (start = 0).
+A TimeBase converts between sample indices and times without building the time array, and slicing it (as the
+stages do, e.g. [::factor] when decimating) gives another TimeBase. np.asarray(time_base) builds the full array for
+code that needs one, such as csv exports and the curve fits. The data store saves a TimeBase as its four numbers.
+"""
+import numpy as np
+
+class TimeBase:
+    __slots__ = ('offset', 'fs', 'n', 'start')
+
+    def __init__(self, offset, fs, n, start = 1):
+        self.offset = float(offset)
+        self.fs = float(fs)
+        self.n = int(n)
+        self.start = float(start)
+
+    def __len__(self):
+        return self.n
+
+    #array attributes, so np.ndim, np.shape and instrument.count_samples see a 1-D float64 array without building it
+    ndim = 1
+    dtype = np.dtype(np.float64)
+
+    @property
+    def shape(self):
+        return (self.n,)
+
+    def __repr__(self):
+        return f'TimeBase(offset = {self.offset}, fs = {self.fs}, n = {self.n}, start = {self.start})'
+
+    def __eq__(self, other):
+        return isinstance(other, TimeBase) and self.to_dict() == other.to_dict()
+
+    ## This function returns the times of sample indices (a number or an array)
+    def time(self, index):
+        return self.offset + (np.asarray(index, dtype = np.float64) + self.start)/self.fs
+
+    ## This function returns the sample of each time, the nearest one or with mode 'floor' the last one at or before it
+    def index(self, time, mode = 'nearest'):
+        #Returns unclipped indices, so times outside the recording give indices below 0 or from n on.
+        position = (np.asarray(time, dtype = np.float64) - self.offset)*self.fs - self.start
+        if mode == 'nearest':
+            #a time half way between two samples goes to the earlier one
+            return np.ceil(position - 0.5).astype(np.int64)
+        if mode == 'floor':
+            #allow for rounding in the conversion so a time exactly on a sample maps to that sample
+            return np.floor(position + 1e-9).astype(np.int64)
+        raise ValueError(f"Unknown mode '{mode}', use 'nearest' or 'floor'")
+
+    ## This function returns the times of samples, a slice of the time base for a slice
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            first, stop, step = key.indices(self.n)
+            if step <= 0:
+                return self.time(np.arange(first, stop, step))
+            return TimeBase(self.offset, self.fs/step, len(range(first, stop, step)), (first + self.start)/step)
+        return self.time(key)
+
+    def __array__(self, dtype = None, copy = None):
+        #the same expression open_tank used to build the time arrays with, so the values are unchanged
+        values = self.offset + (np.arange(self.n, dtype = np.float64) + self.start)/self.fs
+        return values if dtype is None else values.astype(dtype, copy = False)
+
+    ## This function returns the time base of block means of `factor` samples (see peri_event.block_mean)
+    def block_mean(self, factor):
+        #Each block is placed at the mean time of a full block. A shorter last block is placed on the same grid,
+        #at most (factor - 1)/2 samples from the mean time of the samples it has.
+        return TimeBase(self.offset, self.fs/factor, -(-self.n//factor), (self.start + (factor - 1)/2)/factor)
+
+    ## This function returns the same samples with the first one at first_sample_time (default the offset) instead of one interval after it
+    def sample_accurate(self, first_sample_time = None):
+        return TimeBase(self.offset if first_sample_time is None else first_sample_time, self.fs, self.n, start = 0)
+
+    ## This function returns the time base as a dictionary, for the header of the data store
+    def to_dict(self):
+        return {'offset': self.offset, 'fs': self.fs, 'n': self.n, 'start': self.start}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values['offset'], values['fs'], values['n'], values['start'])
@@ -0,0 +1,117 @@
+"""
+This code detects transients in the normalised data and measures the response to every event, for data_analysis.py.
+1. Transient detection - every peak of a whole session in one pass of scipy.signal.find_peaks, kept when its
+   prominence is at least `prominence` times the robust noise of the trace (the median absolute deviation from the
+   median, scaled to a standard deviation) and its width at half prominence is at least `width` seconds.
+2. Event-locked metrics - for every trial of every event type, from the peri-event windows of peri_event.py:
+   the area under the curve before the event (the whole pre window) and after it (the response window), the peak
+   amplitude and its latency in the response window, and the rate of transients (per second) in both windows.
+   Each measure is computed for all the trials and metrics of an event type at once, along the window axis.
+Areas are the sum of the samples times the sample interval, over the samples inside the recording; a window
+with no samples inside the recording gives NaN.
+The results of a subject are one tidy table, one row per event type, trial and metric.
+"""
+import numpy as np
+import pandas as pd
+import scipy
+import instrument
+
+#Scale from the median absolute deviation to the standard deviation of normally distributed noise.
+MAD_SCALE = 1.4826
+
+## This function estimates the noise of a trace from its median absolute deviation, ignoring NaN
+def robust_noise(trace):
+    trace = np.asarray(trace, dtype = np.float64)
+    return MAD_SCALE*np.nanmedian(np.abs(trace - np.nanmedian(trace)))
+
+
+## This function finds the transients of a whole trace in one pass
+@instrument.timed
+def detect_transients(trace, time, sampling_rate, prominence = 3, width = 0.2):
+    #prominence is in multiples of the robust noise of the trace and width in seconds, at half prominence.
+    #Returns a dictionary of arrays with one entry per transient: sample, time, amplitude (the value at the peak),
+    #prominence and width (seconds), and the noise the thresholds were taken from.
+    trace = np.asarray(trace, dtype = np.float64)
+    noise = robust_noise(trace)
+    peaks, properties = scipy.signal.find_peaks(np.nan_to_num(trace, nan = np.nanmedian(trace)),
+                                                prominence = prominence*noise, width = max(width*sampling_rate, 0))
+    return {
+        'sample': peaks,
+        'time': np.asarray(time[peaks], dtype = np.float64),
+        'amplitude': trace[peaks],
+        'prominence': properties['prominences'],
+        'width': properties['widths']/sampling_rate,
+        'noise': noise
+    }
+
+
+## This function returns the rate (per second) of transients from start up to stop seconds around every event time
+def transient_rate(transient_times, event_times, start, stop):
+    #transient_times are sorted, so each count is the difference of two binary searches
+    if stop <= start:
+        return np.full(len(event_times), np.nan)
+    counts = np.searchsorted(transient_times, event_times + stop) - np.searchsorted(transient_times, event_times + start)
+    return counts/(stop - start)
+
+
+## This function measures every trial of one event type, for every metric of its windows
+def window_metrics(window, transients, response = None):
+    #window is one event type from peri_event.peri_event_windows and transients holds the detect_transients output of
+    #each of its metrics. response is the end (seconds after the event) of the response window, blank is the whole
+    #post window. Returns a dictionary of (trials x metrics) arrays.
+    time = np.asarray(window['time'])
+    interval = time[1] - time[0] if len(time) > 1 else 1.0
+    response = time[-1] if response is None else min(float(response), time[-1])
+    #samples outside the recording are already NaN in the windows
+    data = np.asarray(window['data'], dtype = np.float64)
+    before, after = time < 0, (time >= 0) & (time <= response)
+    present = window['valid'][..., None]
+
+    #areas over the samples inside the recording, NaN when the window has none
+    pre_auc = np.where(np.any(present[:, before], axis = 1), np.nansum(data[:, before], axis = 1)*interval, np.nan)
+    post_auc = np.where(np.any(present[:, after], axis = 1), np.nansum(data[:, after], axis = 1)*interval, np.nan)
+
+    #peak of the response window, a trial without samples there gets NaN
+    response_data = data[:, after]
+    peak_index = np.argmax(np.where(present[:, after], response_data, -np.inf), axis = 1)
+    has_samples = np.any(present[:, after], axis = 1)
+    peak = np.where(has_samples, np.take_along_axis(response_data, peak_index[:, None], axis = 1)[:, 0], np.nan)
+    peak_latency = np.where(has_samples, time[after][peak_index], np.nan)
+
+    #transient rates of each window, from the transients of the whole session
+    event_times = np.asarray(window['event_time'], dtype = np.float64)
+    pre_rate = np.column_stack([transient_rate(transients[metric]['time'], event_times, time[0], 0) for metric in window['metrics']])
+    post_rate = np.column_stack([transient_rate(transients[metric]['time'], event_times, 0, response) for metric in window['metrics']])
+    return {'pre_auc': pre_auc, 'post_auc': post_auc, 'peak': peak, 'peak_latency': peak_latency,
+            'pre_rate': pre_rate, 'post_rate': post_rate}
+
+
+## This function measures the trials of every event type of a subject and returns them as one tidy table
+@instrument.timed
+def event_metrics(windows, transients, response = None):
+    #One row per event type, trial and metric, with the time of the event and every measure of window_metrics.
+    columns = ['event', 'trial', 'event_time', 'metric', 'pre_auc', 'post_auc', 'peak', 'peak_latency', 'pre_rate', 'post_rate']
+    tables = []
+    for name, window in windows.items():
+        trials, metrics = window['data'].shape[0], len(window['metrics'])
+        if trials == 0:
+            continue
+        measures = window_metrics(window, transients, response)
+        table = {
+            'event': name,
+            'trial': np.repeat(np.arange(trials), metrics),
+            'event_time': np.repeat(np.asarray(window['event_time'], dtype = np.float64), metrics),
+            'metric': np.tile(window['metrics'], trials)
+        }
+        table.update({measure: values.ravel() for measure, values in measures.items()})
+        tables.append(pd.DataFrame(table, columns = columns))
+    return pd.concat(tables, ignore_index = True) if tables else pd.DataFrame(columns = columns)
+
+
+## This function lists the transients of every metric as one tidy table
+def transient_table(transients):
+    columns = ['metric', 'time', 'amplitude', 'prominence', 'width', 'noise']
+    tables = [pd.DataFrame({'metric': metric, 'time': found['time'], 'amplitude': found['amplitude'],
+                            'prominence': found['prominence'], 'width': found['width'], 'noise': found['noise']}, columns = columns)
+              for metric, found in transients.items()]
+    return pd.concat(tables, ignore_index = True) if tables else pd.DataFrame(columns = columns)
@@ -0,0 +1,307 @@
+"""
+This code lets any number of worker processes, on any number of machines sharing the output directory, drain the same
+batch of jobs. The queue is a folder of the output directory with one folder per job, and only needs the file system:
+1. Claiming - a job is claimed by creating its next lease file (lease.0, lease.1, ...) with O_EXCL, so only one worker
+   gets each generation of a job. A worker skips jobs that have a result or a live lease.
+2. Heartbeat - while a job runs, a thread of its worker touches the lease file every heartbeat_interval seconds.
+3. Reclaiming - a lease that has not been touched for lease_timeout seconds belongs to a worker that crashed (or lost
+   the file system), and the next worker to find it claims the next generation. A worker that finds a newer
+   generation of its own lease stops heart-beating and leaves the result to the new owner.
+4. Results - a finished job writes result.json next to its leases, through a temporary file and a rename. Workers
+   keep polling until every job has a result, so the jobs of a crashed worker are picked up by the others.
+   A job can have a key of its inputs (e.g. the stage keys of a setup), saved with its result: a result with a
+   different key counts as not done, so a queue run again after the tanks or options changed runs those jobs again.
+   The lease of a job is never touched after its result is saved, so a lease older than the result has expired and
+   the job is claimed again at once.
+The ages of the leases are measured against the clock of the file system (the time of a file touched just before),
+so the machines do not need synchronised clocks. Jobs must give the same outputs when they are run twice,
+since a job reclaimed from a worker that was only slow runs twice.
+
+python work_queue.py <output directory>            lists the state of every job of every queue
+python work_queue.py <output directory> --clear    deletes the queues so the next batch starts over
+"""
+import os
+import json
+import time
+import socket
+import hashlib
+import uuid
+import threading
+import contextlib
+import shutil
+import argparse
+import pandas as pd
+
+QUEUE_DIR = 'queue'
+RESULT_FILE = 'result.json'
+
+
+## This function returns the name of this worker, its host and process ID
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+## This function returns the folder of a queue in the output directory, one per batch and settings file
+def queue_path(output_file_path, batch, settings_path):
+    #The settings file is part of the name, so a changed settings file starts a new queue. Within a queue, jobs
+    #whose inputs changed are run again through their keys, see drain.
+    with open(settings_path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:12]
+    return os.path.join(output_file_path, QUEUE_DIR, f'{batch}_{digest}')
+
+
+## This function returns the folder of a job in a queue
+def job_path(path, name):
+    return os.path.join(path, str(name).replace(os.sep, '_'))
+
+
+## This function returns the time of the file system the queue is on, from a file created and removed in path
+def file_system_time(path):
+    clock = os.path.join(path, f".clock_{worker_name().replace(':', '_')}_{uuid.uuid4().hex}")
+    with open(clock, 'w'):
+        pass
+    try:
+        return os.path.getmtime(clock)
+    finally:
+        os.remove(clock)
+
+
+## This function lists the lease generations of a job, oldest first
+def lease_generations(path):
+    return sorted(int(file.split('.')[1]) for file in os.listdir(path) if file.startswith('lease.') and file.split('.')[1].isdigit())
+
+
+## This function returns the digest of a json serialisable value, for the keys of jobs
+def value_key(value):
+    return hashlib.sha1(json.dumps(value, sort_keys = True, default = str).encode()).hexdigest()
+
+
+## This function reads the result of a job, None when it has not finished or finished with another key than key
+def read_result(path, key = None):
+    try:
+        with open(os.path.join(path, RESULT_FILE)) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    if key is not None and saved['key'] != key:
+        return None
+    return saved['result']
+
+
+## This function returns when the result of a job was saved, on the clock of the file system, -inf without a result
+def result_time(path):
+    try:
+        return os.path.getmtime(os.path.join(path, RESULT_FILE))
+    except FileNotFoundError:
+        return float('-inf')
+
+
+## This function claims a job for this worker and returns its lease, None when the job is done or held by a live lease
+def claim(path, lease_timeout, key = None):
+    os.makedirs(path, exist_ok = True)
+    if read_result(path, key) is not None:
+        return None
+    generations = lease_generations(path)
+    generation = 0
+    if generations:
+        try:
+            touched = os.path.getmtime(os.path.join(path, f'lease.{generations[-1]}'))
+            age = file_system_time(os.path.dirname(path)) - touched
+        except FileNotFoundError:
+            return None
+        #a lease last touched before the result was saved belongs to a run that finished with another key, and the
+        #heartbeat stops before the result is saved, so it has expired even if it is younger than lease_timeout
+        if age < lease_timeout and not touched < result_time(path):
+            return None
+        generation = generations[-1] + 1
+
+    #only one worker can create each generation, a worker that loses the race moves on to the next job
+    lease_file = os.path.join(path, f'lease.{generation}')
+    try:
+        fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    lease = {'path': path, 'file': lease_file, 'generation': generation, 'worker': worker_name(), 'claimed': time.time(), 'lost': False,
+             'key': key}
+    with os.fdopen(fd, 'w') as f:
+        json.dump({key: lease[key] for key in ('generation', 'worker', 'claimed')}, f)
+
+    #a slow worker may have finished the job between the checks above and the claim
+    if read_result(path, key) is not None:
+        return None
+    return lease
+
+
+## This function checks that no other worker has reclaimed a lease
+def still_held(lease):
+    return not any(generation > lease['generation'] for generation in lease_generations(lease['path']))
+
+
+## This function touches a lease every interval seconds while the job runs
+@contextlib.contextmanager
+def heartbeat(lease, interval):
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(interval):
+            if not still_held(lease):
+                lease['lost'] = True
+                return
+            try:
+                os.utime(lease['file'])
+            except OSError:
+                #the file system may come back before the lease times out
+                pass
+    thread = threading.Thread(target = beat, name = 'heartbeat', daemon = True)
+    thread.start()
+    try:
+        yield lease
+    finally:
+        stop.set()
+        thread.join()
+
+
+## This function saves the result of a job, unless its lease was reclaimed by another worker in the meantime
+def complete(lease, result):
+    #Returns whether the result was saved. The rename makes the result appear whole or not at all.
+    if lease['lost'] or not still_held(lease):
+        return False
+    temporary = os.path.join(lease['path'], f"{RESULT_FILE}.{lease['worker'].replace(':', '_')}.tmp")
+    with open(temporary, 'w') as f:
+        json.dump({'key': lease['key'], 'result': result}, f)
+    os.replace(temporary, os.path.join(lease['path'], RESULT_FILE))
+    return True
+
+
+## This function runs the jobs of a queue until every one of them has a result, and returns the results
+def drain(path, names, run, lease_timeout = 120, heartbeat_interval = 10, poll = None, keys = None):
+    #names lists the jobs and run(name) runs one of them and returns its (json serialisable) result, failures included:
+    #an exception stops this worker and leaves the job to be reclaimed by another one. keys holds the key of the
+    #inputs of each job (see read_result), None takes any result as done. Jobs held by other workers are checked
+    #again every poll seconds (default heartbeat_interval) until they finish or their lease times out.
+    #Returns the result of every job by name, from whichever worker ran it.
+    poll = heartbeat_interval if poll is None else poll
+    keys = {} if keys is None else keys
+    os.makedirs(path, exist_ok = True)
+    pending = [name for name in names if read_result(job_path(path, name), keys.get(name)) is None]
+    if names and not pending:
+        print(f'Every job of the queue {path} is already done with the same inputs, clear it with python work_queue.py <output directory> --clear to run them again')
+    while pending:
+        for name in pending:
+            lease = claim(job_path(path, name), lease_timeout, keys.get(name))
+            if lease is None:
+                continue
+            with heartbeat(lease, heartbeat_interval):
+                result = run(name)
+            complete(lease, result)
+        pending = [name for name in pending if read_result(job_path(path, name), keys.get(name)) is None]
+        if pending:
+            time.sleep(poll)
+    return {name: read_result(job_path(path, name), keys.get(name)) for name in names}
+
+
+## This function moves a lock file to a private name and returns what it holds and the private name, (None, None) without a lock
+def take_lock(lock):
+    private = f'{lock}.{uuid.uuid4().hex}'
+    try:
+        os.rename(lock, private)
+    except FileNotFoundError:
+        return None, None
+    with open(private) as f:
+        return f.read(), private
+
+
+## This function puts back a lock moved away by take_lock that was not ours, unless a new lock was made in the meantime
+def restore_lock(lock, private):
+    try:
+        os.link(private, lock)
+    except FileExistsError:
+        pass
+    os.remove(private)
+
+
+## This function holds a lock file while the block runs, for short updates of files shared by every worker
+@contextlib.contextmanager
+def exclusive(path, timeout = 600, poll = 0.1):
+    #A lock older than timeout seconds is left over from a crashed worker and is broken, so timeout must be well
+    #above the time the lock is held for. The lock holds a token of its holder, and a lock is only removed (on
+    #release, or when it is broken) after it has been renamed to a private name and found to hold the expected token,
+    #so a slow holder whose lock was broken never removes the lock of the worker that took over.
+    lock = f'{path}.lock'
+    token = f'{worker_name()}:{uuid.uuid4().hex}'
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                f.write(token)
+            break
+        except FileExistsError:
+            try:
+                if file_system_time(os.path.dirname(os.path.abspath(lock))) - os.path.getmtime(lock) > timeout:
+                    with open(lock) as f:
+                        stale = f.read()
+                    held, private = take_lock(lock)
+                    if private is not None and held == stale:
+                        os.remove(private)
+                    elif private is not None:
+                        #another worker took the lock over since it was read
+                        restore_lock(lock, private)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll)
+    try:
+        yield
+    finally:
+        held, private = take_lock(lock)
+        if private is not None and held == token:
+            os.remove(private)
+        else:
+            if private is not None:
+                restore_lock(lock, private)
+            print(f'The lock {lock} was broken while {worker_name()} held it, the lock timeout is too short')
+
+
+## This function lists the state of every job of the queues in the output directory
+def queue_status(output_file_path, lease_timeout = 120):
+    #state is 'done', 'running' (a live lease), 'stale' (a lease that has timed out) or 'waiting'
+    root = os.path.join(output_file_path, QUEUE_DIR)
+    rows = []
+    for queue in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        path = os.path.join(root, queue)
+        if not os.path.isdir(path):
+            continue
+        now = file_system_time(path)
+        for name in sorted(os.listdir(path)):
+            job = os.path.join(path, name)
+            if not os.path.isdir(job):
+                continue
+            generations = lease_generations(job)
+            lease = {}
+            if generations:
+                try:
+                    with open(os.path.join(job, f'lease.{generations[-1]}')) as f:
+                        lease = json.load(f)
+                except ValueError:
+                    #the lease is being written
+                    pass
+                age = now - os.path.getmtime(os.path.join(job, f'lease.{generations[-1]}'))
+            if read_result(job) is not None:
+                state = 'done'
+            elif generations:
+                state = 'running' if age < lease_timeout else 'stale'
+            else:
+                state = 'waiting'
+            rows.append({'queue': queue, 'job': name, 'state': state, 'worker': lease.get('worker', ''), 'claims': len(generations)})
+    return pd.DataFrame(rows, columns = ['queue', 'job', 'state', 'worker', 'claims'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Lists or clears the work queues of an output directory.')
+    parser.add_argument('output_file_path')
+    parser.add_argument('--clear', action = 'store_true', help = 'delete every queue of the output directory')
+    args = parser.parse_args()
+    if args.clear:
+        shutil.rmtree(os.path.join(args.output_file_path, QUEUE_DIR), ignore_errors = True)
+        print('Queues cleared')
+    else:
+        print(queue_status(args.output_file_path).to_string(index = False))